@@ -7,7 +7,9 @@ from code import InteractiveConsole
 from durus.client_storage import ClientStorage
 from durus.connection import Connection
 from durus.logger import log, logger, direct_output
+from durus.storage import FSYNC_POLICIES
 from durus.storage_server import DEFAULT_PORT, DEFAULT_HOST, DEFAULT_GCBYTES
+from durus.storage_server import DEFAULT_COMMIT_WINDOW
 from durus.storage_server import SocketAddress
 from durus.storage_server import StorageServer, wait_for_server
 from durus.utils import int8_to_str, str_to_int8, write
@@ -155,7 +157,11 @@ def get_storage(file, storage_class=None, **kwargs):
             storage_class = get_storage_class(file)
     return storage_class(file, **kwargs)
 
-def start_durus(logfile, logginglevel, address, storage, gcbytes):
+def start_durus(logfile, logginglevel, address, storage, gcbytes,
+                async_server=False, readers=0,
+                commit_window=DEFAULT_COMMIT_WINDOW):
+    if readers and async_server:
+        raise ValueError("Read replicas can not be used with async_server.")
     if logfile is None:
         logfile = sys.stderr
     else:
@@ -166,7 +172,18 @@ def start_durus(logfile, logginglevel, address, storage, gcbytes):
     if hasattr(storage, 'get_filename'):
         log(20, 'Storage file=%s address=%s',
             storage.get_filename(), socket_address)
-    StorageServer(storage, address=socket_address, gcbytes=gcbytes).serve()
+    server_options = {}
+    if readers:
+        from durus.replicated_storage_server import ReplicatedStorageServer
+        server_class = ReplicatedStorageServer
+        server_options['readers'] = readers
+    elif async_server:
+        from durus.async_storage_server import AsyncStorageServer
+        server_class = AsyncStorageServer
+    else:
+        server_class = StorageServer
+    server_class(storage, address=socket_address, gcbytes=gcbytes,
+                 commit_window=commit_window, **server_options).serve()
 
 def stop_durus(address):
     socket_address = SocketAddress.new(address)
@@ -238,10 +255,44 @@ def run_durus_main():
     parser.add_option(
         '--readonly', dest='readonly', action='store_true',
         help='Open the file in read-only mode.')
+    parser.add_option(
+        '--mmap', dest='mmap', action='store_true',
+        help=('Load records through a memory map of the file. '
+              '(FileStorage only)'))
+    parser.add_option(
+        '--pack-workers', dest='pack_workers', default=0, type='int',
+        help=('Find the reachable records for a pack in this many worker '
+              'processes. (FileStorage only, default=0)'))
+    parser.add_option(
+        '--min-live-ratio', dest='min_live_ratio', default=None,
+        type='float',
+        help=('Let garbage collections remove only what was written since '
+              'the last pack, while at least this fraction of the packed '
+              'records is unreplaced. (FileStorage only)'))
+    parser.add_option(
+        '--async', dest='async_server', action='store_true',
+        help='Serve clients from an asyncio event loop.')
+    parser.add_option(
+        '--readers', dest='readers', default=0, type='int',
+        help=('Load records in this many forked reader processes. '
+              '(FileStorage only, default=0)'))
+    parser.add_option(
+        '--fsync', dest='fsync', default=None, choices=FSYNC_POLICIES,
+        help=('When to flush commits to the disk: %s. '
+              'With "group", commits are acknowledged together after one '
+              'fsync. (FileStorage only, default=none)' %
+              ', '.join(FSYNC_POLICIES)))
+    parser.add_option(
+        '--commit-window', dest='commit_window',
+        default=DEFAULT_COMMIT_WINDOW, type='float',
+        help=('With --fsync=group, seconds to wait for more commits '
+              'to join a group. (default=%s)' % DEFAULT_COMMIT_WINDOW))
     parser.add_option(
         '--stop', dest='stop', action='store_true',
         help='Instead of starting the server, try to stop a running one.')
     (options, args) = parser.parse_args()
+    if options.async_server and options.readers:
+        parser.error('--async can not be used with --readers.')
     if getattr(options, 'address', None) is None:
         address = SocketAddress.new((options.host, options.port))
     elif options.address.startswith('@'):
@@ -252,15 +303,28 @@ def run_durus_main():
         address = SocketAddress.new(address=options.address,
             owner=options.owner, group=options.group, umask=options.umask)
     if not options.stop:
+        storage_options = {}
+        if options.mmap:
+            storage_options['mmap'] = True
+        if options.fsync:
+            storage_options['fsync'] = options.fsync
+        if options.pack_workers:
+            storage_options['pack_workers'] = options.pack_workers
+        if options.min_live_ratio is not None:
+            storage_options['min_live_ratio'] = options.min_live_ratio
         storage = get_storage(options.file,
                 storage_class=options.storage,
                 repair=options.repair,
-                readonly=options.readonly)
+                readonly=options.readonly,
+                **storage_options)
         start_durus(options.logfile,
                     options.logginglevel,
                     address,
                     storage,
-                    options.gcbytes)
+                    options.gcbytes,
+                    async_server=options.async_server,
+                    readers=options.readers,
+                    commit_window=options.commit_window)
     else:
         stop_durus(address)
 
@@ -277,10 +341,16 @@ def pack_storage_main():
     parser.add_option(
         '--host', dest="host", default=DEFAULT_HOST,
         help="Host of the server. (default=%s)" % DEFAULT_HOST)
+    parser.add_option(
+        '--pack-workers', dest='pack_workers', default=0, type='int',
+        help=('With --file, find the reachable records in this many worker '
+              'processes. (FileStorage only, default=0)'))
     (options, args) = parser.parse_args()
     if options.file is None:
         wait_for_server(options.host, options.port)
         storage = ClientStorage(host=options.host, port=options.port)
+    elif options.pack_workers:
+        storage = get_storage(options.file, pack_workers=options.pack_workers)
     else:
         storage = get_storage(options.file)
     connection = Connection(storage)
@@ -0,0 +1,218 @@
+/*
+$URL$
+$Id$
+
+C versions of the record helpers in serialize.py.
+ */
+
+#define PY_SSIZE_T_CLEAN
+#include "Python.h"
+
+#if PY_VERSION_HEX < 0x03000000
+	#define Bytes_FromStringAndSize PyString_FromStringAndSize
+	#define Bytes_AS_STRING PyString_AS_STRING
+	#define Str_FromString PyString_FromString
+	#define BUFFER_FORMAT "s*"
+#else
+	#define Bytes_FromStringAndSize PyBytes_FromStringAndSize
+	#define Bytes_AS_STRING PyBytes_AS_STRING
+	#define Str_FromString PyUnicode_FromString
+	#define BUFFER_FORMAT "y*"
+#endif
+
+#define OID_SIZE 8
+
+static Py_ssize_t
+read_int4(const unsigned char *p)
+{
+	return ((Py_ssize_t)p[0] << 24) | ((Py_ssize_t)p[1] << 16) |
+		((Py_ssize_t)p[2] << 8) | (Py_ssize_t)p[3];
+}
+
+static PyObject *
+pack_record(PyObject *self, PyObject *args)
+{
+	Py_buffer oid, data, refs;
+	PyObject *result = NULL;
+	unsigned char *p;
+	if (!PyArg_ParseTuple(args, BUFFER_FORMAT BUFFER_FORMAT BUFFER_FORMAT
+			":pack_record", &oid, &data, &refs))
+		return NULL;
+	if (data.len > 0xffffffffL) {
+		PyErr_SetString(PyExc_ValueError, "data is too long");
+		goto done;
+	}
+	result = Bytes_FromStringAndSize(NULL,
+		oid.len + 4 + data.len + refs.len);
+	if (result == NULL)
+		goto done;
+	p = (unsigned char *)Bytes_AS_STRING(result);
+	memcpy(p, oid.buf, oid.len);
+	p += oid.len;
+	p[0] = (unsigned char)(data.len >> 24);
+	p[1] = (unsigned char)(data.len >> 16);
+	p[2] = (unsigned char)(data.len >> 8);
+	p[3] = (unsigned char)data.len;
+	p += 4;
+	memcpy(p, data.buf, data.len);
+	memcpy(p + data.len, refs.buf, refs.len);
+done:
+	PyBuffer_Release(&oid);
+	PyBuffer_Release(&data);
+	PyBuffer_Release(&refs);
+	return result;
+}
+
+static PyObject *
+unpack_record(PyObject *self, PyObject *args)
+{
+	Py_buffer record;
+	PyObject *result = NULL;
+	const char *p;
+	Py_ssize_t data_end;
+	if (!PyArg_ParseTuple(args, BUFFER_FORMAT ":unpack_record", &record))
+		return NULL;
+	p = (const char *)record.buf;
+	if (record.len < OID_SIZE + 4) {
+		PyErr_SetString(PyExc_ValueError, "record is too short");
+		goto done;
+	}
+	data_end = OID_SIZE + 4 + read_int4((const unsigned char *)p + OID_SIZE);
+	if (data_end > record.len)
+		data_end = record.len; /* as slicing would */
+	result = Py_BuildValue(
+#if PY_VERSION_HEX < 0x03000000
+		"(s#s#s#)",
+#else
+		"(y#y#y#)",
+#endif
+		p, (Py_ssize_t)OID_SIZE,
+		p + OID_SIZE + 4, data_end - OID_SIZE - 4,
+		p + data_end, record.len - data_end);
+done:
+	PyBuffer_Release(&record);
+	return result;
+}
+
+static PyObject *
+split_oids(PyObject *self, PyObject *arg)
+{
+	Py_buffer s;
+	PyObject *result = NULL, *oid;
+	const char *p;
+	Py_ssize_t j, n;
+	int is_true = PyObject_IsTrue(arg);
+	if (is_true < 0)
+		return NULL;
+	if (!is_true)
+		return PyList_New(0);
+	if (PyObject_GetBuffer(arg, &s, PyBUF_SIMPLE) < 0)
+		return NULL;
+	if (s.len % OID_SIZE != 0) {
+		PyErr_SetString(PyExc_ValueError,
+			"length is not a multiple of the oid size");
+		goto done;
+	}
+	n = s.len / OID_SIZE;
+	result = PyList_New(n);
+	if (result == NULL)
+		goto done;
+	p = (const char *)s.buf;
+	for (j = 0; j < n; j++) {
+		oid = Bytes_FromStringAndSize(p + j * OID_SIZE, OID_SIZE);
+		if (oid == NULL) {
+			Py_DECREF(result);
+			result = NULL;
+			goto done;
+		}
+		PyList_SET_ITEM(result, j, oid);
+	}
+done:
+	PyBuffer_Release(&s);
+	return result;
+}
+
+static PyObject *
+extract_class_name(PyObject *self, PyObject *args)
+{
+	Py_buffer record;
+	PyObject *result = NULL;
+	const char *data, *start, *end;
+	Py_ssize_t data_length;
+	if (!PyArg_ParseTuple(args, BUFFER_FORMAT ":extract_class_name",
+			&record))
+		return NULL;
+	if (record.len < OID_SIZE + 4) {
+		PyErr_SetString(PyExc_ValueError, "record is too short");
+		goto done;
+	}
+	data = (const char *)record.buf + OID_SIZE + 4;
+	data_length = read_int4((const unsigned char *)data - 4);
+	if (data_length > record.len - OID_SIZE - 4)
+		data_length = record.len - OID_SIZE - 4;
+	/* The class name is the second line of the data. */
+	start = memchr(data, '\n', data_length);
+	if (start == NULL) {
+		result = Str_FromString("?");
+		goto done;
+	}
+	start++;
+	end = memchr(start, '\n', data + data_length - start);
+	if (end == NULL)
+		end = data + data_length;
+	result = Bytes_FromStringAndSize(start, end - start);
+done:
+	PyBuffer_Release(&record);
+	return result;
+}
+
+static char pack_record_doc[] = "\
+(oid:str, data:str, refs:str) -> record:str";
+
+static char unpack_record_doc[] = "\
+(record:str) -> oid:str, data:str, refs:str\n\
+The inverse of pack_record().";
+
+static char split_oids_doc[] = "\
+(s:str) -> [str]\n\
+s is a packed string of oids.  Return a list of oid strings.";
+
+static char extract_class_name_doc[] = "\
+(record:str) -> str\n\
+Return the class name in the pickle of the record's class.";
+
+static PyMethodDef serialize_module_methods[] = {
+	{"pack_record", pack_record, METH_VARARGS, pack_record_doc},
+	{"unpack_record", unpack_record, METH_VARARGS, unpack_record_doc},
+	{"split_oids", split_oids, METH_O, split_oids_doc},
+	{"extract_class_name", extract_class_name, METH_VARARGS,
+		extract_class_name_doc},
+	{NULL, NULL, 0, NULL} /* sentinel */
+};
+
+#if PY_VERSION_HEX >= 0x03000000
+    static struct PyModuleDef serialize_module = {
+        PyModuleDef_HEAD_INIT,
+        "_serialize",
+        "",
+        -1,
+        serialize_module_methods,
+        NULL,
+        NULL,
+        NULL,
+        NULL
+    };
+
+	PyMODINIT_FUNC
+	PyInit__serialize(void)
+	{
+		return PyModule_Create(&serialize_module);
+	}
+#else
+	PyMODINIT_FUNC
+	init_serialize(void)
+	{
+		Py_InitModule4("_serialize", serialize_module_methods, "",
+			NULL, PYTHON_API_VERSION);
+	}
+#endif
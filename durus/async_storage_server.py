@@ -0,0 +1,148 @@
+"""
+$URL$
+$Id$
+
+A StorageServer that runs its clients on an asyncio event loop.
+
+Every command is read completely, without blocking the loop, before the
+regular StorageServer handler runs, so one slow client cannot stall the
+others.  Commits are serialized by a lock, and pack steps take turns with
+the clients instead of running only when every client is idle.  With group
+commit, the acknowledgements are sent from a timer on the loop.
+"""
+from durus.logger import log
+from durus.storage_server import StorageServer, ClientError, _Client
+from durus.storage_server import InheritedSocket, TIMEOUT
+from durus.systemd_socket import get_systemd_socket
+from durus.utils import BytesIO, str_to_int4
+import asyncio
+import socket
+
+# The number of bytes that follow each command code, for the commands
+# whose requests have a fixed size.
+FIXED_REQUEST_SIZES = dict(N=0, M=1, L=8, S=0, P=0, V=4, Q=0)
+
+
+class _StreamSocket (object):
+    """
+    Stands in for a client socket when a StorageServer handler runs.
+    Reads come from the request that has already been received, and
+    writes are buffered on the stream.
+    """
+    def __init__(self, writer):
+        self.writer = writer
+        self.request = BytesIO()
+
+    def set_request(self, data):
+        self.request = BytesIO(data)
+
+    def read(self, n):
+        return self.request.read(n)
+
+    def write(self, data):
+        self.writer.write(data)
+
+
+class AsyncStorageServer (StorageServer):
+
+    def serve(self):
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        sock = get_systemd_socket()
+        if sock is None:
+            sock = self.address.get_listening_socket()
+        else:
+            self.address = InheritedSocket(sock)
+        log(20, 'Ready on %s', self.address)
+        self.commit_lock = asyncio.Lock()
+        self.quit = asyncio.Event()
+        self.pack_task = None
+        server = await asyncio.start_server(self._serve_client, sock=sock)
+        try:
+            async with server:
+                await self.quit.wait()
+        finally:
+            self.address.close(sock)
+
+    async def _serve_client(self, reader, writer):
+        s = _StreamSocket(writer)
+        client = _Client(s, writer.get_extra_info('peername'))
+        self.clients.append(client)
+        try:
+            while not self.quit.is_set():
+                command = await reader.read(1)
+                if not command:
+                    break
+                await self._handle(reader, s, chr(command[0]))
+                await writer.drain()
+                self._start_gc_if_due()
+                self._schedule_packer()
+        except SystemExit:
+            self.quit.set()
+        except (ClientError, asyncio.IncompleteReadError, asyncio.TimeoutError,
+            socket.error, IOError) as exc:
+            log(10, '%s', ''.join(map(str, exc.args)))
+        finally:
+            self.clients.remove(client)
+            writer.close()
+
+    async def _handle(self, reader, s, command_code):
+        handler = getattr(self, 'handle_%s' % command_code, None)
+        if handler is None:
+            raise ClientError('No such command code: %r' % command_code)
+        if command_code == 'C':
+            # The invalidations sent to the client must stay complete until
+            # its transaction data arrives, so no other commit may start.
+            async with self.commit_lock:
+                self._send_commit_invalidations(s)
+                await s.writer.drain()
+                size = str_to_int4(await self._read(reader, 4))
+                self._commit(s, await self._read(reader, size))
+        else:
+            s.set_request(await self._read_request(reader, command_code))
+            handler(s)
+
+    async def _read_request(self, reader, command_code):
+        if command_code in FIXED_REQUEST_SIZES:
+            return await self._read(reader, FIXED_REQUEST_SIZES[command_code])
+        if command_code == 'B':
+            head = await self._read(reader, 4)
+        elif command_code == 'F':
+            head = await self._read(reader, 8)
+        else:
+            raise ClientError('No request format for: %r' % command_code)
+        number_of_oids = str_to_int4(head[-4:])
+        return head + await self._read(reader, 8 * number_of_oids)
+
+    async def _read(self, reader, n):
+        if n == 0:
+            return b''
+        return await asyncio.wait_for(reader.readexactly(n), TIMEOUT)
+
+    def _acknowledge_commit(self, s):
+        first = not self.commit_acks
+        StorageServer._acknowledge_commit(self, s)
+        if self.commit_acks and first:
+            asyncio.get_running_loop().call_later(
+                self.commit_window, self._send_due_commit_acks)
+
+    def _send_due_commit_acks(self):
+        if self.commit_acks:
+            self._send_commit_acks()
+
+    def _schedule_packer(self):
+        if self.packer is not None and self.pack_task is None:
+            self.pack_task = asyncio.get_running_loop().create_task(
+                self._run_packer())
+
+    async def _run_packer(self):
+        # One pack step per turn of the event loop, so that clients with
+        # requests ready are served between steps.
+        try:
+            while self.packer is not None and not self.quit.is_set():
+                async with self.commit_lock:
+                    self._pack_step()
+                await asyncio.sleep(0)
+        finally:
+            self.pack_task = None
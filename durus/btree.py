@@ -3,6 +3,7 @@ $URL$
 $Id$
 """
 
+from bisect import bisect_left
 import collections.abc
 from durus.persistent import PersistentObject
 
@@ -24,9 +25,15 @@ class _NullCount:
 class BNode(PersistentObject):
     """
     Instance attributes:
-      items: list
+      keys: list
+      values: list
+        The keys of the items in this node, in order, and their values.
       nodes: [BNode]
       _count: int | _NullCount
+      counts: [int] | None
+        The _count of each of the nodes, kept here so that a position can
+        be found without loading the siblings on the way down.  None in a
+        leaf, and in a node stored before counts were kept.
     """
     minimum_degree = 2 # a.k.a. t
 
@@ -34,121 +41,148 @@ class BNode(PersistentObject):
     # _count instance attribute.
     _count = _NullCount()
 
+    # This exists for leaves, and for BNode instances stored before the
+    # addition of the counts instance attribute.
+    counts = None
+
     def __init__(self):
-        self.items = []
+        self.keys = []
+        self.values = []
         self.nodes = None
         self._count = 0
 
+    def __setstate__(self, state):
+        if 'items' in state:
+            # A BNode stored before keys and values were kept apart.
+            state = dict(state)
+            items = state.pop('items')
+            state['keys'] = [item[0] for item in items]
+            state['values'] = [item[1] for item in items]
+        PersistentObject.__setstate__(self, state)
+
+    def _get_items(self):
+        return list(zip(self.keys, self.values))
+
+    def _set_items(self, items):
+        self.keys = [item[0] for item in items]
+        self.values = [item[1] for item in items]
+
+    items = property(_get_items, _set_items,
+        doc="A new list of the (key, value) items in this node.")
+
     def is_leaf(self):
         return self.nodes is None
 
     def __iter__(self):
         if self.is_leaf():
-            yield from self.items
+            yield from zip(self.keys, self.values)
         else:
-            for position, item in enumerate(self.items):
+            for position, item in enumerate(zip(self.keys, self.values)):
                 yield from self.nodes[position]
                 yield item
             yield from self.nodes[-1]
 
     def __reversed__(self):
         if self.is_leaf():
-            for item in reversed(self.items):
-                yield item
+            yield from zip(reversed(self.keys), reversed(self.values))
         else:
-            for item in reversed(self.nodes[-1]):
-                yield item
-            for position in range(len(self.items) - 1, -1, -1):
-                yield self.items[position]
-                for item in reversed(self.nodes[position]):
-                    yield item
+            yield from reversed(self.nodes[-1])
+            for position in range(len(self.keys) - 1, -1, -1):
+                yield self.keys[position], self.values[position]
+                yield from reversed(self.nodes[position])
 
     def iter_from(self, key):
         position = self.get_position(key)
         if self.is_leaf():
-            for item in self.items[position:]:
-                yield item
+            yield from zip(self.keys[position:], self.values[position:])
         else:
-            for item in self.nodes[position].iter_from(key):
-                yield item
-            for p in range(position, len(self.items)):
-                yield self.items[p]
-                for item in self.nodes[p + 1]:
-                    yield item
+            yield from self.nodes[position].iter_from(key)
+            for p in range(position, len(self.keys)):
+                yield self.keys[p], self.values[p]
+                yield from self.nodes[p + 1]
 
     def iter_backward_from(self, key):
         position = self.get_position(key)
         if self.is_leaf():
-            for item in reversed(self.items[:position]):
-                yield item
+            yield from zip(reversed(self.keys[:position]),
+                           reversed(self.values[:position]))
         else:
-            for item in self.nodes[position].iter_backward_from(key):
-                yield item
+            yield from self.nodes[position].iter_backward_from(key)
             for p in range(position - 1, -1, -1):
-                yield self.items[p]
-                for item in reversed(self.nodes[p]):
-                    yield item
+                yield self.keys[p], self.values[p]
+                yield from reversed(self.nodes[p])
 
     def is_full(self):
-        return len(self.items) == 2 * self.minimum_degree - 1
+        return len(self.keys) == 2 * self.minimum_degree - 1
 
     def get_position(self, key):
-        for position, item in enumerate(self.items):
-            if item[0] >= key:
-                return position
-        return len(self.items)
+        """(key:anything) -> int
+        Return the position of the first key that is not less than key.
+        """
+        return bisect_left(self.keys, key)
 
     def search(self, key):
         """(key:anything) -> None | (key:anything, value:anything)
         Return the matching pair, or None.
         """
-        position = self.get_position(key)
-        if position < len(self.items) and self.items[position][0] == key:
-            return self.items[position]
-        elif self.is_leaf():
-            return None
-        else:
-            return self.nodes[position].search(key)
+        node = self
+        while True:
+            keys = node.keys
+            position = bisect_left(keys, key)
+            if position < len(keys) and keys[position] == key:
+                return keys[position], node.values[position]
+            if node.nodes is None:
+                return None
+            node = node.nodes[position]
 
     def insert_item(self, item):
         """(item:(key:anything, value:anything))
         """
         assert not self.is_full()
-        key = item[0]
-        position = self.get_position(key)
-        if position < len(self.items) and self.items[position][0] == key:
-            self.items[position] = item
+        key, value = item
+        position = bisect_left(self.keys, key)
+        if position < len(self.keys) and self.keys[position] == key:
+            self.keys[position] = key
+            self.values[position] = value
             self._p_note_change()
         elif self.is_leaf():
-            self.items.insert(position, item)
+            self.keys.insert(position, key)
+            self.values.insert(position, value)
             self._count += 1
             self._p_note_change()
         else:
             child = self.nodes[position]
             if child.is_full():
                 self.split_child(position, child)
-                if key == self.items[position][0]:
-                    self.items[position] = item
+                if key == self.keys[position]:
+                    self.keys[position] = key
+                    self.values[position] = value
                     self._p_note_change()
-                else:
-                    if key > self.items[position][0]:
-                        position += 1
-                    old_count = self.nodes[position]._count
-                    self.nodes[position].insert_item(item)
-                    self._count += self.nodes[position]._count - old_count
-            else:
-                old_count = self.nodes[position]._count
-                self.nodes[position].insert_item(item)
-                self._count += self.nodes[position]._count - old_count
+                    return
+                if key > self.keys[position]:
+                    position += 1
+            old_count = self.nodes[position]._count
+            self.nodes[position].insert_item(item)
+            self._count += self.nodes[position]._count - old_count
+            self._update_child_count(position)
 
     def _update_count(self):
         """Update _count to match the actual item count."""
-        if self.is_leaf():
-            self._count = len(self.items)
-        else:
-            self._count = len(self.items)
-            for node in self.nodes:
-                self._count += node._count
+        self._count = len(self.keys)
+        if not self.is_leaf():
+            if self.counts is None:
+                for node in self.nodes:
+                    self._count += node._count
+            else:
+                self._count += sum(self.counts)
+
+    def _update_child_count(self, position):
+        """(position:int)
+        Update the count kept for the child at position.
+        """
+        if self.counts is not None:
+            self.counts[position] = self.nodes[position]._count
+            self._p_note_change()
 
     def _change_count(self, delta):
         """Update _count by delta."""
@@ -167,18 +201,28 @@ class BNode(PersistentObject):
         assert child.is_full()
         bigger = self.__class__()
         middle = self.minimum_degree - 1
-        splitting_key = child.items[middle]
-        bigger.items = child.items[middle + 1 :]
-        child.items = child.items[:middle]
-        assert len(bigger.items) == len(child.items)
+        splitting_key = child.keys[middle]
+        splitting_value = child.values[middle]
+        bigger.keys = child.keys[middle + 1 :]
+        bigger.values = child.values[middle + 1 :]
+        child.keys = child.keys[:middle]
+        child.values = child.values[:middle]
+        assert len(bigger.keys) == len(child.keys)
         if not child.is_leaf():
             bigger.nodes = child.nodes[middle + 1 :]
             child.nodes = child.nodes[: middle + 1]
             assert len(bigger.nodes) == len(child.nodes)
-        self.items.insert(position, splitting_key)
+            if child.counts is not None:
+                bigger.counts = child.counts[middle + 1 :]
+                child.counts = child.counts[: middle + 1]
+        self.keys.insert(position, splitting_key)
+        self.values.insert(position, splitting_value)
         self.nodes.insert(position + 1, bigger)
         bigger._update_count()
         child._count -= bigger._count + 1
+        if self.counts is not None:
+            self.counts[position] = child._count
+            self.counts.insert(position + 1, bigger._count)
         self._p_note_change()
 
     def get_min_item(self):
@@ -186,7 +230,7 @@ class BNode(PersistentObject):
         Return the item with the minimal key.
         """
         if self.is_leaf():
-            return self.items[0]
+            return self.keys[0], self.values[0]
         else:
             return self.nodes[0].get_min_item()
 
@@ -195,7 +239,7 @@ class BNode(PersistentObject):
         Return the item with the maximal key.
         """
         if self.is_leaf():
-            return self.items[-1]
+            return self.keys[-1], self.values[-1]
         else:
             return self.nodes[-1].get_max_item()
 
@@ -207,21 +251,26 @@ class BNode(PersistentObject):
         """
         def is_big(node):
             # Precondition for recursively calling node.delete(key).
-            return node and len(node.items) >= node.minimum_degree
+            return node is not None and len(node.keys) >= node.minimum_degree
         p = self.get_position(key)
-        matches = p < len(self.items) and self.items[p][0] == key
+        matches = p < len(self.keys) and self.keys[p] == key
         if self.is_leaf():
             if matches:
                 # Case 1.
-                del self.items[p]
+                del self.keys[p]
+                del self.values[p]
                 self._count -= 1
                 self._p_note_change()
             else:
                 raise KeyError(key)
         else:
             node = self.nodes[p]
-            lower_sibling = p > 0 and self.nodes[p - 1]
-            upper_sibling = p < len(self.nodes) - 1 and self.nodes[p + 1]
+            # Test these against None: the truth of a BNode is its _count.
+            lower_sibling = upper_sibling = None
+            if p > 0:
+                lower_sibling = self.nodes[p - 1]
+            if p < len(self.nodes) - 1:
+                upper_sibling = self.nodes[p + 1]
             if matches:
                 # Case 2.
                 if is_big(node):
@@ -229,87 +278,124 @@ class BNode(PersistentObject):
                     extreme = node.get_max_item()
                     node.delete(extreme[0])
                     self._count -= 1
-                    self.items[p] = extreme
+                    self._update_child_count(p)
+                    self.keys[p], self.values[p] = extreme
                 elif is_big(upper_sibling):
                     # Case 2b.
                     extreme = upper_sibling.get_min_item()
                     upper_sibling.delete(extreme[0])
                     self._count -= 1
-                    self.items[p] = extreme
+                    self._update_child_count(p + 1)
+                    self.keys[p], self.values[p] = extreme
                 else:
-                    # Case 2c.
-                    extreme = upper_sibling.get_min_item()
-                    upper_sibling.delete(extreme[0])
-                    node.items = node.items + [extreme] + upper_sibling.items
+                    # Case 2c: Merge the item and upper_sibling into node,
+                    # and delete the key from there.
+                    node.keys = node.keys + [key] + upper_sibling.keys
+                    node.values = (
+                        node.values + [self.values[p]] + upper_sibling.values)
                     if not node.is_leaf():
                         node.nodes = node.nodes + upper_sibling.nodes
-                    node._count += upper_sibling._count
-                    self._count -= 1
-                    del self.items[p]
+                        node.counts = _join_counts(node, upper_sibling)
+                    node._count += upper_sibling._count + 1
+                    del self.keys[p]
+                    del self.values[p]
                     del self.nodes[p + 1]
+                    if self.counts is not None:
+                        del self.counts[p + 1]
+                    node.delete(key)
+                    self._count -= 1
+                    self._update_child_count(p)
                 self._p_note_change()
             else:
                 if not is_big(node):
                     if is_big(lower_sibling):
                         # Case 3a1: Shift an item from lower_sibling.
-                        node.items.insert(0, self.items[p - 1])
+                        node.keys.insert(0, self.keys[p - 1])
+                        node.values.insert(0, self.values[p - 1])
                         node._count += 1
-                        self.items[p - 1] = lower_sibling.items[-1]
-                        del lower_sibling.items[-1]
+                        self.keys[p - 1] = lower_sibling.keys.pop()
+                        self.values[p - 1] = lower_sibling.values.pop()
                         lower_sibling._count -= 1
                         if not node.is_leaf():
-                            node.nodes.insert(0, lower_sibling.nodes[-1])
-                            del lower_sibling.nodes[-1]
+                            moved = _move_child(lower_sibling, node, True)
+                            node._count += moved
+                            lower_sibling._count -= moved
+                        self._update_child_count(p - 1)
                         lower_sibling._p_note_change()
                     elif is_big(upper_sibling):
                         # Case 3a2: Shift an item from upper_sibling.
-                        node.items.append(self.items[p])
+                        node.keys.append(self.keys[p])
+                        node.values.append(self.values[p])
                         node._count += 1
-                        self.items[p] = upper_sibling.items[0]
-                        del upper_sibling.items[0]
+                        self.keys[p] = upper_sibling.keys.pop(0)
+                        self.values[p] = upper_sibling.values.pop(0)
                         upper_sibling._count -= 1
                         if not node.is_leaf():
-                            node.nodes.append(upper_sibling.nodes[0])
-                            del upper_sibling.nodes[0]
+                            moved = _move_child(upper_sibling, node, False)
+                            node._count += moved
+                            upper_sibling._count -= moved
+                        self._update_child_count(p + 1)
                         upper_sibling._p_note_change()
-                    elif lower_sibling:
+                    elif lower_sibling is not None:
                         # Case 3b1: Merge with lower_sibling
-                        node.items = (
-                            lower_sibling.items
-                            + [self.items[p - 1]]
-                            + node.items
+                        node.keys = (
+                            lower_sibling.keys
+                            + [self.keys[p - 1]]
+                            + node.keys
+                        )
+                        node.values = (
+                            lower_sibling.values
+                            + [self.values[p - 1]]
+                            + node.values
                         )
                         if not node.is_leaf():
                             node.nodes = lower_sibling.nodes + node.nodes
+                            node.counts = _join_counts(lower_sibling, node)
                         node._count += lower_sibling._count + 1
-                        del self.items[p - 1]
+                        del self.keys[p - 1]
+                        del self.values[p - 1]
                         del self.nodes[p - 1]
+                        if self.counts is not None:
+                            del self.counts[p - 1]
+                        p -= 1
                     else:
                         # Case 3b2: Merge with upper_sibling
-                        node.items = (
-                            node.items + [self.items[p]] + upper_sibling.items
+                        node.keys = (
+                            node.keys + [self.keys[p]] + upper_sibling.keys)
+                        node.values = (
+                            node.values
+                            + [self.values[p]]
+                            + upper_sibling.values
                         )
                         if not node.is_leaf():
                             node.nodes = node.nodes + upper_sibling.nodes
+                            node.counts = _join_counts(node, upper_sibling)
                         node._count += upper_sibling._count + 1
-                        del self.items[p]
+                        del self.keys[p]
+                        del self.values[p]
                         del self.nodes[p + 1]
+                        if self.counts is not None:
+                            del self.counts[p + 1]
                     self._p_note_change()
                     node._p_note_change()
                 assert is_big(node)
                 old_count = node._count
                 node.delete(key)
                 self._count += node._count - old_count
-            if not self.items:
+                self._update_child_count(p)
+            if not self.keys:
                 # This can happen when self is the root node.
-                self.items = self.nodes[0].items
-                self.nodes = self.nodes[0].nodes
+                child = self.nodes[0]
+                self.keys = child.keys
+                self.values = child.values
+                self.nodes = child.nodes
+                self.counts = child.counts
 
     def get_count(self):
         """() -> int
         How many items are stored in this node and descendants?
         """
-        result = len(self.items)
+        result = len(self.keys)
         for node in self.nodes or []:
             result += node.get_count()
         return result
@@ -368,38 +454,632 @@ class BNode512(BNode):
 
 # Set narrow specifications of BNode instance attributes.
 for bnode_class in [BNode] + BNode.__subclasses__():
-    bnode_class.items_is = [tuple]
+    bnode_class.keys_is = list
+    bnode_class.values_is = list
     bnode_class.nodes_is = (None, [bnode_class])
+    bnode_class.counts_is = (None, [int])
 del bnode_class
 
+def _join_counts(*nodes):
+    """(*nodes:BNode) -> [int] | None
+    Return the counts of the children of the given nodes, one node after
+    the other, or None if any of them has no counts.
+    """
+    result = []
+    for node in nodes:
+        if node.counts is None:
+            return None
+        result.extend(node.counts)
+    return result
+
+def _move_child(source, target, to_front):
+    """(source:BNode, target:BNode, to_front:bool) -> int
+    Move the last child of source to the front of target, if to_front is
+    true, or else the first child of source to the end of target, with
+    its count, and return the count.
+    """
+    position = -1 if to_front else 0
+    moved = source.nodes.pop(position)
+    if source.counts is None:
+        count = moved._count
+        target.counts = None
+    else:
+        count = source.counts.pop(position)
+    if to_front:
+        target.nodes.insert(0, moved)
+        if target.counts is not None:
+            target.counts.insert(0, count)
+    else:
+        target.nodes.append(moved)
+        if target.counts is not None:
+            target.counts.append(count)
+    return count
+
+def _get_child_counts(node, stop=None):
+    """(node:BNode, stop:int=None) -> [int]
+    Return the numbers of items under the children of node, up to the
+    child at position stop.  They are read from node.counts.  For a node
+    stored before counts were kept, those children are loaded with one
+    call to Connection.prefetch(), and any stored before BNode kept a
+    _count are counted the slow way.
+    """
+    if node.counts is not None and not isinstance(node._count, _NullCount):
+        return node.counts[:stop]
+    children = node.nodes[:stop]
+    connection = node._p_connection
+    if connection is not None:
+        connection.prefetch(children)
+    counts = []
+    for child in children:
+        count = child._count
+        if isinstance(count, _NullCount):
+            count = child.get_count()
+        counts.append(count)
+    return counts
+
+
+# The most child nodes that _gen_items() loads in one prefetch.  Without
+# an end or a limit, the batches start with one node, and double as the
+# walk goes on, so that a walk that stops early loads little more than it
+# uses.
+PREFETCH_SIZE = 32
+
+# Marks a missing bound for _gen_items().
+_UNBOUNDED = object()
+
+
+def _prefetch_children(frame, end, remaining, size):
+    """(frame:[BNode, int, int], end:anything, remaining:int|None, size:int)
+        -> bool
+    If the child at the frame's position has not been prefetched, load the
+    ghosts among it and the children that follow it, up to size of them,
+    and up to the ones that may hold end, or remaining more items, using
+    one call to Connection.prefetch().  Return True if a batch was started.
+    """
+    node, position, fetched = frame
+    if position < fetched:
+        return False
+    stop = min(len(node.nodes), position + size)
+    if end is not _UNBOUNDED:
+        stop = min(stop, bisect_left(node.keys, end) + 1)
+    if remaining is not None:
+        stop = min(stop, position + remaining // node.minimum_degree + 1)
+    stop = max(stop, position + 1)
+    frame[2] = stop
+    connection = node._p_connection
+    if connection is not None and stop - position > 1:
+        connection.prefetch(node.nodes[position:stop])
+    return True
+
+def _gen_items(root, start=_UNBOUNDED, end=_UNBOUNDED, limit=None):
+    """(root:BNode, start:anything=_UNBOUNDED, end:anything=_UNBOUNDED,
+        limit:int=None) -> generator
+    Generate, in order, the items under root whose keys are not less than
+    start, and at most limit of them.  The nodes are walked with a stack
+    instead of nested generators, and the children needed next are loaded
+    in batches by _prefetch_children().  end is the largest key that the
+    caller may want, and only bounds those batches.
+    """
+    remaining = limit
+    if remaining is not None and remaining <= 0:
+        return
+    if end is _UNBOUNDED and limit is None:
+        size = 1
+    else:
+        # The caller says how far it will read.
+        size = PREFETCH_SIZE
+    stack = []
+    node = root
+    while True:
+        # Descend to the leaf holding the next item.
+        while True:
+            if start is _UNBOUNDED:
+                position = 0
+            else:
+                position = bisect_left(node.keys, start)
+            if node.nodes is None:
+                break
+            frame = [node, position, position]
+            stack.append(frame)
+            _prefetch_children(frame, end, remaining, size)
+            node = node.nodes[position]
+        start = _UNBOUNDED
+        for item in zip(node.keys[position:], node.values[position:]):
+            yield item
+            if remaining is not None:
+                remaining -= 1
+                if not remaining:
+                    return
+        # Climb to the next separating item, and the child after it.
+        while stack:
+            frame = stack[-1]
+            node, position = frame[0], frame[1]
+            if position < len(node.keys):
+                yield node.keys[position], node.values[position]
+                if remaining is not None:
+                    remaining -= 1
+                    if not remaining:
+                        return
+                frame[1] = position + 1
+                if _prefetch_children(frame, end, remaining, size):
+                    size = min(2 * size, PREFETCH_SIZE)
+                node = node.nodes[position + 1]
+                break
+            stack.pop()
+        else:
+            return
+
+
+# The fraction of the maximum number of keys that load_sorted() puts in
+# each node.  Some room is left for later inserts.
+DEFAULT_FILL = 0.9
+
+
+class _SortedBuilder(object):
+    """
+    Builds the nodes of a tree, bottom-up, from items given in increasing
+    key order.  A node is made only when enough follows it at its level
+    that the last nodes of the level can not be underfull, so each BNode
+    is made once, with its final contents.
+
+    Instance attributes:
+      node_constructor: class
+      size: int
+        The number of keys in each node made before finish().
+      levels: [(keys:list, values:list, nodes:list|None, counts:list|None)]
+        For each level, from the leaves up, the items and children that
+        do not yet belong to a node, and the item counts of the children.
+    """
+
+    def __init__(self, node_constructor, fill):
+        assert 0 < fill <= 1
+        self.node_constructor = node_constructor
+        degree = node_constructor.minimum_degree
+        self.size = max(degree - 1, min(2 * degree - 1,
+                                        int(fill * (2 * degree - 1))))
+        self.levels = [([], [], None, None)]
+
+    def add(self, key, value):
+        keys, values = self.levels[0][:2]
+        keys.append(key)
+        values.append(value)
+        if len(keys) >= 2 * self.size + 2:
+            self._emit(0)
+
+    def get_pending(self):
+        """() -> [BNode]
+        Return the nodes made so far that have no parent yet.
+        """
+        return [node for level in self.levels[1:] for node in level[2]]
+
+    def _take_node(self, height, size):
+        keys, values, nodes, counts = self.levels[height]
+        node = self.node_constructor()
+        node.keys = keys[:size]
+        node.values = values[:size]
+        del keys[:size]
+        del values[:size]
+        count = size
+        if nodes is not None:
+            node.nodes = nodes[:size + 1]
+            node.counts = counts[:size + 1]
+            count += sum(node.counts)
+            del nodes[:size + 1]
+            del counts[:size + 1]
+        node._count = count
+        return node, count
+
+    def _push(self, height, node, count, key, value):
+        if height == len(self.levels):
+            self.levels.append(([], [], [], []))
+        keys, values, nodes, counts = self.levels[height]
+        nodes.append(node)
+        counts.append(count)
+        keys.append(key)
+        values.append(value)
+        if len(keys) >= 2 * self.size + 2:
+            self._emit(height)
+
+    def _emit(self, height, size=None):
+        if size is None:
+            size = self.size
+        node, count = self._take_node(height, size)
+        keys, values = self.levels[height][:2]
+        self._push(height + 1, node, count, keys.pop(0), values.pop(0))
+
+    def finish(self):
+        """() -> BNode
+        Make the nodes from what is left at each level, and return the
+        root.
+        """
+        maximum = 2 * self.node_constructor.minimum_degree - 1
+        height = 0
+        while True:
+            keys = self.levels[height][0]
+            while len(keys) >= 2 * self.size + 2:
+                self._emit(height)
+            if len(keys) > maximum:
+                # Split what is left evenly between two nodes.
+                self._emit(height, (len(keys) - 1) // 2)
+            node, count = self._take_node(height, len(keys))
+            if height + 1 == len(self.levels):
+                return node
+            nodes, counts = self.levels[height + 1][2:]
+            nodes.append(node)
+            counts.append(count)
+            height += 1
+
+
+def _merge_items(old, new):
+    """(old:sequence, new:sequence) -> generator
+    Generate the items of two sequences of items in increasing key order,
+    in increasing key order.  If both have an item with the same key, only
+    the one from new is generated.
+    """
+    old = iter(old)
+    new = iter(new)
+    a = next(old, None)
+    b = next(new, None)
+    while a is not None and b is not None:
+        if b[0] < a[0]:
+            yield b
+            b = next(new, None)
+        elif a[0] < b[0]:
+            yield a
+            a = next(old, None)
+        else:
+            yield b
+            a = next(old, None)
+            b = next(new, None)
+    if a is not None:
+        yield a
+        yield from old
+    if b is not None:
+        yield b
+        yield from new
+
+
+def _split_node(node):
+    """(node:BNode) -> [(key:anything, value:anything, BNode)]
+    Split a node that has too many keys into nodes of allowed sizes.  The
+    node keeps the first part.  Return the items that separate the parts,
+    each with the new node that follows it.
+    """
+    degree = node.minimum_degree
+    total = len(node.keys)
+    if total <= 2 * degree - 1:
+        return []
+    parts = -(-(total + 1) // (2 * degree))
+    size, extra = divmod(total - (parts - 1), parts)
+    keys, values, nodes = node.keys, node.values, node.nodes
+    counts = node.counts
+    start = size + (extra > 0)
+    node.keys = keys[:start]
+    node.values = values[:start]
+    if nodes is not None:
+        node.nodes = nodes[:start + 1]
+        if counts is not None:
+            node.counts = counts[:start + 1]
+    result = []
+    for part in range(1, parts):
+        stop = start + 1 + size + (part < extra)
+        piece = node.__class__()
+        piece.keys = keys[start + 1:stop]
+        piece.values = values[start + 1:stop]
+        if nodes is not None:
+            piece.nodes = nodes[start + 1:stop + 1]
+            if counts is not None:
+                piece.counts = counts[start + 1:stop + 1]
+        piece._update_count()
+        node._count -= piece._count + 1
+        result.append((keys[start], values[start], piece))
+        start = stop
+    assert start == total
+    return result
+
+def _partition(node, keys):
+    """(node:BNode, keys:list) -> ([int], [(int, int, int)])
+    Sort the given keys, in increasing order, by where they belong in
+    node.  Return the positions of the keys of node that are among them,
+    and, for each child that the others belong under, the child's position
+    and the start and stop of its keys.
+    """
+    node_keys = node.keys
+    matched = []
+    batches = []
+    j = 0
+    while j < len(keys):
+        position = bisect_left(node_keys, keys[j])
+        if position == len(node_keys):
+            batches.append((position, j, len(keys)))
+            break
+        if node_keys[position] == keys[j]:
+            matched.append(position)
+            j += 1
+        else:
+            stop = bisect_left(keys, node_keys[position], j + 1)
+            batches.append((position, j, stop))
+            j = stop
+    return matched, batches
+
+def _insert_sorted(node, keys, values):
+    """(node:BNode, keys:list, values:list) -> int
+    Add the items with the given keys, in increasing order, and values
+    under node, and return the number of keys that were not there before.
+    Children that get too many keys are split, but node is left for its
+    parent to split.
+    """
+    if node.nodes is None:
+        node_keys = node.keys
+        node_values = node.values
+        merged_keys = []
+        merged_values = []
+        j = 0
+        for key, value in zip(keys, values):
+            while j < len(node_keys) and node_keys[j] < key:
+                merged_keys.append(node_keys[j])
+                merged_values.append(node_values[j])
+                j += 1
+            if j < len(node_keys) and node_keys[j] == key:
+                j += 1
+            merged_keys.append(key)
+            merged_values.append(value)
+        merged_keys.extend(node_keys[j:])
+        merged_values.extend(node_values[j:])
+        added = len(merged_keys) - len(node_keys)
+        node.keys = merged_keys
+        node.values = merged_values
+        node._count += added
+        return added
+    matched, batches = _partition(node, keys)
+    for position in matched:
+        node.values[position] = values[bisect_left(keys, node.keys[position])]
+    added = 0
+    for position, start, stop in reversed(batches):
+        child = node.nodes[position]
+        added += _insert_sorted(child, keys[start:stop], values[start:stop])
+        extras = _split_node(child)
+        node.keys[position:position] = [extra[0] for extra in extras]
+        node.values[position:position] = [extra[1] for extra in extras]
+        node.nodes[position + 1:position + 1] = [
+            extra[2] for extra in extras]
+        if node.counts is not None:
+            node.counts[position] = child._count
+            node.counts[position + 1:position + 1] = [
+                extra[2]._count for extra in extras]
+    node._count += added
+    node._p_note_change()
+    return added
+
+def _fix_children(node, suspects):
+    """(node:BNode, suspects:set([BNode]))
+    Merge each child of node that is among the suspects and has too few
+    keys with a sibling, until every child has enough keys or node has
+    only one child.  Merged nodes with too many keys are split again.
+    """
+    minimum = node.minimum_degree - 1
+    nodes = node.nodes
+    changed = False
+    position = 0
+    while position < len(nodes) and len(nodes) > 1:
+        child = nodes[position]
+        if child not in suspects or len(child.keys) >= minimum:
+            position += 1
+            continue
+        if position + 1 < len(nodes):
+            left, right = child, nodes[position + 1]
+        else:
+            position -= 1
+            left, right = nodes[position], child
+        left.keys = left.keys + [node.keys[position]] + right.keys
+        left.values = left.values + [node.values[position]] + right.values
+        left._count += right._count + 1
+        del node.keys[position]
+        del node.values[position]
+        del nodes[position + 1]
+        if node.counts is not None:
+            del node.counts[position + 1]
+        changed = True
+        suspects.add(left)
+        if left.nodes is not None:
+            left.nodes = left.nodes + right.nodes
+            left.counts = _join_counts(left, right)
+            _fix_children(left, suspects)
+        extras = _split_node(left)
+        for j, (key, value, piece) in enumerate(extras):
+            node.keys.insert(position + j, key)
+            node.values.insert(position + j, value)
+            nodes.insert(position + j + 1, piece)
+            if node.counts is not None:
+                node.counts.insert(position + j + 1, piece._count)
+        node._update_child_count(position)
+        if extras:
+            position += len(extras) + 1
+    if changed:
+        node._p_note_change()
+
+def _pop_max(node, suspects):
+    """(node:BNode, suspects:set([BNode])) -> (key, value) | None
+    Remove and return the last item under node, or None if there is none.
+    The nodes changed are added to suspects.
+    """
+    suspects.add(node)
+    if node.nodes is None:
+        if not node.keys:
+            return None
+        node._count -= 1
+        node._p_note_change()
+        return node.keys.pop(), node.values.pop()
+    item = _pop_max(node.nodes[-1], suspects)
+    if item is not None:
+        node._count -= 1
+        node._update_child_count(-1)
+        _fix_children(node, suspects)
+    return item
+
+def _delete_sorted(node, keys, suspects):
+    """(node:BNode, keys:list, suspects:set([BNode])) -> int
+    Remove the items with the given keys, in increasing order, from under
+    node, and return the number removed.  The nodes changed are added to
+    suspects.  Children left with too few keys are merged, but node may be
+    left with too few keys, or with no keys and a single child, for its
+    parent to fix.
+    """
+    suspects.add(node)
+    if node.nodes is None:
+        node_keys = node.keys
+        node_values = node.values
+        kept_keys = []
+        kept_values = []
+        j = 0
+        for key in keys:
+            while j < len(node_keys) and node_keys[j] < key:
+                kept_keys.append(node_keys[j])
+                kept_values.append(node_values[j])
+                j += 1
+            if j < len(node_keys) and node_keys[j] == key:
+                j += 1
+        kept_keys.extend(node_keys[j:])
+        kept_values.extend(node_values[j:])
+        removed = len(node_keys) - len(kept_keys)
+        if removed:
+            node.keys = kept_keys
+            node.values = kept_values
+            node._count -= removed
+        return removed
+    matched, batches = _partition(node, keys)
+    removed = 0
+    for position, start, stop in batches:
+        removed += _delete_sorted(node.nodes[position], keys[start:stop],
+                                  suspects)
+        node._update_child_count(position)
+    for position in reversed(matched):
+        # Replace the key with the one before it.
+        item = _pop_max(node.nodes[position], suspects)
+        if item is None:
+            # Nothing is left under the child before the key.
+            del node.keys[position]
+            del node.values[position]
+            del node.nodes[position]
+            if node.counts is not None:
+                del node.counts[position]
+        else:
+            node.keys[position], node.values[position] = item
+            node._update_child_count(position)
+        removed += 1
+    if removed:
+        node._count -= removed
+        node._p_note_change()
+        _fix_children(node, suspects)
+    return removed
+
+def _sorted_unique(items):
+    """(items:[(key, value)]) -> ([key], [value])
+    Return the keys of the items in increasing order, without repeats, and
+    their values.  The last value given for a key is the one kept.
+    """
+    keys = []
+    values = []
+    for key, value in sorted(items, key=lambda item: item[0]):
+        if keys and keys[-1] == key:
+            values[-1] = value
+        else:
+            keys.append(key)
+            values.append(value)
+    return keys, values
+
 
 class BTree(PersistentObject, collections.abc.MutableMapping):
     """
     Instance attributes:
       root: BNode
+      _loading: [BNode] | None
+        While load_sorted() commits in chunks, the nodes built so far
+        that have no parent yet.
     """
 
     root_is = BNode
 
+    _loading = None
+
     def __init__(self, node_constructor=BNode16):
         assert issubclass(node_constructor, BNode)
         self.root = node_constructor()
 
+    @classmethod
+    def from_sorted(klass, items, node_constructor=BNode16,
+                    fill=DEFAULT_FILL):
+        """(items:sequence((key, value)), node_constructor:class=BNode16,
+            fill:float=DEFAULT_FILL) -> BTree
+        Return a new BTree holding the given items, which must be in
+        strictly increasing key order.  See load_sorted().
+        """
+        tree = klass(node_constructor)
+        tree.load_sorted(items, fill=fill)
+        return tree
+
+    def load_sorted(self, items, fill=DEFAULT_FILL, commit_every=None,
+                    node_constructor=None):
+        """(items:sequence((key, value)), fill:float=DEFAULT_FILL,
+            commit_every:int=None, node_constructor:class=None)
+        Replace the contents of this tree with the given items, which must
+        be in strictly increasing key order.  The nodes are built bottom-up
+        in one pass, each node is made once, and most nodes get fill times
+        the maximum number of keys.  The nodes are of the class of the
+        current root, unless node_constructor is given.
+        If commit_every is given, this tree must be stored, and its
+        connection commits after every commit_every items, so that the
+        finished nodes need not stay in memory.  The tree keeps its old
+        contents until the load is done.  The last commit is left to the
+        caller.
+        """
+        connection = self._p_connection
+        if commit_every and connection is None:
+            raise ValueError("commit_every requires a stored BTree")
+        builder = _SortedBuilder(node_constructor or self.root.__class__,
+                                 fill)
+        try:
+            for count, (key, value) in enumerate(items, 1):
+                if count > 1 and not previous < key:
+                    raise ValueError(
+                        "keys are not in increasing order: %r, %r" % (
+                        previous, key))
+                previous = key
+                builder.add(key, value)
+                if commit_every and count % commit_every == 0:
+                    self._loading = builder.get_pending()
+                    connection.commit()
+            root = builder.finish()
+        finally:
+            if self._loading is not None:
+                del self._loading
+        self.root = root
+
+    def merge_sorted(self, items, fill=DEFAULT_FILL, commit_every=None):
+        """(items:sequence((key, value)), fill:float=DEFAULT_FILL,
+            commit_every:int=None)
+        Add the given items, which must be in strictly increasing key
+        order, to this tree.  Given values replace those of keys already
+        present.  The tree is rebuilt, as by load_sorted(), from one pass
+        over its items merged with the given ones.
+        """
+        self.load_sorted(_merge_items(self.iteritems(), items), fill=fill,
+                         commit_every=commit_every)
+
     def __nonzero__(self):
-        return bool(self.root.items)
+        return bool(self.root.keys)
 
     __bool__ = __nonzero__
 
     def iteritems(self):
-        for item in self.root:
-            yield item
+        return _gen_items(self.root)
 
     def iterkeys(self):
-        for item in self.root:
+        for item in _gen_items(self.root):
             yield item[0]
 
     def itervalues(self):
-        for item in self.root:
+        for item in _gen_items(self.root):
             yield item[1]
 
     def items(self):
@@ -415,6 +1095,26 @@ class BTree(PersistentObject, collections.abc.MutableMapping):
         for key in self.iterkeys():
             yield key
 
+    def _p_prefetch_refs(self):
+        """() -> [object]
+        Return the keys and values, for prefetch_contents() to load.  The
+        nodes are prefetched here a level at a time, so that takes a round
+        trip for each level.
+        """
+        connection = self._p_connection
+        contents = []
+        nodes = [self.root]
+        while nodes:
+            connection.prefetch(nodes)
+            children = []
+            for node in nodes:
+                contents.extend(node.keys)
+                contents.extend(node.values)
+                if not node.is_leaf():
+                    children.extend(node.nodes)
+            nodes = children
+        return contents
+
     def __reversed__(self):
         for item in reversed(self.root):
             yield item[0]
@@ -452,6 +1152,45 @@ class BTree(PersistentObject, collections.abc.MutableMapping):
         for key, value in kwargs.items():
             self[key] = value
 
+    def insert_many(self, items):
+        """(items:sequence((key:anything, value:anything)))
+        Make self[key] == value for each of the items, which need not be
+        sorted.  If a key is given more than once, the last value wins.
+        The items are sorted and added in one pass down the tree, so each
+        node is changed at most once.
+        """
+        keys, values = _sorted_unique(items)
+        if not keys:
+            return
+        _insert_sorted(self.root, keys, values)
+        extras = _split_node(self.root)
+        while extras:
+            root = self.root.__class__()
+            root.keys = [extra[0] for extra in extras]
+            root.values = [extra[1] for extra in extras]
+            root.nodes = [self.root] + [extra[2] for extra in extras]
+            if self.root.is_leaf() or self.root.counts is not None:
+                root.counts = [node._count for node in root.nodes]
+            root._count = len(extras) + self.root._count
+            for extra in extras:
+                root._count += extra[2]._count
+            self.root = root
+            extras = _split_node(root)
+
+    def delete_many(self, keys):
+        """(keys:sequence(anything)) -> int
+        Remove the items with the given keys, which need not be sorted.
+        Keys that are not present are ignored.  The keys are sorted and
+        removed in one pass down the tree, merging nodes left with too few
+        keys, so each node is changed at most once.  Return the number of
+        items removed.
+        """
+        keys = _sorted_unique((key, None) for key in keys)[0]
+        removed = _delete_sorted(self.root, keys, set())
+        while not self.root.keys and not self.root.is_leaf():
+            self.root = self.root.nodes[0]
+        return removed
+
     def __getitem__(self, key):
         item = self.root.search(key)
         if item is None:
@@ -481,6 +1220,8 @@ class BTree(PersistentObject, collections.abc.MutableMapping):
             node = self.root.__class__()
             node.nodes = [self.root]
             node._count = self.root._count
+            if self.root.is_leaf() or self.root.counts is not None:
+                node.counts = [self.root._count]
             node.split_child(0, node.nodes[0])
             self.root = node
         self.root.insert_item((key, value))
@@ -507,6 +1248,95 @@ class BTree(PersistentObject, collections.abc.MutableMapping):
         # If we have an up-to-date _count, fast O(1) version.
         return self.root._count
 
+    def index_of(self, key):
+        """(key:anything) -> int
+        Return the position of the item with the given key, counting from
+        0 in key order.  Raise KeyError if there is no such item.
+        """
+        node = self.root
+        index = 0
+        while True:
+            keys = node.keys
+            position = bisect_left(keys, key)
+            index += position
+            found = position < len(keys) and keys[position] == key
+            if node.nodes is not None:
+                # The child at position comes before a key found here.
+                index += sum(_get_child_counts(node, position + found))
+            if found:
+                return index
+            if node.nodes is None:
+                raise KeyError(key)
+            node = node.nodes[position]
+
+    def item_at(self, index):
+        """(index:int) -> (key:anything, value:anything)
+        Return the item at the given position in key order.  A negative
+        index counts from the end.
+        """
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('BTree index out of range')
+        node = self.root
+        while node.nodes is not None:
+            for position, count in enumerate(_get_child_counts(node)):
+                if index < count:
+                    node = node.nodes[position]
+                    break
+                index -= count
+                if index == 0:
+                    return node.keys[position], node.values[position]
+                index -= 1
+        return node.keys[index], node.values[index]
+
+    def items_between_positions(self, start, stop):
+        """(start:int, stop:int) -> generator
+        Generate the items whose positions in key order are at least start
+        and less than stop, like the slice [start:stop] of self.items().
+        """
+        start, stop, step = slice(start, stop).indices(len(self))
+        if start < stop:
+            key = self.item_at(start)[0]
+            yield from _gen_items(self.root, key, limit=stop - start)
+
+    def fill_counts(self, commit_every=None):
+        """(commit_every:int=None) -> int
+        Set the _count and counts of the nodes stored before BNode kept
+        them, so that len() and the positional methods need not count items
+        or load siblings.  The nodes are updated from the leaves up, so a
+        node with both never has a child without them.  If commit_every is
+        given, the connection commits after every commit_every updated
+        nodes, so that this can run on a tree in use; if a commit fails,
+        calling this again goes on from the last commit.  Return the number
+        of nodes updated.
+        """
+        def lacks_counts(node):
+            return isinstance(node._count, _NullCount) or (
+                node.nodes is not None and node.counts is None)
+        connection = self._p_connection
+        if commit_every and connection is None:
+            raise ValueError("commit_every requires a stored BTree")
+        if not lacks_counts(self.root):
+            return 0
+        updated = 0
+        stack = [(self.root, iter(self.root.nodes or []))]
+        while stack:
+            node, children = stack[-1]
+            for child in children:
+                if lacks_counts(child):
+                    stack.append((child, iter(child.nodes or [])))
+                    break
+            else:
+                stack.pop()
+                if node.nodes is not None:
+                    node.counts = [child._count for child in node.nodes]
+                node._update_count()
+                updated += 1
+                if commit_every and updated % commit_every == 0:
+                    connection.commit()
+        return updated
+
     def items_backward(self):
         """() -> generator
         Generate all items in reverse order.
@@ -514,51 +1344,81 @@ class BTree(PersistentObject, collections.abc.MutableMapping):
         for item in reversed(self.root):
             yield item
 
-    def items_from(self, key, closed=True):
-        """(key, closed=True) -> generator
+    def items_from(self, key, closed=True, limit=None):
+        """(key, closed=True, limit=None) -> generator
         If closed is true, generate all items with keys greater than or equal to
         the given key.
         If closed is false, generate all items with keys greater than the
         given key.
+        If limit is given, generate at most that many items.
         """
-        for item in self.root.iter_from(key):
-            if closed or item[0] != key:
-                yield item
+        return self._items_forward(key, _UNBOUNDED, closed, True, limit)
 
-    def items_backward_from(self, key, closed=False):
-        """(key, closed=False) -> generator
+    def items_backward_from(self, key, closed=False, limit=None):
+        """(key, closed=False, limit=None) -> generator
         If closed is true, generate in reverse order all items with keys
         less than or equal to the given key.
         If closed is false, generate in reverse order all items with keys
         less than the given key.
+        If limit is given, generate at most that many items.
         """
+        if limit is not None and limit <= 0:
+            return
+        count = 0
         if closed:
             item = self.root.search(key)
             if item is not None:
                 yield item
+                count += 1
         for item in self.root.iter_backward_from(key):
+            if count == limit:
+                break
             yield item
+            count += 1
 
-    def items_range(self, start, end, closed_start=True, closed_end=False):
-        """(start, end, closed_start=True, closed_end=False) -> generator
+    def items_range(self, start, end, closed_start=True, closed_end=False,
+                    limit=None):
+        """(start, end, closed_start=True, closed_end=False, limit=None)
+            -> generator
         Generate items with keys in the given range, from the start to the end.
         If closed_start is true, include the item with the start key,
         if it is present.
         If closed_end is true, include the item with the end key,
         if it is present.
+        If limit is given, generate at most that many items.
+        Going forward, the nodes that the range needs are loaded ahead of
+        use, in batches.
         """
         if start <= end:
-            for item in self.items_from(start, closed=closed_start):
-                if item[0] > end:
-                    break
-                if closed_end or item[0] < end:
-                    yield item
-        else:
-            for item in self.items_backward_from(start, closed=closed_start):
-                if item[0] < end:
+            return self._items_forward(start, end, closed_start, closed_end,
+                                       limit)
+        return self._items_backward(start, end, closed_start, closed_end,
+                                    limit)
+
+    def _items_forward(self, start, end, closed_start, closed_end, limit):
+        bound = limit
+        if limit is not None and not closed_start:
+            # Room for the start item, which is skipped.
+            bound += 1
+        count = 0
+        for item in _gen_items(self.root, start, end, bound):
+            if not closed_start and item[0] == start:
+                continue
+            if end is not _UNBOUNDED:
+                if item[0] > end or (item[0] == end and not closed_end):
                     break
-                if closed_end or item[0] > end:
-                    yield item
+            if count == limit:
+                break
+            yield item
+            count += 1
+
+    def _items_backward(self, start, end, closed_start, closed_end, limit):
+        for item in self.items_backward_from(start, closed=closed_start,
+                                             limit=limit):
+            if item[0] < end:
+                break
+            if closed_end or item[0] > end:
+                yield item
 
     def note_change_of_bnode_containing_key(self, key):
         """()
@@ -9,32 +9,120 @@ from durus.storage import Storage
 from durus.storage_server import DEFAULT_PORT, DEFAULT_HOST
 from durus.storage_server import SocketAddress, StorageServer
 from durus.storage_server import STATUS_OKAY, STATUS_KEYERROR, STATUS_INVALID
+from durus.storage_server import PROTOCOL_2
 from durus.utils import int4_to_str, read, write, join_bytes, write_all
 from durus.utils import read_int4, write_int4, write_int4_str, iteritems
 from durus.utils import as_bytes
+from collections import deque, OrderedDict
 
 
 class ClientStorage (Storage):
+    """
+    Instance attributes:
+      protocol : str
+        The protocol version agreed with the server.
+      pending : deque([(request_id:str, [oid:str])])
+        Prefetch requests sent to the server whose responses have not been
+        read yet, oldest first.
+      pending_oids : set([oid:str])
+        The oids in pending.
+      prefetched : OrderedDict({oid:str : (status:str, record:str|None)})
+        Load responses that have been read but not yet used, oldest first.
+    """
+
+    # The most prefetch requests left unread at once.  The server writes
+    # the responses with blocking writes, so a client must not let them
+    # pile up.
+    max_pending = 8
+
+    # The most unused load responses kept before a new prefetch request or
+    # a sync().  The oldest are dropped first.  A prefetch that stops early
+    # leaves the rest of its responses unused.
+    max_prefetched = 10000
 
     def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, address=None):
         self.address = SocketAddress.new(address or (host, port))
-        self.s = self.address.get_connected_socket()
-        assert self.s, "Could not connect to %s" % self.address
         self.oid_pool = []
         self.oid_pool_size = 32
+        self.pending = deque()
+        self.pending_oids = set()
+        self.prefetched = OrderedDict()
+        self.request_count = 0
         self.begin()
-        protocol = StorageServer.protocol
+        self.protocol = self._connect(StorageServer.protocol)
+        if self.protocol not in StorageServer.supported_protocols:
+            raise ProtocolError("Protocol version mismatch.")
+        if self.protocol != StorageServer.protocol:
+            # An older server answers with the protocol it speaks, and then
+            # drops the connection, so connect again using that one.
+            self.s.close()
+            if self._connect(self.protocol) != self.protocol:
+                raise ProtocolError("Protocol version mismatch.")
+
+    def _connect(self, protocol):
+        self.s = self.address.get_connected_socket()
+        assert self.s, "Could not connect to %s" % self.address
         assert len(protocol) == 4
         write_all(self.s, 'V', protocol)
-        server_protocol = read(self.s, 4)
-        if server_protocol != protocol:
-            raise ProtocolError("Protocol version mismatch.")
+        return read(self.s, 4)
 
     def __str__(self):
         return "ClientStorage(%s)" % self.address
 
+    def prefetch(self, oids):
+        """(oids:sequence(oid:str))
+        Ask the server for the records of these oids without waiting for the
+        answer.  The records are read when load() asks for one of them, or
+        when another request needs the connection.
+        This does nothing if the server does not speak protocol 2.
+        """
+        if self.protocol < PROTOCOL_2:
+            return
+        oids = [oid for oid in oids
+                if oid not in self.prefetched and oid not in self.pending_oids]
+        if not oids:
+            return
+        while len(self.pending) >= self.max_pending:
+            self._receive_prefetched()
+        self._trim_prefetched()
+        self.request_count += 1
+        request_id = int4_to_str(self.request_count % 2**32)
+        write_all(self.s, 'F', request_id, int4_to_str(len(oids)),
+                  join_bytes(oids))
+        self.pending.append((request_id, oids))
+        self.pending_oids.update(oids)
+
+    def _receive_prefetched(self):
+        """
+        Read the responses to the oldest pending prefetch request.
+        """
+        request_id, oids = self.pending.popleft()
+        if read(self.s, 4) != request_id:
+            raise ProtocolError('unexpected response to request %r' % (
+                request_id,))
+        for oid in oids:
+            self.prefetched[oid] = self._read_load_response()
+            self.pending_oids.discard(oid)
+
+    def _drain(self):
+        """
+        Read all pending prefetch responses so that the connection is ready
+        for a new request/response exchange.
+        """
+        while self.pending:
+            self._receive_prefetched()
+
+    def _forget_prefetched(self, oids):
+        for oid in oids:
+            self.prefetched.pop(oid, None)
+
+    def _trim_prefetched(self):
+        while len(self.prefetched) > self.max_prefetched:
+            self.prefetched.popitem(last=False)
+
     def new_oid(self):
         if not self.oid_pool:
+            self._drain()
             batch = self.oid_pool_size
             write(self.s, 'M%s' % chr(batch))
             self.oid_pool = split_oids(read(self.s, 8 * batch))
@@ -46,11 +134,17 @@ class ClientStorage (Storage):
         return oid
 
     def load(self, oid):
+        while oid in self.pending_oids:
+            self._receive_prefetched()
+        if oid in self.prefetched:
+            status, record = self.prefetched.pop(oid)
+            self._check_status(status, oid)
+            return record
+        self._drain()
         write_all(self.s, 'L', oid)
         return self._get_load_response(oid)
 
-    def _get_load_response(self, oid):
-        status = read(self.s, 1)
+    def _check_status(self, status, oid):
         if status == STATUS_OKAY:
             pass
         elif status == STATUS_INVALID:
@@ -59,8 +153,20 @@ class ClientStorage (Storage):
             raise DurusKeyError(oid)
         else:
             raise ProtocolError('status=%r, oid=%r' % (status, oid))
-        n = read_int4(self.s)
-        record = read(self.s, n)
+
+    def _read_load_response(self):
+        """() -> (status:str, record:str|None)
+        Read one load response.  Only an okay status is followed by a
+        record.
+        """
+        status = read(self.s, 1)
+        if status == STATUS_OKAY:
+            return status, read(self.s, read_int4(self.s))
+        return status, None
+
+    def _get_load_response(self, oid):
+        status, record = self._read_load_response()
+        self._check_status(status, oid)
         return record
 
     def begin(self):
@@ -73,12 +179,16 @@ class ClientStorage (Storage):
         self.records[oid] = record
 
     def end(self, handle_invalidations=None):
+        self._drain()
+        # Prefetched records of objects committed here are now obsolete.
+        self._forget_prefetched(self.records)
         write(self.s, 'C')
         n = read_int4(self.s)
         oid_list = []
         if n != 0:
             packed_oids = read(self.s, n*8)
             oid_list = split_oids(packed_oids)
+            self._forget_prefetched(oid_list)
             try:
                 handle_invalidations(oid_list)
             except ConflictError:
@@ -106,29 +216,45 @@ class ClientStorage (Storage):
                 raise ProtocolError('server returned invalid status %r' % status)
 
     def sync(self):
+        self._drain()
         write(self.s, 'S')
         n = read_int4(self.s)
         if n == 0:
             packed_oids = ''
         else:
             packed_oids = read(self.s, n*8)
-        return split_oids(packed_oids)
+        oid_list = split_oids(packed_oids)
+        self._forget_prefetched(oid_list)
+        self._trim_prefetched()
+        return oid_list
 
     def pack(self):
+        self._drain()
         write(self.s, 'P')
         status = read(self.s, 1)
         if status != STATUS_OKAY:
             raise ProtocolError('server returned invalid status %r' % status)
 
     def bulk_load(self, oids):
+        oids = list(oids)
+        if self.protocol >= PROTOCOL_2:
+            self.prefetch(oids)
+            for oid in oids:
+                yield self.load(oid)
+            return
+        self._drain()
         oid_str = join_bytes(oids)
         num_oids, remainder = divmod(len(oid_str), 8)
         assert remainder == 0, remainder
         write_all(self.s, 'B', int4_to_str(num_oids), oid_str)
-        records = [self._get_load_response(oid) for oid in oids]
-        for record in records:
+        # Read every response before raising for any of them, so that the
+        # connection stays ready for the next request.
+        responses = [self._read_load_response() for oid in oids]
+        for oid, (status, record) in zip(oids, responses):
+            self._check_status(status, oid)
             yield record
 
     def close(self):
+        self._drain()
         write(self.s, '.') # Closes the server side.
         self.s.close()
@@ -0,0 +1,217 @@
+"""
+$URL$
+$Id$
+
+Compression codecs for state pickles.
+
+A state pickle is stored as is, compressed by zlib (as Durus always has
+done), or compressed by a codec that puts a one byte tag in front of its
+output.  Uncompressed state pickles start with the pickle protocol opcode
+and zlib streams start with 'x', so the tags used here, which are small
+control characters, can not be confused with either.
+"""
+from durus.error import DurusError
+from durus.utils import int4_to_str, str_to_int4, dumps, as_bytes
+from zlib import compress, decompress, crc32, error as zlib_error
+import threading
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ZLIB_TAG = compress(dumps({}, 2))[:1]
+LZ4_TAG = as_bytes('\x01')
+ZSTD_TAG = as_bytes('\x02')
+ZSTD_DICT_TAG = as_bytes('\x03')
+# Not a codec: serialize uses this for states with out-of-band buffers.
+BUFFERS_TAG = as_bytes('\x04')
+
+# The names of the codecs that own the tags, available or not.
+TAG_NAMES = {ZLIB_TAG: 'zlib', LZ4_TAG: 'lz4', ZSTD_TAG: 'zstd',
+             ZSTD_DICT_TAG: 'zstd'}
+
+DEFAULT_DICTIONARY_SIZE = 16384
+
+
+class Codec (object):
+    """
+    A Codec compresses state pickles.  The output of compress() starts
+    with one of the codec's tags.
+    """
+    name = None
+    tags = ()
+
+    def compress(self, data, klass):
+        """(data:str, klass:type) -> str
+        Return the compressed state pickle of an instance of klass.
+        """
+        raise NotImplementedError
+
+    def decompress(self, data):
+        """(data:str) -> str | None
+        Return the state pickle, or None if data turns out not to be
+        compressed after all.
+        """
+        raise NotImplementedError
+
+
+class ZlibCodec (Codec):
+
+    name = 'zlib'
+    tags = (ZLIB_TAG,)
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, data, klass):
+        return compress(data, self.level)
+
+    def decompress(self, data):
+        try:
+            return decompress(data)
+        except zlib_error:
+            return None # let the unpickler try anyway.
+
+
+class LZ4Codec (Codec):
+    """
+    LZ4 block compression.  It compresses less than zlib, but is much
+    faster, particularly when decompressing.
+    """
+    name = 'lz4'
+    tags = (LZ4_TAG,)
+
+    def compress(self, data, klass):
+        return LZ4_TAG + lz4.block.compress(data, store_size=True)
+
+    def decompress(self, data):
+        return lz4.block.decompress(data[1:])
+
+
+class ZstdCodec (Codec):
+    """
+    Zstandard compression, optionally with a dictionary chosen by the
+    class of the object.  Small records compress much better with a
+    dictionary trained on records of the same class.  Records written
+    with a dictionary hold its int4 id after the tag, and the same
+    dictionary must be added to the codec of every process that reads
+    them.
+    """
+    name = 'zstd'
+    tags = (ZSTD_TAG, ZSTD_DICT_TAG)
+
+    def __init__(self, level=3):
+        self.level = level
+        self.dictionaries = {} # dictionary id -> ZstdCompressionDict
+        self.class_dictionary = {} # class -> dictionary id
+        # Zstandard compressors and decompressors are not thread-safe.
+        self.local = threading.local()
+
+    def add_dictionary(self, data, classes=()):
+        """(data:str, classes:[type]) -> int
+        Make the dictionary available for reading, and use it when writing
+        instances of the given classes.  Return the dictionary's id.
+        """
+        dictionary_id = crc32(data) & 0xffffffff
+        self.dictionaries[dictionary_id] = zstandard.ZstdCompressionDict(data)
+        for klass in classes:
+            self.class_dictionary[klass] = dictionary_id
+        return dictionary_id
+
+    def _get_compressor(self, dictionary_id):
+        compressors = self.local.__dict__.setdefault('compressors', {})
+        compressor = compressors.get(dictionary_id)
+        if compressor is None:
+            if dictionary_id is None:
+                compressor = zstandard.ZstdCompressor(level=self.level)
+            else:
+                compressor = zstandard.ZstdCompressor(
+                    level=self.level,
+                    dict_data=self.dictionaries[dictionary_id],
+                    write_dict_id=False)
+            compressors[dictionary_id] = compressor
+        return compressor
+
+    def _get_decompressor(self, dictionary_id):
+        decompressors = self.local.__dict__.setdefault('decompressors', {})
+        decompressor = decompressors.get(dictionary_id)
+        if decompressor is None:
+            if dictionary_id is None:
+                decompressor = zstandard.ZstdDecompressor()
+            else:
+                dictionary = self.dictionaries.get(dictionary_id)
+                if dictionary is None:
+                    raise DurusError(
+                        'zstd dictionary %s is not available' % dictionary_id)
+                decompressor = zstandard.ZstdDecompressor(
+                    dict_data=dictionary)
+            decompressors[dictionary_id] = decompressor
+        return decompressor
+
+    def compress(self, data, klass):
+        dictionary_id = self.class_dictionary.get(klass)
+        compressed = self._get_compressor(dictionary_id).compress(data)
+        if dictionary_id is None:
+            return ZSTD_TAG + compressed
+        else:
+            return ZSTD_DICT_TAG + int4_to_str(dictionary_id) + compressed
+
+    def decompress(self, data):
+        if data[:1] == ZSTD_TAG:
+            return self._get_decompressor(None).decompress(data[1:])
+        else:
+            dictionary_id = str_to_int4(data[1:5])
+            return self._get_decompressor(dictionary_id).decompress(data[5:])
+
+
+def train_dictionary(samples, size=DEFAULT_DICTIONARY_SIZE):
+    """([str], int) -> str
+    Return a zstd dictionary trained on the given state pickles,
+    for use with ZstdCodec.add_dictionary().
+    """
+    return zstandard.train_dictionary(size, samples).as_bytes()
+
+
+_codecs = {}
+_codecs_by_tag = {}
+
+def register_codec(codec):
+    """(codec:Codec)
+    Make the codec available by name for writing, and by tag for reading.
+    This replaces any codec registered with the same name or tags.
+    """
+    _codecs[codec.name] = codec
+    for tag in codec.tags:
+        _codecs_by_tag[tag] = codec
+
+def get_codec(name):
+    """(name:str) -> Codec
+    """
+    try:
+        return _codecs[name]
+    except KeyError:
+        raise ValueError('Unknown or unavailable codec %r' % name)
+
+def decompress_state(data, start=0):
+    """(data:str, start:int) -> str | None
+    Return the state pickle that was compressed to make data[start:], or
+    None if it is not compressed.
+    """
+    tag = data[start:start + 1]
+    codec = _codecs_by_tag.get(tag)
+    if codec is None:
+        if tag in TAG_NAMES:
+            raise DurusError(
+                'State compressed by unavailable codec %r' % TAG_NAMES[tag])
+        return None
+    return codec.decompress(data[start:])
+
+register_codec(ZlibCodec())
+if lz4 is not None:
+    register_codec(LZ4Codec())
+if zstandard is not None:
+    register_codec(ZstdCodec())
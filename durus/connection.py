@@ -5,14 +5,15 @@ $Id$
 from durus.error import ConflictError, WriteConflictError, ReadConflictError
 from durus.error import DurusKeyError
 from durus.logger import log
-from durus.persistent import ConnectionBase
+from durus.persistent import ConnectionBase, PersistentBase
 from durus.persistent_dict import PersistentDict
-from durus.serialize import ObjectReader, ObjectWriter
+from durus.serialize import ObjectReader, ObjectWriter, CompressionStats
 from durus.serialize import unpack_record, pack_record, persistent_load
 from durus.utils import int8_to_str, iteritems, loads, byte_string, as_bytes
-from heapq import heappush, heappop
-from itertools import islice, chain
+from durus.utils import next
+from collections import OrderedDict
 from os import getpid
+from threading import Lock
 from time import time
 from weakref import ref, KeyedRef
 import durus.storage
@@ -38,11 +39,23 @@ class Connection (ConnectionBase):
         Number of calls to commit() or abort() since this instance was created.
         This is used to maintain consistency, and to implement LRU replacement
         in the cache.
+      record_cache: RecordCache | None
+        State pickles shared with other connections, if any.
+      record_cache_view: int
+        The serial of the record_cache before the last sync of the storage.
+        Pickles loaded by other connections after that are not used.
+      record_cache_tag: int
+        The serial of the record_cache after the last sync of the storage.
+        The pickles that this connection loads are kept with this tag.
+      predictor: AccessPredictor | None
+        Chooses the states to prefetch when a ghost is loaded, if any.
     """
 
-    def __init__(self, storage, cache_size=100000, root_class=None):
+    def __init__(self, storage, cache_size=100000, root_class=None,
+                 record_cache=None, predictor=None):
         """(storage:Storage|str, cache_size:int=100000, 
-            root_class:class|None=None)
+            root_class:class|None=None, record_cache:RecordCache|None=None,
+            predictor:AccessPredictor|None=None)
         Make a connection to `storage`.
         Set the target number of non-ghosted persistent objects to keep in
         the cache at `cache_size`.
@@ -51,6 +64,10 @@ class Connection (ConnectionBase):
         calling the constructor with no arguments.
         Also, if the root_class is not None, verify that this really is the 
         class of the root object.  
+        If record_cache is given, state pickles are looked up there before
+        they are loaded from the storage.
+        If predictor is given, loading a ghost also loads the states that
+        were loaded after it before, in the same call to bulk_load().
         """
         if isinstance(storage, str):
             from durus.file_storage import FileStorage
@@ -58,10 +75,15 @@ class Connection (ConnectionBase):
         assert isinstance(storage, durus.storage.Storage)
         self.storage = storage
         self.reader = ObjectReader(self)
+        self.compression_stats = CompressionStats()
         self.changed = {}
         self.invalid_oids = set()
         self.new_oid = storage.new_oid # needed by serialize
         self.cache = Cache(cache_size)
+        self.record_cache = record_cache
+        if record_cache is not None:
+            self._sync_storage()
+        self.predictor = predictor
         self.root = self.get(ROOT_OID)
         if self.root is None:
             new_oid = self.new_oid()
@@ -114,14 +136,24 @@ class Connection (ConnectionBase):
         the oid is invalid.
         """
         assert oid not in self.invalid_oids, "still conflicted: missing abort()"
+        record_cache = self.record_cache
+        if record_cache is not None:
+            data = record_cache.get(
+                oid, self.record_cache_view, self.record_cache_tag)
+            if data is not None:
+                return data
+            record_cache_serial = record_cache.get_serial()
         try:
             record = self.storage.load(oid)
         except ReadConflictError:
-            invalid_oids = self.storage.sync()
+            invalid_oids = self._sync_storage()
             self._handle_invalidations(invalid_oids, read_oid=oid)
             record = self.storage.load(oid)
         oid2, data, refdata = unpack_record(record)
         assert as_bytes(oid) == oid2, (oid, oid2)
+        if record_cache is not None:
+            record_cache.put(
+                oid, data, record_cache_serial, self.record_cache_tag)
         return data
 
     def get(self, oid):
@@ -139,14 +171,76 @@ class Connection (ConnectionBase):
             data = self.get_stored_pickle(oid)
         except KeyError:
             return None
-        klass = loads(data)
-        obj = self.cache.get_instance(oid, klass, self)
+        return self._set_state(oid, None, data)
+
+    __getitem__ = get
+
+    def _set_state(self, oid, obj, data):
+        """(oid:str, obj:PersistentObject | None, data:str) -> PersistentObject
+        Set the state of the ghost obj from the data, making obj first if
+        it is None.
+        """
+        if obj is None:
+            klass = loads(data)
+            obj = self.cache.get_instance(oid, klass, self)
         state = self.reader.get_state(data, load=True)
         obj.__setstate__(state)
         obj._p_set_status_saved()
+        # Let shrink() find it, even if it is never accessed.
+        self.cache.recent_objects.add(obj)
         return obj
 
-    __getitem__ = get
+    def prefetch(self, objects):
+        """(objects:sequence(PersistentObject | oid:str | oid:int))
+        Load the states of the ghosts among the given objects, and of the
+        objects with the given oids, using one call to the storage's
+        bulk_load() method.  With a ClientStorage, that takes one round
+        trip to the server.  This is only an optimization: states that can
+        not be loaded here are left to be loaded on access, where the
+        usual exceptions are raised.
+        """
+        ghosts = {}
+        for x in objects:
+            if isinstance(x, PersistentBase):
+                if x._p_is_ghost() and x._p_connection is self:
+                    ghosts[x._p_oid] = x
+            else:
+                if not isinstance(x, byte_string):
+                    x = int8_to_str(x)
+                obj = self.cache.get(x)
+                if obj is None or obj._p_is_ghost():
+                    ghosts[x] = obj
+        record_cache = self.record_cache
+        if record_cache is not None:
+            for oid in list(ghosts):
+                data = record_cache.get(
+                    oid, self.record_cache_view, self.record_cache_tag)
+                if data is not None:
+                    self._set_state(oid, ghosts.pop(oid), data)
+            record_cache_serial = record_cache.get_serial()
+        oids = [oid for oid in ghosts if oid not in self.invalid_oids]
+        if not oids:
+            return
+        records = self.storage.bulk_load(oids)
+        try:
+            for record in records:
+                oid, data, refdata = unpack_record(record)
+                if record_cache is not None:
+                    record_cache.put(oid, data, record_cache_serial,
+                                     self.record_cache_tag)
+                obj = ghosts[oid]
+                if obj is None:
+                    obj = self.cache.get(oid)
+                if obj is None or obj._p_is_ghost():
+                    self._set_state(oid, obj, data)
+        except (ReadConflictError, KeyError):
+            pass
+        finally:
+            # Let a generator that stopped early finish its exchange with
+            # the storage now, not whenever it is collected.
+            close = getattr(records, 'close', None)
+            if close is not None:
+                close()
 
     def get_crawler(self, start_oid=ROOT_OID, batch_size=100):
         """(start_oid:str = ROOT_OID, batch_size:int = 100) ->
@@ -167,13 +261,7 @@ class Connection (ConnectionBase):
                 yield obj
             else:
                 record_oid, data, refdata = unpack_record(record)
-                if obj is None:
-                    klass = loads(data)
-                    obj = self.cache.get_instance(oid, klass, self)
-                state = self.reader.get_state(data, load=True)
-                obj.__setstate__(state)
-                obj._p_set_status_saved()
-                yield obj
+                yield self._set_state(oid, obj, data)
 
     def get_cache(self):
         return self.cache
@@ -185,6 +273,12 @@ class Connection (ConnectionBase):
         assert self.storage is not None, 'connection is closed'
         assert obj._p_is_ghost()
         oid = obj._p_oid
+        if self.predictor is not None:
+            followers = self.predictor.note_load(oid)
+            if followers:
+                self._prefetch_followers(obj, followers)
+                if not obj._p_is_ghost():
+                    return
         try:
             pickle = self.get_stored_pickle(oid)
         except DurusKeyError:
@@ -196,17 +290,41 @@ class Connection (ConnectionBase):
         obj.__setstate__(state)
         obj._p_set_status_saved()
 
+    def _prefetch_followers(self, obj, followers):
+        cache = self.cache
+        wanted = []
+        for oid in followers:
+            follower = cache.get(oid)
+            if follower is None or follower._p_is_ghost():
+                wanted.append(oid)
+        if not wanted:
+            return
+        self.prefetch([obj] + wanted)
+        for oid in wanted:
+            follower = cache.get(oid)
+            if follower is not None and not follower._p_is_ghost():
+                self.predictor.note_prefetch(oid)
+
     def get_load_count(self):
         """() -> int
         Returns the number of times that any object's state has been loaded.
         """
         return self.reader.get_load_count()
 
+    def get_compression_stats(self):
+        """() -> CompressionStats
+        Returns the counts of state pickles stored compressed and
+        uncompressed, and the bytes saved and time spent compressing.
+        """
+        return self.compression_stats
+
     def note_access(self, obj):
         assert obj._p_connection is self
         assert obj._p_oid is not None
         _setattribute(obj, '_p_serial', self.transaction_serial)
         self.cache.recent_objects.add(obj)
+        if self.predictor is not None and self.predictor.pending:
+            self.predictor.note_access(obj._p_oid)
 
     def note_change(self, obj):
         """(obj:PersistentObject)
@@ -226,11 +344,26 @@ class Connection (ConnectionBase):
         """
         self.cache.shrink(self)
 
+    def _sync_storage(self):
+        """() -> [str]
+        Return the oids from the storage's sync(), after removing them from
+        the record_cache, and moving this connection's view of the
+        record_cache up to the storage's.
+        """
+        record_cache = self.record_cache
+        if record_cache is None:
+            return self.storage.sync()
+        view = record_cache.get_serial()
+        invalid_oids = self.storage.sync()
+        self.record_cache_tag = record_cache.invalidate(invalid_oids)
+        self.record_cache_view = view
+        return invalid_oids
+
     def _sync(self):
         """
         Process all invalid_oids so that all non-ghost objects are current.
         """
-        invalid_oids = self.storage.sync()
+        invalid_oids = self._sync_storage()
         self.invalid_oids.update(invalid_oids)
         for oid in self.invalid_oids:
             obj = self.cache.get(oid)
@@ -261,21 +394,22 @@ class Connection (ConnectionBase):
             assert not self.invalid_oids, "still conflicted: missing abort()"
             self.storage.begin()
             new_objects = {}
-            for oid, changed_object in iteritems(self.changed):
-                writer = ObjectWriter(self)
-                try:
-                    for obj in writer.gen_new_objects(changed_object):
-                        oid = obj._p_oid
-                        if oid in new_objects:
-                            continue
-                        elif oid not in self.changed:
-                            new_objects[oid] = obj
-                            self.cache[oid] = obj
-                        data, refs = writer.get_state(obj)
-                        self.storage.store(oid, pack_record(oid, data, refs))
-                        obj._p_set_status_saved()
-                finally:
-                    writer.close()
+            writer = ObjectWriter(self, self.compression_stats)
+            try:
+                for obj in writer.gen_objects(self.changed.values()):
+                    oid = obj._p_oid
+                    if oid in new_objects:
+                        continue
+                    elif oid not in self.changed:
+                        new_objects[oid] = obj
+                        self.cache[oid] = obj
+                    data, refs = writer.get_state(obj)
+                    self.storage.store(oid, pack_record(oid, data, refs))
+                    obj._p_set_status_saved()
+            finally:
+                writer.close()
+            if self.record_cache is not None:
+                view = self.record_cache.get_serial()
             try:
                 self.storage.end(self._handle_invalidations)
             except ConflictError:
@@ -285,6 +419,11 @@ class Connection (ConnectionBase):
                     obj._p_set_status_unsaved()
                     obj._p_connection = None
                 raise
+            if self.record_cache is not None:
+                # The storage is now as current as after a sync().
+                self.record_cache_tag = self.record_cache.invalidate(
+                    self.changed)
+                self.record_cache_view = view
             self.changed.clear()
         self.shrink_cache()
         self.transaction_serial += 1
@@ -294,6 +433,8 @@ class Connection (ConnectionBase):
         Check if any of the oids are for objects that were accessed during
         this transaction.  If so, raise the appropriate conflict exception.
         """
+        if self.record_cache is not None:
+            self.record_cache.invalidate(oids)
         conflicts = []
         for oid in oids:
             obj = self.cache.get(oid)
@@ -366,29 +507,220 @@ class ObjectDictionary (object):
 class ReferenceContainer (object):
     """
     This is used to hold hard references to recently used instances.
+
+    It is also the replacement policy of the Cache.  The Connection calls
+    add() when an instance is first accessed in a transaction, and when
+    the cache is too big, pop() chooses the instances to release.
+    A different policy can be given to the Cache, as any object with
+    these methods.  This one releases the least recently used instances
+    first, and every method takes constant amortized time.
     """
     def __init__(self):
-        self.map = {}
+        self.map = OrderedDict()
 
     def __len__(self):
         return len(self.map)
 
     def add(self, x):
-        self.map[id(x)] = x
+        key = id(x)
+        # Removing first puts x at the most recently used end.
+        self.map.pop(key, None)
+        self.map[key] = x
 
     def discard(self, x):
-        key = id(x)
-        if key in self.map:
-            del self.map[key]
+        self.map.pop(id(x), None)
+
+    def pop(self, transaction_serial):
+        """(transaction_serial:int) -> PersistentObject | None
+        Remove and return the least recently used instance that was not
+        accessed in the current transaction, or return None if every one
+        was.  The instances passed over are moved to the most recently used
+        end, so that the next call does not look at them again.
+        """
+        for j in range(len(self.map)):
+            key, x = self.map.popitem(last=False)
+            if x._p_serial != transaction_serial:
+                return x
+            self.map[key] = x
+        return None
+
+
+class RecordCache (object):
+    """
+    A cache of state pickles, keyed by oid, that Connections in different
+    threads may share, so that a record used by all of them is loaded
+    from the storage once instead of once per connection.
+    Each Connection removes the oids reported by sync() and end() of its
+    storage, and the oids it commits.  The least recently used pickles are
+    removed when the total size is over the target.
+
+    A pickle that another connection loaded may be newer than the state
+    that a connection's storage would give it, or the storage would raise
+    ReadConflictError instead.  So each pickle is kept with a tag, the
+    serial after the last sync of the storage it came from.  A connection
+    only uses the pickles with tags that are not greater than its serial
+    from before the last sync of its own storage, and its own pickles.
+    The others it loads from its storage, as if they were not here.
+
+    Instance attributes:
+      size: int
+        The target total number of bytes in the pickles.
+      records: OrderedDict({oid:str : (data:str, tag:int)})
+        Least recently used first.
+      bytes: int
+        The total number of bytes in the pickles.
+      serial: int
+        The number of calls to invalidate().  A pickle loaded while
+        invalidate() was called might be obsolete, so it is not kept.
+    """
+    def __init__(self, size=1 << 26):
+        self.size = size
+        self.records = OrderedDict()
+        self.bytes = 0
+        self.serial = 0
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.records)
+
+    def get_serial(self):
+        return self.serial
+
+    def get(self, oid, view, tag):
+        """(oid:str, view:int, tag:int) -> str | None
+        Return the pickle, if it has the given tag, or a tag that is not
+        greater than view.
+        """
+        self.lock.acquire()
+        try:
+            entry = self.records.get(oid)
+            if entry is None or (entry[1] > view and entry[1] != tag):
+                return None
+            # Move it to the most recently used end.
+            del self.records[oid]
+            self.records[oid] = entry
+            return entry[0]
+        finally:
+            self.lock.release()
+
+    def put(self, oid, data, serial, tag):
+        """(oid:str, data:str, serial:int, tag:int)
+        Keep the pickle, with the tag, unless there has been a call to
+        invalidate() since get_serial() returned serial.
+        """
+        self.lock.acquire()
+        try:
+            if serial != self.serial or oid in self.records:
+                return
+            self.records[oid] = (data, tag)
+            self.bytes += len(data)
+            while self.bytes > self.size:
+                old_oid, old_entry = self.records.popitem(last=False)
+                self.bytes -= len(old_entry[0])
+        finally:
+            self.lock.release()
+
+    def invalidate(self, oids):
+        """(oids:sequence(str)) -> int
+        Remove the pickles, and return the new serial.
+        """
+        self.lock.acquire()
+        try:
+            self.serial += 1
+            for oid in oids:
+                entry = self.records.pop(oid, None)
+                if entry is not None:
+                    self.bytes -= len(entry[0])
+            return self.serial
+        finally:
+            self.lock.release()
+
+
+class AccessPredictor (object):
+    """
+    Remembers, for each oid, the oids of the ghosts loaded right after it,
+    so that a Connection can load them with it the next time.  This
+    helps when the same objects are used in the same order again and
+    again, and each load from the storage costs a round trip.
+    A Connection that has one prefetches the followers of each ghost it
+    loads, in the same call to the storage's bulk_load().
+
+    Instance attributes:
+      size: int
+        The maximum number of oids to remember followers for.
+      followers: int
+        The maximum number of followers to remember for each oid.
+      table: OrderedDict({oid:str : [oid:str]})
+        Least recently used first.  The followers are oldest first.
+      last_oid: str | None
+        The oid of the last ghost loaded.
+      pending: set([str])
+        Oids of prefetched objects that have not been accessed yet.
+      hits: int
+        The number of prefetched objects that were then accessed.
+      misses: int
+        The number of ghosts that had to be loaded.
+      prefetched: int
+        The number of objects loaded because they were predicted.
+    """
+    def __init__(self, size=10000, followers=8):
+        self.size = size
+        self.followers = followers
+        self.table = OrderedDict()
+        self.last_oid = None
+        self.pending = set()
+        self.hits = 0
+        self.misses = 0
+        self.prefetched = 0
+
+    def note_load(self, oid):
+        """(oid:str) -> [str]
+        Remember that the ghost with this oid is being loaded, and return
+        the oids that followed it before.
+        """
+        self.misses += 1
+        last_oid = self.last_oid
+        self.last_oid = oid
+        if last_oid is not None and last_oid != oid:
+            followers = self.table.pop(last_oid, None)
+            if followers is None:
+                followers = []
+            elif oid in followers:
+                followers.remove(oid)
+            followers.append(oid)
+            if len(followers) > self.followers:
+                del followers[0]
+            self.table[last_oid] = followers
+            if len(self.table) > self.size:
+                self.table.popitem(last=False)
+        return self.table.get(oid)
+
+    def note_prefetch(self, oid):
+        self.prefetched += 1
+        if len(self.pending) >= self.size:
+            self.pending.clear() # forget those never accessed
+        self.pending.add(oid)
+
+    def note_access(self, oid):
+        if oid in self.pending:
+            self.pending.remove(oid)
+            self.hits += 1
+
+    def __str__(self):
+        return '%s hits, %s misses, %s prefetched' % (
+            self.hits, self.misses, self.prefetched)
 
 
 class Cache (object):
 
-    def __init__(self, size):
+    def __init__(self, size, policy=None):
+        """(size:int, policy:ReferenceContainer=None)
+        """
         self.objects = ObjectDictionary()
-        self.recent_objects = ReferenceContainer()
+        if policy is None:
+            policy = ReferenceContainer()
+        self.recent_objects = policy
         self.set_size(size)
-        self.finger = 0
 
     def get_size(self):
         """Return the target size of the cache."""
@@ -419,29 +751,10 @@ class Cache (object):
             assert obj._p_oid is None
             del self.objects[key]
 
-    def _build_heap(self, transaction_serial):
-        """(transaction_serial:int) -> [(serial, oid)]
-        """
-        all = self.objects
-        heap_size_target = (len(all) - self.size) * 2
-        start = self.finger % len(all)
-        heap = []
-        for oid in islice(chain(all, all), start, start + len(all)):
-            self.finger += 1
-            obj = all.get(oid)
-            if obj is None:
-                continue # The ref is dead.
-            if obj._p_serial == transaction_serial:
-                continue # obj is current.  Leave it alone.
-            heappush(heap, (obj._p_serial, oid))
-            if len(heap) >= heap_size_target:
-                break
-        self.finger = self.finger % len(all)
-        return heap
-
     def shrink(self, connection):
         """(connection:Connection)
         Try to reduce the size of self.objects.
+        The work done is proportional to the number of instances released.
         """
         current = len(self.objects)
         if current <= self.size:
@@ -450,17 +763,15 @@ class Cache (object):
                 getpid(), current, len(self.recent_objects))
             return
         start_time = time()
-        heap = self._build_heap(connection.get_transaction_serial())
+        transaction_serial = connection.get_transaction_serial()
         num_ghosted = 0
-        while heap and len(self.objects) > self.size:
-            serial, oid = heappop(heap)
-            obj = self.objects.get(oid)
+        while len(self.objects) > self.size:
+            obj = self.recent_objects.pop(transaction_serial)
             if obj is None:
-                continue
+                break # Everything left is in use.
             if obj._p_is_saved():
                 obj._p_set_status_ghost()
                 num_ghosted += 1
-            self.recent_objects.discard(obj)
         log(10, '[%s] shrink %fs removed %s ghosted %s size %s recent %s',
             getpid(), time() - start_time, current - len(self.objects),
             num_ghosted, len(self.objects), len(self.recent_objects))
@@ -487,6 +798,22 @@ def touch_every_reference(connection, *words):
             if word in data or word in state:
                 get(oid)._p_note_change()
 
+def prefetch_contents(container):
+    """(container:PersistentList | PersistentDict | PersistentSet | BTree)
+    Load the states of the persistent objects held by the container, using
+    Connection.prefetch().  The container's _p_prefetch_refs() returns the
+    objects it holds; a BTree loads its nodes a level at a time there, so
+    that takes a round trip for each level, and one more for the keys and
+    values.
+    """
+    try:
+        get_refs = container._p_prefetch_refs
+    except AttributeError:
+        raise TypeError('Unknown container type %r' % type(container))
+    contents = get_refs()
+    container._p_connection.prefetch(
+        x for x in contents if isinstance(x, PersistentBase))
+
 def gen_every_instance(connection, *classes):
     """(connection:Connection, *classes:(class)) -> sequence [PersistentObject]
     Generate all PersistentObject instances that are instances of any of the
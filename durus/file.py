@@ -2,6 +2,8 @@
 $URL$
 $Id$
 """
+from durus.utils import ShortRead
+import mmap
 import os, os.path
 from os.path import exists
 from tempfile import NamedTemporaryFile, _TemporaryFileWrapper
@@ -10,6 +12,12 @@ if os.name == 'nt':
 else:
     import fcntl
 
+# Writers that produce many small records (Shelf, FileStorage2) assemble
+# them in memory and pass them to File.write() in chunks of about this
+# many bytes, so that a transaction costs one write() and one flush()
+# rather than several per record.
+WRITE_BUFFER_SIZE = 1 << 20
+
 class File (object):
     """
     A file wrapper that smooths over some platform-specific
@@ -35,6 +43,9 @@ class File (object):
     def get_name(self):
         return self.file.name
 
+    def fileno(self):
+        return self.file.fileno()
+
     def is_temporary(self):
         return isinstance(self.file, _TemporaryFileWrapper)
 
@@ -131,3 +142,55 @@ class File (object):
     def fsync(self):
         if hasattr(os, 'fsync'):
             os.fsync(self.file)
+
+
+class FileMap (object):
+    """
+    A read-only memory map of a File.
+    Reads are served from the map without seek() or read() calls.
+    The map is renewed, when needed, to cover data appended to the file
+    after it was made.
+    """
+    def __init__(self, file):
+        self.file = file
+        self.map = None
+        self.size = 0
+        self.remap()
+
+    def remap(self):
+        """
+        Extend the map to cover the current length of the file.
+        """
+        size = len(self.file)
+        if size > self.size:
+            # The old map, if any, is released once nothing refers to it.
+            self.map = mmap.mmap(self.file.fileno(), size,
+                                 access=mmap.ACCESS_READ)
+            self.size = size
+
+    def _check(self, start, n):
+        if start + n > self.size:
+            self.remap()
+            if start + n > self.size:
+                raise ShortRead()
+
+    def read(self, start, n):
+        """(start:int, n:int) -> str
+        Return the n bytes that start at the given position.
+        """
+        self._check(start, n)
+        return self.map[start:start + n]
+
+    def view(self, start, n):
+        """(start:int, n:int) -> memoryview
+        Like read(), but the result is a view of the map, not a copy.
+        """
+        self._check(start, n)
+        return memoryview(self.map)[start:start + n]
+
+    def __len__(self):
+        return self.size
+
+    def close(self):
+        self.map = None
+        self.size = 0
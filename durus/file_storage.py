@@ -5,12 +5,15 @@ $Id$
 from datetime import datetime
 import heapq
 from durus.error import DurusKeyError
-from durus.file import File
+from durus.file import File, WRITE_BUFFER_SIZE
 from durus.logger import log, is_logging
+from durus.pack import gen_mark, ReferenceIndex
 from durus.serialize import unpack_record, split_oids
 from durus.shelf import Shelf
-from durus.storage import Storage
-from durus.utils import int8_to_str, str_to_int8, IntSet, iteritems
+from durus.storage import Storage, FSYNC_NONE, FSYNC_PER_COMMIT, FSYNC_GROUP
+from durus.storage import FSYNC_POLICIES
+from durus.utils import int8_to_str, str_to_int8, Bitmap, iteritems
+from durus.utils import write, write_int8, join_bytes
 import durus.connection
 
 
@@ -37,13 +40,50 @@ class FileStorage (Storage):
         None if a pack is not in progress.
       invalid : set([oid:str])
         set of oids removed by packs since the last call to sync().
+      fsync_policy : str
+        One of FSYNC_POLICIES.
+      fsync_pending : bool
+        Are there transactions that have not been made durable by fsync()?
+      pack_workers : int
+        The number of worker processes that mark reachable records during
+        a pack.  If it is 0, the pack marks them in this process.
+      min_live_ratio : float | None
+        If this is not None, get_collector() returns a young collector
+        while get_live_ratio() is at least this.
     """
-    def __init__(self, filename=None, readonly=False, repair=False):
-        self.shelf = Shelf(filename, readonly=readonly, repair=repair)
+    def __init__(self, filename=None, readonly=False, repair=False,
+                 mmap=False, fsync=FSYNC_NONE, pack_workers=0,
+                 min_live_ratio=None, shared=False):
+        """(filename:str=None, readonly:bool=False, repair:bool=False,
+            mmap:bool=False, fsync:str=FSYNC_NONE, pack_workers:int=0,
+            min_live_ratio:float=None, shared:bool=False)
+        If mmap is true, records are loaded through a memory map of the
+        file.  This saves system calls on every load, which helps
+        read-mostly servers.
+        If shared is true, this read-only storage reads a file that another
+        process is still writing (see Shelf).
+        The fsync policy says when committed transactions are flushed to
+        the disk: never (FSYNC_NONE), at the end of every commit
+        (FSYNC_PER_COMMIT), or when fsync() is called (FSYNC_GROUP).
+        If pack_workers is positive, packs use that many processes to find
+        the reachable records.
+        If min_live_ratio is given, the collections that a StorageServer
+        starts only remove garbage written since the last pack, until
+        the live ratio of the records written by that pack falls below
+        min_live_ratio.
+        """
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("Unknown fsync policy %r" % fsync)
+        self.shelf = Shelf(filename, readonly=readonly, repair=repair,
+                           mmap=mmap, shared=shared)
         self.pending_records = {}
         self.allocated_unused_oids = set()
         self.pack_extra = None
         self.invalid = set()
+        self.fsync_policy = fsync
+        self.fsync_pending = False
+        self.pack_workers = pack_workers
+        self.min_live_ratio = min_live_ratio
 
     @classmethod
     def has_format(klass, file):
@@ -77,8 +117,15 @@ class FileStorage (Storage):
             self.begin()
             raise ValueError("oid %r is a surprise" % oid)
 
+    def get_fsync_policy(self):
+        return self.fsync_policy
+
     def end(self, handle_invalidations=None):
         self.shelf.store(iteritems(self.pending_records))
+        if self.fsync_policy == FSYNC_PER_COMMIT:
+            self.shelf.get_file().fsync()
+        elif self.fsync_policy == FSYNC_GROUP:
+            self.fsync_pending = True
         if is_logging(20):
             shelf_file = self.shelf.get_file()
             shelf_file.seek_end()
@@ -88,6 +135,8 @@ class FileStorage (Storage):
             self.pack_extra.update(self.pending_records)
         self.allocated_unused_oids -= set(self.pending_records)
         self.begin()
+        if not self.fsync_pending:
+            self.checkpoint()
 
     def sync(self):
         """() -> [str]
@@ -103,7 +152,7 @@ class FileStorage (Storage):
         else:
             todo = [start_oid]
             if seen is None:
-                seen = IntSet() # This eventually contains them all.
+                seen = Bitmap() # This eventually contains them all.
             while todo:
                 oid = heapq.heappop(todo)
                 if str_to_int8(oid) in seen:
@@ -139,13 +188,27 @@ class FileStorage (Storage):
         assert file.tell() == 0
         def packer():
             yield "started %s" % datetime.now()
-            seen = IntSet()
-            items = self.gen_oid_record(start_oid=int8_to_str(0), seen=seen)
+            if self.pack_workers > 0:
+                seen = yield from gen_mark(file_path, int8_to_str(0),
+                    self.pack_workers,
+                    self.shelf.get_offset_map().get_array_size(),
+                    mmap=self.shelf.is_mapped())
+                yield "marked %s %s" % (len(seen), datetime.now())
+                items = ((int8_to_str(n), self.load(int8_to_str(n)))
+                         for n in seen)
+            else:
+                # Mark from the references alone, and copy in file order.
+                index = ReferenceIndex()
+                for step in index.gen_scan(self.shelf):
+                    yield step
+                seen = yield from index.gen_mark([int8_to_str(0)])
+                yield "marked %s %s" % (len(seen), datetime.now())
+                items = index.gen_records(file_path, seen)
             for step in Shelf.generate_shelf(file, items):
                 yield step
             file.flush()
             file.fsync()
-            shelf = Shelf(file)
+            shelf = Shelf(file, mmap=self.shelf.is_mapped())
             yield "base written %s" % datetime.now()
             # Invalidate oids that have been removed.
             for hole in shelf.get_offset_map().gen_holes():
@@ -159,22 +222,159 @@ class FileStorage (Storage):
                 seen.discard(str_to_int8(oid))
             for oid in self.pack_extra:
                 shelf.store(self.gen_oid_record(start_oid=oid, seen=seen))
-            file.flush()
-            file.fsync()
-            if not self.shelf.get_file().is_temporary():
-                self.shelf.get_file().rename(file_path + '.prepack')
-                self.shelf.get_file().close()
-            shelf.get_file().rename(file_path)
-            self.shelf = shelf
-            self.pack_extra = None
+            self._replace_shelf(shelf)
             yield "finished %s" % datetime.now()
         return packer()
 
+    def _replace_shelf(self, shelf):
+        file_path = self.shelf.get_file().get_name()
+        shelf.get_file().flush()
+        shelf.get_file().fsync()
+        # The old checkpoint does not describe the new file.
+        self.shelf.remove_checkpoint()
+        if not self.shelf.get_file().is_temporary():
+            self.shelf.get_file().rename(file_path + '.prepack')
+            self.shelf.get_file().close()
+        shelf.get_file().rename(file_path)
+        self.shelf = shelf
+        self.pack_extra = None
+
+    def get_live_ratio(self):
+        """() -> float
+        Return the fraction of the bytes in the records written by the
+        last pack that belong to records that have not been replaced
+        since.  Records that have become unreachable without being
+        replaced count as live: only a pack can find them.
+        """
+        initial = (self.shelf.get_offset_map().get_start() -
+                   len(Shelf.prefix) - 8)
+        if initial <= 0:
+            return 1.0
+        return 1.0 - float(self.shelf.get_replaced_bytes()) / initial
+
+    def get_collector(self):
+        """
+        Return a young collector if min_live_ratio is set and the records
+        written by the last pack are live enough, and a packer otherwise.
+        """
+        if (self.min_live_ratio is not None and
+            self.get_live_ratio() >= self.min_live_ratio):
+            return self.get_young_collector()
+        return self.get_packer()
+
+    def get_young_collector(self):
+        """
+        Return a generator that removes the unreachable objects created
+        since the last pack.  The objects that were in the last pack are
+        taken to be reachable, and the records written by the pack are
+        copied as they are, so the work of marking and copying records
+        grows with the records written since the pack, not with the size
+        of the database.  Objects that survive stay in the later part of
+        the file until the next pack.
+        """
+        if (self.pending_records or
+            self.pack_extra is not None or
+            self.shelf.get_file().is_temporary() or
+            self.shelf.get_file().is_readonly()):
+            return (x for x in []) # Don't collect.
+        self.pack_extra = set()
+        file_path = self.shelf.get_file().get_name()
+        file = File(file_path + '.pack')
+        file.truncate() # obtains lock and clears.
+        assert file.tell() == 0
+        def collector():
+            yield "young started %s" % datetime.now()
+            offset_map = self.shelf.get_offset_map()
+            index = ReferenceIndex()
+            for step in index.gen_scan(self.shelf, initial=False):
+                yield step
+            # Only objects created since the pack can be removed.  Their
+            # oids are not in the offset map, and only records written
+            # since the pack can refer to them.
+            roots = [int8_to_str(0)]
+            for n in index.oids:
+                if n >= 0 and offset_map.get(n) is not None:
+                    roots.append(int8_to_str(n))
+            seen = yield from index.gen_mark(roots)
+            yield "young marked %s %s" % (len(seen), datetime.now())
+            # Copy the part written by the pack, up to the transactions
+            # after the offset map.
+            source = open(file_path, 'rb')
+            try:
+                while file.tell() < self.shelf.transactions_start:
+                    write(file, source.read(min(WRITE_BUFFER_SIZE,
+                        self.shelf.transactions_start - file.tell())))
+                    yield file.tell()
+            finally:
+                source.close()
+            # Write the surviving records as one transaction.
+            transaction_start = file.tell()
+            write_int8(file, 0)
+            chunk = []
+            chunk_size = 0
+            for oid, record in index.gen_records(file_path, seen):
+                chunk.append(int8_to_str(len(oid) + len(record)))
+                chunk.append(oid)
+                chunk.append(record)
+                chunk_size += 16 + len(record)
+                if chunk_size >= WRITE_BUFFER_SIZE:
+                    write(file, join_bytes(chunk))
+                    chunk = []
+                    chunk_size = 0
+                    yield file.tell()
+            write(file, join_bytes(chunk))
+            transaction_end = file.tell()
+            file.seek(transaction_start)
+            write_int8(file, transaction_end - transaction_start - 8)
+            file.flush()
+            file.fsync()
+            shelf = Shelf(file, mmap=self.shelf.is_mapped())
+            yield "young written %s" % datetime.now()
+            for n in index.oids:
+                if n >= 0 and n not in seen:
+                    self.invalid.add(int8_to_str(n))
+            # Add what was committed since the start, and any objects
+            # that it reaches that were not copied.
+            todo = list(self.pack_extra)
+            done = set()
+            records = []
+            while todo:
+                oid = todo.pop()
+                if oid in done:
+                    continue
+                done.add(oid)
+                if (oid not in self.pack_extra and
+                    shelf.get_position(oid) is not None):
+                    continue
+                record = self.load(oid)
+                records.append((oid, record))
+                todo.extend(split_oids(unpack_record(record)[2]))
+            shelf.store(records)
+            self._replace_shelf(shelf)
+            yield "young finished %s" % datetime.now()
+        return collector()
+
     def pack(self):
         for iteration in self.get_packer():
             pass
 
+    def fsync(self):
+        if self.fsync_pending:
+            self.shelf.get_file().fsync()
+            self.fsync_pending = False
+            self.checkpoint()
+
+    def checkpoint(self):
+        """
+        Write the shelf's index checkpoint, if enough has been committed
+        since the last one.  This is called once commits are on the disk,
+        not while a transaction is being written.
+        """
+        if self.shelf.is_checkpoint_due():
+            self.shelf.write_checkpoint()
+
     def close(self):
+        self.fsync()
         self.shelf.close()
 
     def __str__(self):
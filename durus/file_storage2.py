@@ -4,15 +4,15 @@ $Id: file_storage.py 31299 2008-11-19 19:52:31Z dbinger $
 """
 from datetime import datetime
 import heapq
-from durus.file import File
+from durus.file import File, WRITE_BUFFER_SIZE
 from durus.logger import log, is_logging
 from durus.serialize import unpack_record, split_oids
 from durus.storage import Storage
-from durus.utils import int8_to_str, str_to_int8, IntSet
+from durus.utils import int8_to_str, str_to_int8, int4_to_str, IntSet
 from durus.utils import read, write, read_int8_str, write_int8_str
 from durus.utils import read_int8, write_int8, ShortRead, iteritems
-from durus.utils import write_int4, read_int4_str, write_int4_str
-from durus.utils import dumps, loads, as_bytes, byte_string
+from durus.utils import read_int4_str
+from durus.utils import dumps, loads, as_bytes, byte_string, join_bytes
 from zlib import compress, decompress
 import durus.connection
 
@@ -177,13 +177,24 @@ class FileStorage2(Storage):
 
     def _write_transaction(self, fp, records, index):
         fp.seek(0, 2)
+        position = fp.tell()
+        chunk = []
+        chunk_size = 0
         for i, (oid, record) in enumerate(records):
             full_record = self._disk_format(record)
-            index[oid] = fp.tell()
-            write_int4_str(fp, full_record)
+            index[oid] = position
+            chunk.append(int4_to_str(len(full_record)))
+            chunk.append(full_record)
+            position += 4 + len(full_record)
+            chunk_size += 4 + len(full_record)
+            if chunk_size >= WRITE_BUFFER_SIZE:
+                write(fp, join_bytes(chunk))
+                chunk = []
+                chunk_size = 0
             if i % self._PACK_INCREMENT == 0:
                 yield None
-        write_int4(fp, 0) # terminator
+        chunk.append(int4_to_str(0)) # terminator
+        write(fp, join_bytes(chunk))
 
     def _disk_format(self, record):
         return record
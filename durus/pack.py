@@ -0,0 +1,245 @@
+"""
+$URL$
+$Id$
+
+Marking of the records reachable from the root, for packing a FileStorage.
+
+A ReferenceIndex holds the references of all of the records in a Shelf
+file, read in one sequential pass, so that marking needs no record loads
+and the copy can read the live records in file order.
+
+gen_mark() instead spreads the marking over worker processes.  Each worker
+opens its own read-only Shelf on the file and owns a range of oids.  A
+worker loads the records of the oids it is sent, skipping the ones it has
+seen before, and returns the references it finds, grouped by the worker
+that owns them.  The parent only routes batches of references between the
+workers, so the loading and unpickling of references runs on as many
+cores as there are workers.
+"""
+from array import array
+from durus.file import WRITE_BUFFER_SIZE
+from durus.serialize import unpack_record, split_oids
+from durus.shelf import Shelf
+from durus.utils import str_to_int8, int8_to_str, join_bytes, Bitmap
+from durus.utils import empty_byte_string, read_int8, read_int8_str
+from multiprocessing import Pipe, Process
+from multiprocessing.connection import wait
+import sys
+
+# The number of packed chunks of oids in a batch sent to a worker.
+BATCH_SIZE = 64
+
+# Seconds to wait for a worker before yielding to the caller.
+POLL_TIMEOUT = 0.01
+
+# Records handled by a ReferenceIndex between yields.
+STEP_SIZE = 10000
+
+
+class ReferenceIndex (object):
+    """
+    The positions and references of the records in a Shelf file.
+    It holds no record data, so it is small enough to keep in memory.
+
+    Instance attributes:
+      slots : array('q')
+        For each oid number, the slot of its current record, or -1.
+      oids : array('q')
+        For each slot, the oid number of the record, or -1 if a later
+        record for the same oid replaces it.
+      positions : array('Q')
+        For each slot, the position of the record in the file.
+      ends : array('Q')
+        For each slot, where the record's references end in refs.
+      refs : array('Q')
+        The oid numbers referenced by the records, in file order.
+    """
+    def __init__(self):
+        self.slots = array('q')
+        self.oids = array('q')
+        self.positions = array('Q')
+        self.ends = array('Q')
+        self.refs = array('Q')
+
+    def add(self, n, position, record):
+        """(n:int, position:int, record:str)
+        Note the record of the oid with number n, found at position.
+        """
+        if n >= len(self.slots):
+            self.slots.extend(array('q', [-1]) * (n + 1 - len(self.slots)))
+        slot = self.slots[n]
+        if slot >= 0:
+            self.oids[slot] = -1
+        self.slots[n] = len(self.oids)
+        self.oids.append(n)
+        self.positions.append(position)
+        refs = array('Q')
+        refs.frombytes(unpack_record(record)[2])
+        if sys.byteorder == 'little':
+            refs.byteswap()
+        self.refs.extend(refs)
+        self.ends.append(len(self.refs))
+
+    def gen_scan(self, shelf, initial=True):
+        """(shelf:Shelf, initial:bool=True)
+        Return a generator that adds the records in the shelf's file, up
+        to the shelf's current end, reading the file from start to end.
+        If initial is false, the records of the initial transaction, the
+        one written by the last pack, are skipped.
+        """
+        spans = [(shelf.transactions_start, shelf.end)]
+        if initial:
+            spans.insert(0,
+                (len(shelf.prefix), shelf.get_offset_map().get_start()))
+        file = open(shelf.get_file().get_name(), 'rb', WRITE_BUFFER_SIZE)
+        try:
+            for start, end in spans:
+                file.seek(start)
+                position = start
+                while position < end:
+                    transaction_end = position + 8 + read_int8(file)
+                    position += 8
+                    while position < transaction_end:
+                        item = read_int8_str(file)
+                        self.add(str_to_int8(item[:8]), position, item[8:])
+                        position += 8 + len(item)
+                        if len(self.oids) % STEP_SIZE == 0:
+                            yield len(self.oids)
+        finally:
+            file.close()
+
+    def gen_mark(self, start_oids):
+        """(start_oids:[str])
+        Return a generator that marks the oids reachable from start_oids.
+        It yields now and then, and returns the Bitmap of the marked oids.
+        """
+        slots = self.slots
+        ends = self.ends
+        refs = self.refs
+        seen = Bitmap()
+        todo = [str_to_int8(oid) for oid in start_oids]
+        count = 0
+        while todo:
+            n = todo.pop()
+            if n in seen:
+                continue
+            seen.add(n)
+            if n < len(slots) and slots[n] >= 0:
+                slot = slots[n]
+                todo.extend(refs[slot and ends[slot - 1]:ends[slot]])
+            count += 1
+            if count % STEP_SIZE == 0:
+                yield count
+        return seen
+
+    def gen_records(self, filename, seen):
+        """(filename:str, seen:Bitmap) -> sequence((str, str))
+        Generate the oids and current records of the members of seen, in
+        the order of their positions in the file.
+        """
+        file = open(filename, 'rb', WRITE_BUFFER_SIZE)
+        try:
+            for slot, n in enumerate(self.oids):
+                if n >= 0 and n in seen:
+                    file.seek(self.positions[slot])
+                    item = read_int8_str(file)
+                    yield int8_to_str(n), item[8:]
+        finally:
+            file.close()
+
+
+def get_owner(n, workers, span):
+    """(n:int, workers:int, span:int) -> int
+    Return the number of the worker that owns the oid with number n.
+    The oids below span are split into equal ranges.  Larger ones belong
+    to the last worker.
+    """
+    return min(workers - 1, n * workers // span)
+
+def mark_worker(connection, filename, mmap, workers, span):
+    """
+    The loop of a worker process.  It receives batches of packed oids,
+    and answers each with a list of packed references, one for each
+    worker.  An empty batch asks for the Bitmap of the oids seen, and
+    ends the loop.
+    """
+    shelf = Shelf(filename, readonly=True, mmap=mmap, shared=True)
+    seen = Bitmap()
+    try:
+        while True:
+            oids = connection.recv_bytes()
+            if not oids:
+                connection.send_bytes(bytes(seen.bits))
+                break
+            found = [[] for j in range(workers)]
+            for oid in split_oids(oids):
+                n = str_to_int8(oid)
+                if n in seen:
+                    continue
+                seen.add(n)
+                record = shelf.get_value(oid)
+                if record is None:
+                    # Committed after this shelf was opened.
+                    shelf.refresh()
+                    record = shelf.get_value(oid)
+                    if record is None:
+                        continue
+                for ref in split_oids(unpack_record(record)[2]):
+                    found[get_owner(str_to_int8(ref), workers, span)].append(
+                        ref)
+            connection.send([join_bytes(refs) for refs in found])
+    finally:
+        shelf.close()
+
+def gen_mark(filename, start_oid, workers, span, mmap=False):
+    """(filename:str, start_oid:str, workers:int, span:int, mmap:bool)
+    Return a generator that marks the records reachable from start_oid in
+    the file, using the given number of worker processes.  It yields while
+    it waits for the workers, and returns the Bitmap of the reachable oids.
+    span is the number of oids divided among the workers.
+    """
+    span = max(span, 1)
+    connections = []
+    processes = []
+    try:
+        for j in range(workers):
+            parent_end, child_end = Pipe()
+            process = Process(target=mark_worker,
+                args=(child_end, filename, mmap, workers, span))
+            process.daemon = True
+            process.start()
+            child_end.close()
+            connections.append(parent_end)
+            processes.append(process)
+        todo = [[] for j in range(workers)]
+        todo[get_owner(str_to_int8(start_oid), workers, span)].append(
+            start_oid)
+        busy = set()
+        while True:
+            for j, connection in enumerate(connections):
+                if todo[j] and connection not in busy:
+                    batch = todo[j][:BATCH_SIZE]
+                    del todo[j][:BATCH_SIZE]
+                    connection.send_bytes(join_bytes(batch))
+                    busy.add(connection)
+            if not busy:
+                break
+            for connection in wait(list(busy), POLL_TIMEOUT):
+                busy.remove(connection)
+                for j, refs in enumerate(connection.recv()):
+                    if refs:
+                        todo[j].append(refs)
+            yield len(busy)
+        seen = Bitmap()
+        for connection in connections:
+            connection.send_bytes(empty_byte_string)
+            seen.update(connection.recv_bytes())
+        for process in processes:
+            process.join()
+        return seen
+    finally:
+        for connection in connections:
+            connection.close()
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
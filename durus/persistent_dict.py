@@ -125,4 +125,10 @@ class PersistentDict (PersistentObject, collections.abc.MutableMapping):
     def __iter__(self):
         return iter(self.data)
 
+    def _p_prefetch_refs(self):
+        """() -> [object]
+        Return the keys and values, for prefetch_contents() to load.
+        """
+        return list(self.data.keys()) + list(self.data.values())
+
 
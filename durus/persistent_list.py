@@ -17,6 +17,12 @@ class PersistentList (PersistentObject, collections.abc.MutableSequence):
     def __init__(self, *args, **kwargs):
         self.data = list(*args, **kwargs)
 
+    def _p_prefetch_refs(self):
+        """() -> [object]
+        Return the items, for prefetch_contents() to load.
+        """
+        return self.data
+
     def __cast(self, other):
         if isinstance(other, PersistentList): return other.data
         else: return other
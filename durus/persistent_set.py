@@ -74,6 +74,12 @@ class PersistentSet (PersistentObject, collections.abc.MutableSet):
         for x in self.s:
             yield x
 
+    def _p_prefetch_refs(self):
+        """() -> set
+        Return the items, for prefetch_contents() to load.
+        """
+        return self.s
+
     def __ixor__(self, other):
         self._p_note_change()
         if isinstance(other, PersistentSet):
@@ -0,0 +1,264 @@
+"""
+$URL$
+$Id$
+
+A StorageServer that spreads loads over forked reader processes.
+
+The primary process accepts every client connection, and it handles all
+commands other than loads itself, so commits, oid allocation and packing
+work as they do in the StorageServer.  The 'L', 'B', and 'F' loads are
+passed to reader processes, each with its own read-only FileStorage on the
+same file.  Each message to a reader carries the primary's end-of-file
+position, so that the reader can add the transactions committed since its
+last load to its index before it loads anything, and a generation number
+that changes when a pack replaces the file, so that the reader knows to
+open the file again.  The primary also marks the oids that the client must
+see as invalid, since it is the primary that tracks invalidations.
+
+The client's socket goes to the reader with the message, as SCM_RIGHTS
+ancillary data, and the reader writes the load responses to the client
+itself.  The primary only reads the request, and the records never pass
+through it, so the loading and the sending of the records are spread over
+the reader processes.  The primary does not read from the client again
+until the reader says that it is done.
+
+A message to a reader has the following parts:
+1) the generation (int4);
+2) the end-of-file position (int8);
+3) the number of oids (int4);
+4) the bytes to send ahead of the load responses (int4_str);
+5) for each oid, STATUS_INVALID or STATUS_OKAY, followed by the oid.
+The reader answers STATUS_OKAY when the responses are sent to the client,
+or _STATUS_DROPPED if the client could not be written to.
+"""
+from durus.file_storage import FileStorage
+from durus.logger import log
+from durus.storage_server import StorageServer, TIMEOUT
+from durus.storage_server import STATUS_OKAY, STATUS_INVALID
+from durus.utils import int4_to_str, int8_to_str, str_to_int4, read, write
+from durus.utils import read_int4, read_int8, read_int4_str
+from durus.utils import join_bytes, as_bytes, ShortRead, xrange
+from array import array
+from collections import deque
+import os
+import socket
+
+_STATUS_DROPPED = as_bytes('D')
+
+
+def _send_with_socket(s, data, client):
+    """(s:socket, data:str, client:socket)
+    Write data to s, passing client along with it.
+    """
+    fds = array('i', [client.fileno()])
+    sent = s.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+    if sent < len(data):
+        write(s, data[sent:])
+
+def _read_with_socket(s, n):
+    """(s:socket, n:int) -> (str, socket)
+    Read n bytes from s, and the socket passed along with them.
+    """
+    fds = array('i')
+    data, ancillary, flags, address = s.recvmsg(
+        n, socket.CMSG_SPACE(fds.itemsize))
+    if not data:
+        raise ShortRead
+    for level, kind, fd_data in ancillary:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            size = len(fd_data) - len(fd_data) % fds.itemsize
+            fds.frombytes(fd_data[:size])
+    assert len(fds) == 1
+    if len(data) < n:
+        data += read(s, n - len(data))
+    return data, socket.socket(fileno=fds[0])
+
+
+class _Reader (object):
+    """
+    The primary's view of a reader process.
+
+    Instance attributes:
+      pid : int
+      s : socket
+        The primary's end of the connection to the reader.
+      requests : deque([(socket, prefix:str, header:str, entries:[str])])
+        Loads, each for a client socket, waiting for the reader, oldest
+        first.  The header holds the generation, end-of-file position, and
+        oid count as they were when the entries were made.  The first
+        request has been sent to the reader, which answers its client.
+        Only one is sent at a time so that neither process can block
+        writing to the other while it waits to be read.
+    """
+    def __init__(self, pid, s):
+        self.pid = pid
+        self.s = s
+        self.requests = deque()
+
+
+class ReplicatedStorageServer (StorageServer):
+
+    def __init__(self, storage, readers=2, **kwargs):
+        """(storage:FileStorage, readers:int=2, **kwargs)
+        The remaining keyword arguments are those of StorageServer.
+        """
+        if (not isinstance(storage, FileStorage) or
+            storage.shelf.get_file().is_temporary()):
+            raise TypeError("Read replicas need a FileStorage with a file.")
+        assert readers > 0
+        StorageServer.__init__(self, storage, **kwargs)
+        self.reader_count = readers
+        self.readers = []
+        self.shelf = storage.shelf
+        self.generation = 0
+
+    def serve(self):
+        self._start_readers()
+        try:
+            StorageServer.serve(self)
+        finally:
+            self._stop_readers()
+
+    def _start_readers(self):
+        filename = self.storage.get_filename()
+        mmap = self.storage.shelf.is_mapped()
+        for j in xrange(self.reader_count):
+            s, reader_s = socket.socketpair()
+            pid = os.fork()
+            if pid == 0:
+                # This is the reader process.
+                try:
+                    s.close()
+                    for reader in self.readers:
+                        reader.s.close()
+                    ReadReplica(filename, mmap=mmap).serve(reader_s)
+                finally:
+                    os._exit(0)
+            reader_s.close()
+            reader = _Reader(pid, s)
+            self.readers.append(reader)
+            self.sockets.append(s)
+            log(20, 'Reader %s started', pid)
+
+    def _stop_readers(self):
+        for reader in self.readers:
+            reader.s.close() # The reader exits when this closes.
+        for reader in self.readers:
+            os.waitpid(reader.pid, 0)
+        self.readers = []
+
+    def _find_reader(self, s):
+        for reader in self.readers:
+            if reader.s is s:
+                return reader
+        return None
+
+    def handle(self, s):
+        reader = self._find_reader(s)
+        if reader is None:
+            StorageServer.handle(self, s)
+        else:
+            try:
+                status = read(s, 1)
+            except (socket.error, IOError):
+                raise SystemExit('Reader %s failed.' % reader.pid)
+            self._finish_reader_request(reader, status)
+
+    def _send_load_responses(self, s, prefix, oids):
+        self._complete_commits_of(oids)
+        client = self._find_client(s)
+        entries = []
+        for oid in oids:
+            if oid in client.invalid:
+                entries.append(STATUS_INVALID)
+            else:
+                entries.append(STATUS_OKAY)
+            entries.append(oid)
+        if self.storage.shelf is not self.shelf:
+            # A pack has replaced the file.
+            self.shelf = self.storage.shelf
+            self.generation += 1
+        # The reader must load from the file as it is now, when the
+        # entries match the client's invalidations, even if more is
+        # committed before the request reaches the reader.
+        header = join_bytes([int4_to_str(self.generation),
+                             int8_to_str(self.shelf.end),
+                             int4_to_str(len(oids))])
+        # Wait for this answer before reading more from the client, so
+        # that its responses are sent in the order of its requests.
+        self.sockets.remove(s)
+        reader = min(self.readers, key=lambda reader: len(reader.requests))
+        reader.requests.append((s, prefix, header, entries))
+        if len(reader.requests) == 1:
+            self._send_reader_request(reader)
+
+    def _send_reader_request(self, reader):
+        s, prefix, header, entries = reader.requests[0]
+        _send_with_socket(reader.s, join_bytes(
+            [header, int4_to_str(len(prefix)), prefix] + entries), s)
+
+    def _finish_reader_request(self, reader, status):
+        s, prefix, header, entries = reader.requests.popleft()
+        if reader.requests:
+            self._send_reader_request(reader)
+        if status == STATUS_OKAY:
+            self.sockets.append(s)
+        else:
+            log(10, 'Client dropped while loading')
+            self.clients.remove(self._find_client(s))
+            s.close()
+
+
+class ReadReplica (StorageServer):
+    """
+    Runs in a reader process, answering the loads that a
+    ReplicatedStorageServer passes to it.
+    """
+    def __init__(self, filename, mmap=False):
+        self.filename = filename
+        self.mmap = mmap
+        StorageServer.__init__(self, self._open_storage())
+        self.generation = 0
+
+    def _open_storage(self):
+        return FileStorage(self.filename, readonly=True, mmap=self.mmap,
+                           shared=True)
+
+    def serve(self, s):
+        try:
+            while True:
+                try:
+                    data, client = _read_with_socket(s, 4)
+                except ShortRead:
+                    break # The primary is gone.
+                generation = str_to_int4(data)
+                end = read_int8(s)
+                count = read_int4(s)
+                prefix = read_int4_str(s)
+                entries = read(s, 9 * count)
+                if generation != self.generation:
+                    self.storage.close()
+                    self.storage = self._open_storage()
+                    self.generation = generation
+                self.storage.shelf.refresh(end)
+                responses = [prefix]
+                for j in xrange(0, len(entries), 9):
+                    if entries[j:j+1] == STATUS_INVALID:
+                        responses.append(STATUS_INVALID)
+                    else:
+                        oid = entries[j+1:j+9]
+                        responses.append(self._load_response(oid))
+                try:
+                    client.settimeout(TIMEOUT)
+                    write(client, join_bytes(responses))
+                except (socket.error, IOError):
+                    status = _STATUS_DROPPED
+                else:
+                    status = STATUS_OKAY
+                finally:
+                    # The primary keeps its own copy of the socket open.
+                    client.close()
+                write(s, status)
+        finally:
+            self.storage.close()
+            s.close()
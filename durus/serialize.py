@@ -2,21 +2,38 @@
 $URL$
 $Id$
 """
+from durus.codec import get_codec, decompress_state, BUFFERS_TAG
 from durus.persistent import call_if_persistent, GHOST
 from durus.utils import int4_to_str, str_to_int4, join_bytes, BytesIO
 from durus.utils import Pickler, Unpickler, loads, dumps, as_bytes
+from durus.utils import iteritems
 import functools
 from types import MethodType
-from zlib import compress, decompress, error as zlib_error
-import struct
+from zlib import compress
 import sys
+import time
+try:
+    from pickle import PickleBuffer
+except ImportError:
+    PickleBuffer = None
 try:
     from durus._persistent import _setattribute
 except ImportError:
     _setattribute = object.__setattr__
 
 WRITE_COMPRESSED_STATE_PICKLES = True
+STATE_CODEC = 'zlib' # the name of a codec in durus.codec
+# State pickles shorter than this are stored uncompressed.
+COMPRESS_MIN_SIZE = 128
+# Compressed state is stored only if it is at most this fraction of the
+# size of the state pickle.
+COMPRESS_MAX_RATIO = 0.9
+# With protocol 5 or higher, out-of-band buffers are stored uncompressed
+# after the state pickle and loaded as read-only views of the record.
+# numpy arrays pickle their data out-of-band, and so do bytes and
+# bytearray attribute values of at least BUFFER_MIN_SIZE bytes.
 PICKLE_PROTOCOL = 2
+BUFFER_MIN_SIZE = 1024
 
 def pack_record(oid, data, refs):
     """(oid:str, data:str, refs:str) -> record:str
@@ -40,10 +57,10 @@ def split_oids(s):
     """
     if not s:
         return []
-    num, extra = divmod(len(s), 8)
-    assert extra == 0, s
-    fmt = '8s' * num
-    return list(struct.unpack('>' + fmt, s))
+    if len(s) % 8 != 0:
+        raise ValueError("length is not a multiple of the oid size")
+    s = bytes(s)
+    return [s[j:j + 8] for j in range(0, len(s), 8)]
 
 NEWLINE = as_bytes('\n')
 
@@ -54,6 +71,13 @@ def extract_class_name(record):
     except IndexError:
         return "?"
 
+try:
+    # These are called for every record that is loaded, stored or packed.
+    from durus._serialize import pack_record, unpack_record, split_oids
+    from durus._serialize import extract_class_name
+except ImportError:
+    pass
+
 if sys.version < "3":
     def method(a, b):
         return MethodType(a, b, object)
@@ -63,17 +87,71 @@ else:
 
 
 class _PersistentPickler(Pickler):
-    def __init__(self, fp, proto, persistent_id):
-        Pickler.__init__(self, fp, proto)
+    def __init__(self, fp, proto, persistent_id, buffer_callback=None):
+        if buffer_callback is None:
+            Pickler.__init__(self, fp, proto)
+        else:
+            Pickler.__init__(self, fp, proto, buffer_callback=buffer_callback)
         self.persistent_id = method(call_if_persistent, persistent_id)
 
 
+class _OutOfBand (object):
+    """
+    Stands in for a large bytes or bytearray value so that the value is
+    pickled out-of-band.
+    """
+    __slots__ = ['value']
+
+    def __init__(self, value):
+        self.value = value
+
+    def __reduce_ex__(self, protocol):
+        return type(self.value), (PickleBuffer(self.value),)
+
+
+def _out_of_band(state):
+    """
+    Return state with its large bytes and bytearray values, if it is a
+    dict, replaced by _OutOfBand instances.
+    """
+    if type(state) is not dict:
+        return state
+    result = state
+    for name, value in iteritems(state):
+        if (type(value) in (bytes, bytearray) and
+            len(value) >= BUFFER_MIN_SIZE):
+            if result is state:
+                result = state.copy()
+            result[name] = _OutOfBand(value)
+    return result
+
+
 class _PersistentUnpickler(Unpickler):
-    def __init__(self, fp, persistent_load):
-        Unpickler.__init__(self, fp)
+    def __init__(self, fp, persistent_load, buffers=None):
+        if buffers is None:
+            Unpickler.__init__(self, fp)
+        else:
+            Unpickler.__init__(self, fp, buffers=buffers)
         self.persistent_load = persistent_load
 
 
+class CompressionStats (object):
+    """
+    Counts the work done by ObjectWriters to compress state pickles.
+    """
+
+    def __init__(self):
+        self.compressed = 0 # number of states stored compressed
+        self.uncompressed = 0 # number of states stored uncompressed
+        self.bytes_saved = 0 # by the states stored compressed
+        self.compress_time = 0.0 # seconds, including rejected attempts
+
+    def __str__(self):
+        return ('%s compressed, %s uncompressed, %s bytes saved '
+                'in %.3f seconds' % (self.compressed, self.uncompressed,
+                                     self.bytes_saved, self.compress_time))
+
+
 class ObjectWriter (object):
     """
     Serializes objects for storage in the database.
@@ -81,18 +159,34 @@ class ObjectWriter (object):
     The client is responsible for calling the close() method to avoid
     leaking memory.  The ObjectWriter uses a Pickler internally, and
     Pickler objects do not participate in garbage collection.
+
+    The state pickle of an object is compressed if it is at least
+    COMPRESS_MIN_SIZE bytes long and compression makes it small enough.
+    A class can set the _p_compress attribute to True to have its states
+    always compressed, or to False to have them never compressed.
     """
 
-    def __init__(self, connection):
+    def __init__(self, connection, stats=None):
         self._setup_pickler()
         self.objects_found = []
         self.refs = set() # populated by _persistent_id()
         self.connection = connection
+        self.codec = get_codec(STATE_CODEC)
+        if stats is None:
+            stats = CompressionStats()
+        self.stats = stats
 
     def _setup_pickler(self):
         self.sio = BytesIO()
-        self.pickler = _PersistentPickler(self.sio, PICKLE_PROTOCOL,
-                                          self._persistent_id)
+        if PICKLE_PROTOCOL < 5:
+            self.buffers = None
+            self.pickler = _PersistentPickler(self.sio, PICKLE_PROTOCOL,
+                                              self._persistent_id)
+        else:
+            self.buffers = [] # populated with out-of-band PickleBuffers
+            self.pickler = _PersistentPickler(self.sio, PICKLE_PROTOCOL,
+                                              self._persistent_id,
+                                              self.buffers.append)
         self._num_bytes = 0 # number of bytes serialized by pickler
 
     def close(self):
@@ -119,9 +213,19 @@ class ObjectWriter (object):
         def once(obj):
             raise RuntimeError('gen_new_objects() already called.')
         self.gen_new_objects = once
-        yield obj # The modified object is also a "new" object.
-        for obj in self.objects_found:
-            yield obj
+        return self.gen_objects([obj])
+
+    def gen_objects(self, objects):
+        """(objects:[PersistentBase]) -> sequence [PersistentBase]
+        Generate each of the modified objects, followed by the new objects
+        found while getting its state.  This lets one ObjectWriter
+        serialize all of the changes of a transaction.
+        """
+        for obj in objects:
+            yield obj # The modified object is also a "new" object.
+            for new_obj in self.objects_found:
+                yield new_obj
+            del self.objects_found[:]
 
     def get_state(self, obj):
         if self._num_bytes > 20000:
@@ -131,22 +235,65 @@ class ObjectWriter (object):
             self.sio.seek(0) # recycle BytesIO instance
             self.sio.truncate()
             self.pickler.clear_memo()
-        self.pickler.dump(type(obj))
-        self.refs.clear()
-        position = self.sio.tell()
-        self.pickler.dump(obj.__getstate__())
-        uncompressed = self.sio.getvalue()
-        pickled_type = uncompressed[:position]
-        pickled_state = uncompressed[position:]
-        if WRITE_COMPRESSED_STATE_PICKLES:
-            state = compress(pickled_state)
+        if self.buffers is None:
+            self.pickler.dump(type(obj))
+            self.refs.clear()
+            position = self.sio.tell()
+            self.pickler.dump(obj.__getstate__())
+            uncompressed = self.sio.getvalue()
+            pickled_type = uncompressed[:position]
+            pickled_state = uncompressed[position:]
+            state = self._compress(pickled_state, type(obj))
+            data = pickled_type + state
         else:
-            state = pickled_state
-        data = pickled_type + state
+            data = self._get_data_with_buffers(obj)
         self._num_bytes += len(data)
         self.refs.discard(obj._p_oid)
         return data, join_bytes(sorted(self.refs))
 
+    def _get_data_with_buffers(self, obj):
+        """
+        The class is pickled with protocol 2, as always, so that
+        extract_class_name() works.  The state is a separate pickle.  It
+        follows BUFFERS_TAG and its own int4 length, and is followed by
+        the out-of-band buffers, each preceded by its int4 length.
+        """
+        del self.buffers[:]
+        self.refs.clear()
+        self.pickler.dump(_out_of_band(obj.__getstate__()))
+        state = self._compress(self.sio.getvalue(), type(obj))
+        segments = [dumps(type(obj), 2), BUFFERS_TAG,
+                    int4_to_str(len(state)), state]
+        for buffer in self.buffers:
+            raw = buffer.raw()
+            segments.append(int4_to_str(raw.nbytes))
+            segments.append(raw)
+        return join_bytes(segments)
+
+    def _compress(self, pickled_state, klass):
+        stats = self.stats
+        if WRITE_COMPRESSED_STATE_PICKLES:
+            override = getattr(klass, '_p_compress', None)
+        else:
+            override = False
+        if override is None:
+            adaptive = True
+            wanted = len(pickled_state) >= COMPRESS_MIN_SIZE
+        else:
+            adaptive = False
+            wanted = override
+        if wanted:
+            start = time.time()
+            state = self.codec.compress(pickled_state, klass)
+            stats.compress_time += time.time() - start
+            if (not adaptive or
+                len(state) <= len(pickled_state) * COMPRESS_MAX_RATIO):
+                stats.compressed += 1
+                stats.bytes_saved += len(pickled_state) - len(state)
+                return state
+        stats.uncompressed += 1
+        return pickled_state
+
 
 
 COMPRESSED_START_BYTE = compress(dumps({}, 2))[0]
@@ -156,14 +303,18 @@ class ObjectReader (object):
     def __init__(self, connection):
         self.connection = connection
         self.load_count = 0
+        # Idle (BytesIO, unpickler) pairs.  Loading a state can load
+        # another one, so get_state() takes a pair from here, or makes
+        # one, and puts it back when it is done.
+        self.unpicklers = []
 
-    def _get_unpickler(self, file):
+    def _get_unpickler(self, file, buffers=None):
         cache = self.connection.get_cache()
         # persistent_load() is called often so using 'partial' gives a small
         # performance boost
         load = functools.partial(persistent_load, self.connection,
                                  cache.objects)
-        unpickler = _PersistentUnpickler(file, load)
+        unpickler = _PersistentUnpickler(file, load, buffers)
         return unpickler
 
     def get_ghost(self, data):
@@ -174,25 +325,50 @@ class ObjectReader (object):
 
     def get_state(self, data, load=True):
         self.load_count += 1
-        s = BytesIO()
-        s.write(data)
-        s.seek(0)
-        unpickler = self._get_unpickler(s)
-        klass = unpickler.load()
-        position = s.tell()
-        if data[s.tell()] == COMPRESSED_START_BYTE:
-            # This is almost certainly a compressed pickle.
-            try:
-                decompressed = decompress(data[position:])
-            except zlib_error:
-                pass # let the unpickler try anyway.
-            else:
+        if self.unpicklers:
+            s, unpickler = self.unpicklers.pop()
+            s.seek(0)
+            s.truncate()
+        else:
+            s = BytesIO()
+            unpickler = self._get_unpickler(s)
+        try:
+            s.write(data)
+            s.seek(0)
+            klass = unpickler.load()
+            position = s.tell()
+            if data[position:position + 1] == BUFFERS_TAG:
+                return self._get_state_with_buffers(data, position, load)
+            decompressed = decompress_state(data, position)
+            if decompressed is not None:
                 s.write(decompressed)
                 s.seek(position)
-        if load:
-            return unpickler.load()
-        else:
-            return s.read()
+            if load:
+                return unpickler.load()
+            else:
+                return s.read()
+        finally:
+            unpickler.memo.clear()
+            self.unpicklers.append((s, unpickler))
+
+    def _get_state_with_buffers(self, data, position, load):
+        # See ObjectWriter._get_data_with_buffers().
+        start = position + 5
+        end = start + str_to_int4(data[position + 1:start])
+        pickled_state = data[start:end]
+        decompressed = decompress_state(pickled_state)
+        if decompressed is not None:
+            pickled_state = decompressed
+        if not load:
+            return pickled_state
+        view = memoryview(data)
+        buffers = []
+        while end < len(data):
+            start = end + 4
+            end = start + str_to_int4(data[end:start])
+            buffers.append(view[start:end])
+        unpickler = self._get_unpickler(BytesIO(pickled_state), buffers)
+        return unpickler.load()
 
     def get_state_pickle(self, data):
         return self.get_state(data, load=False)
@@ -2,10 +2,15 @@
 $URL$
 $Id$
 """
-from durus.file import File
+from durus.file import File, FileMap, WRITE_BUFFER_SIZE
 from durus.utils import int8_to_str, str_to_int8, read_int8_str, IntArray
-from durus.utils import iteritems, next, as_bytes
+from durus.utils import iteritems, next, as_bytes, join_bytes
 from durus.utils import read, read_int8, write, write_int8, ShortRead, xrange
+from durus.logger import log
+from array import array
+from struct import pack, unpack, iter_unpack
+from zlib import crc32
+import os
 import sys
 
 
@@ -59,11 +64,35 @@ class Shelf (object):
 
     After the initial construction of a Shelf is completed, all subsequent
     writing happens at the end of the file.
+
+    If the Shelf is opened with mmap=True, records and offset map entries
+    are read through a memory map of the file instead of with seek() and
+    read() calls.
+
+    A read-only Shelf opened with shared=True reads a file that another
+    process is still writing.  An incomplete transaction at the end of the
+    file is then taken to be one that is still being written, and it is
+    left for a later refresh().  Otherwise it is an error.
+
+    A Shelf kept in a named file can also write an index checkpoint to a
+    companion file (see write_checkpoint()); its owner does that when
+    is_checkpoint_due() says so, outside of store().  When the
+    Shelf is opened, a valid checkpoint provides the offsets of all records
+    in the transactions it covers, so only later transactions are read.
     """
     prefix = as_bytes("SHELF-1\n")
 
-    def __init__(self, file=None, items=None, repair=False, readonly=False):
-        """(File:str:None, [(str:str)], boolean)
+    checkpoint_prefix = as_bytes("SHELF-INDEX-1\n")
+
+    # A new checkpoint is due after this many bytes of transactions.
+    checkpoint_bytes = 1 << 26
+
+    # generate_shelf() fills in the offset map in blocks of this many oids.
+    offset_block_size = 1 << 16
+
+    def __init__(self, file=None, items=None, repair=False, readonly=False,
+                 mmap=False, shared=False):
+        """(File:str:None, [(str:str)], boolean, boolean, boolean, boolean)
         """
         if file is None:
             file = File()
@@ -71,6 +100,7 @@ class Shelf (object):
             assert not repair
         elif not hasattr(file, 'seek'):
             file = File(file, readonly=readonly)
+        assert readonly or not shared
         if not readonly:
             file.obtain_lock()
         file.seek(0, 2) # seek end
@@ -83,19 +113,29 @@ class Shelf (object):
         # The file is not empty.
         assert self.has_format(file)
         self.file = file
+        self.shared = shared
+        if mmap:
+            self.file_map = FileMap(self.file)
+        else:
+            self.file_map = None
         self.file.seek(len(self.prefix))
         n = read_int8(self.file) # bytes in first transaction
         self.file.seek(self.file.tell() + n)
-        self.offset_map = OffsetMap(self.file)
+        self.offset_map = OffsetMap(self.file, file_map=self.file_map)
         # Initialize the memory index.
+        self.transactions_start = self.file.tell()
         self.memory_index = {}
-        while True:
-            transaction_offsets = read_transaction_offsets(
-                self.file, repair=repair)
-            if transaction_offsets is None:
-                break
-            self.memory_index.update(transaction_offsets)
-        self.file.seek_end()
+        self.replaced_bytes = 0
+        checkpoint = self.read_checkpoint()
+        if checkpoint is None:
+            self.end = self.transactions_start
+        else:
+            self.end, index = checkpoint
+            self._add_replaced_bytes(index)
+            self.memory_index = index
+        checkpoint_position = self.end
+        self.refresh(repair=repair)
+        self.bytes_since_checkpoint = self.end - checkpoint_position
         self.unused_name_generator = None
 
     @classmethod
@@ -134,14 +174,35 @@ class Shelf (object):
             max_key = 0
             max_offset = 0
             n = 0
+            position = file.tell()
+            chunk = []
+            chunk_size = 0
+            # block number -> (array of oids in the block, array of positions)
+            blocks = {}
             for name, value in items:
-                max_key = max(max_key, str_to_int8(name))
-                max_offset = max(max_offset, file.tell())
-                write_int8(file, len(name) + len(value))
-                write(file, name)
-                write(file, value)
+                k = str_to_int8(name)
+                max_key = max(max_key, k)
+                max_offset = max(max_offset, position)
+                block = blocks.get(k // klass.offset_block_size)
+                if block is None:
+                    block = blocks[k // klass.offset_block_size] = (
+                        array('Q'), array('Q'))
+                block[0].append(k % klass.offset_block_size)
+                block[1].append(position)
+                record_length = len(name) + len(value)
+                chunk.append(int8_to_str(record_length))
+                chunk.append(as_bytes(name))
+                chunk.append(as_bytes(value))
+                position += 8 + record_length
+                chunk_size += 8 + record_length
+                if chunk_size >= WRITE_BUFFER_SIZE:
+                    write(file, join_bytes(chunk))
+                    chunk = []
+                    chunk_size = 0
                 n += 1
                 yield n
+            if chunk:
+                write(file, join_bytes(chunk))
             transaction_end = file.tell()
             # Write the correct transaction length.
             file.seek(transaction_start)
@@ -151,20 +212,46 @@ class Shelf (object):
             for step in OffsetMap.generate(file, max_key, max_offset):
                 yield step
             offset_map = OffsetMap(file)
-            # Now read through the records and record the offsets in the array.
-            file.seek(transaction_start + 8)
-            while file.tell() < transaction_end:
-                position = file.tell()
-                record_length = read_int8(file)
-                name = read(file, 8)
-                k = str_to_int8(name)
-                offset_map[k] = position
-                file.seek(position + 8 + record_length)
-                n -= 1
+            # Record the positions, noted as the records were written, in
+            # the array, one block at a time.
+            int_array = offset_map.int_array
+            for number in sorted(blocks):
+                start = number * klass.offset_block_size
+                values = int_array.read_block(
+                    start, min(start + klass.offset_block_size,
+                               len(int_array)))
+                for j, position in zip(*blocks.pop(number)):
+                    values[j] = position
+                    n -= 1
+                int_array.write_block(start, values)
                 yield n
         for index in offset_map.gen_stitch():
             yield index
 
+    def refresh(self, end=None, repair=False):
+        """(end:int=None, repair:bool=False)
+        Add the offsets of the records in transactions after self.end, up
+        to the given end position or to the end of the file, to the memory
+        index.  A Shelf opened with shared=True can use this to see
+        transactions written by another process, and then an incomplete
+        transaction at the end of the file is left for a later refresh().
+        """
+        self.file.seek(self.end)
+        while end is None or self.end < end:
+            try:
+                transaction_offsets = read_transaction_offsets(
+                    self.file, repair=repair)
+            except ShortRead:
+                if not self.shared:
+                    raise
+                break
+            if transaction_offsets is None:
+                break
+            self._add_replaced_bytes(transaction_offsets)
+            self.memory_index.update(transaction_offsets)
+            self.end = self.file.tell()
+        self.file.seek_end()
+
     def next_name(self):
         """() -> str
         Return the next element in a sequence of names.
@@ -195,30 +282,142 @@ class Shelf (object):
         """
         self.file.seek_end()
         start = self.file.tell()
-        write_int8(self.file, 0)
+        position = start + 8
+        chunk = []
         result = []
         index = {}
+        replaced_bytes = 0
+        for name, value in name_value_sequence:
+            old_position = self.get_position(name)
+            if (old_position is not None and
+                old_position < self.transactions_start and
+                name not in index):
+                replaced_bytes += 8 + self._get_record_length(old_position)
+            index[name] = position
+            result.append((name, old_position, position))
+            record_length = len(name) + len(value)
+            chunk.append(int8_to_str(record_length))
+            chunk.append(as_bytes(name))
+            chunk.append(as_bytes(value))
+            position += 8 + record_length
+        # The whole transaction goes to the file in a single write().
+        self.file.seek(start)
         try:
-            for name, value in name_value_sequence:
-                new_position = self.file.tell()
-                old_position = self.get_position(name)
-                index[name] = new_position
-                result.append((name, old_position, new_position))
-                write_int8(self.file, len(name) + len(value))
-                write(self.file, name)
-                write(self.file, value)
+            write(self.file, join_bytes(
+                [int8_to_str(position - start - 8)] + chunk))
+            if self.file.tell() != position:
+                raise IOError("short write: %s of %s bytes" % (
+                    self.file.tell() - start, position - start))
         except:
             # Revert before raising.
             self.file.seek(start)
             self.file.truncate()
             raise
-        end = self.file.tell()
-        self.file.seek(start)
-        write_int8(self.file, end - start - 8)
-        self.file.seek(end)
+        self.end = position
         self.memory_index.update(index)
+        self.replaced_bytes += replaced_bytes
+        self.bytes_since_checkpoint += position - start
         return result
 
+    def get_checkpoint_name(self):
+        """() -> str | None
+        Return the name of the file that holds the index checkpoint,
+        or None if this Shelf does not keep one.
+        """
+        if isinstance(self.file, File) and not self.file.is_temporary():
+            return self.file.get_name() + '.index'
+        return None
+
+    def _get_checkpoint_check(self, position):
+        # A checksum of the transaction data just before position.  This
+        # ties a checkpoint to the file it was written for.
+        start = max(self.transactions_start, position - 4096)
+        self.file.seek(start)
+        return crc32(read(self.file, position - start))
+
+    def write_checkpoint(self):
+        """
+        Save the memory index, and the file position that it covers,
+        in the checkpoint file.
+        The checkpoint file has the following parts:
+        1) a prefix string;
+        2) the position of the offset map;
+        3) the position of the end of the last transaction covered;
+        4) a checksum of the (up to 4096) bytes before that position;
+        5) the number of entries in the index;
+        6) the entries, each an 8 byte name followed by a position;
+        7) a checksum of parts 2 through 6.
+        Parts 2 through 5 are int8s; the checksums are crc32 values.
+        """
+        name = self.get_checkpoint_name()
+        if name is None or self.file.is_readonly():
+            return
+        self.file.seek_end()
+        position = self.file.tell()
+        chunk = [
+            pack('>QQQQ', self.offset_map.get_start(), position,
+                 self._get_checkpoint_check(position), len(self.memory_index))]
+        for item in iteritems(self.memory_index):
+            chunk.append(pack('>8sQ', *item))
+        data = join_bytes(chunk)
+        temporary_name = name + '.tmp'
+        checkpoint_file = open(temporary_name, 'wb')
+        try:
+            checkpoint_file.write(self.checkpoint_prefix)
+            checkpoint_file.write(data)
+            checkpoint_file.write(int8_to_str(crc32(data)))
+        finally:
+            checkpoint_file.close()
+        os.replace(temporary_name, name)
+        self.file.seek_end()
+        self.bytes_since_checkpoint = 0
+
+    def is_checkpoint_due(self):
+        """() -> bool
+        Have enough transactions been stored since the last checkpoint
+        that a new one should be written?
+        """
+        return self.bytes_since_checkpoint >= self.checkpoint_bytes
+
+    def remove_checkpoint(self):
+        """
+        Remove the checkpoint file, if there is one.
+        """
+        name = self.get_checkpoint_name()
+        if name is not None and os.path.exists(name):
+            os.remove(name)
+
+    def read_checkpoint(self):
+        """() -> (int, {str:int}) | None
+        Return the position covered by the checkpoint file and the index
+        that it holds.
+        Return None if there is no checkpoint, or if it is damaged or does
+        not match this file.
+        """
+        name = self.get_checkpoint_name()
+        if name is None or not os.path.exists(name):
+            return None
+        checkpoint_file = open(name, 'rb')
+        try:
+            data = checkpoint_file.read()
+        finally:
+            checkpoint_file.close()
+        prefix_length = len(self.checkpoint_prefix)
+        body = data[prefix_length:-8]
+        if (data[:prefix_length] != self.checkpoint_prefix or
+            len(body) < 32 or
+            crc32(body) != str_to_int8(data[-8:])):
+            log(20, 'Ignoring damaged checkpoint %s', name)
+            return None
+        start, position, check, count = unpack('>QQQQ', body[:32])
+        if (start != self.offset_map.get_start() or
+            not self.transactions_start <= position <= len(self.file) or
+            len(body) != 32 + 16 * count or
+            check != self._get_checkpoint_check(position)):
+            log(20, 'Ignoring checkpoint %s for a different file', name)
+            return None
+        return position, dict(iter_unpack('>8sQ', body[32:]))
+
     def get_position(self, name):
         """(str) -> int
         Return the position of the most recent value with this name.
@@ -228,17 +427,41 @@ class Shelf (object):
         p = self.memory_index.get(name, None)
         if p is not None:
             return p
-        current = self.file.tell()
-        result = self.offset_map.get(str_to_int8(name), None)
-        self.file.seek(current)
+        if self.file_map is None:
+            current = self.file.tell()
+            result = self.offset_map.get(str_to_int8(name), None)
+            self.file.seek(current)
+        else:
+            result = self.offset_map.get(str_to_int8(name), None)
         if result is None or result >= self.offset_map.get_start():
             return None
         else:
             return result
 
+    def _get_record_length(self, position):
+        if self.file_map is not None:
+            return str_to_int8(self.file_map.read(position, 8))
+        current = self.file.tell()
+        self.file.seek(position)
+        length = read_int8(self.file)
+        self.file.seek(current)
+        return length
+
+    def _add_replaced_bytes(self, names):
+        for name in names:
+            if name not in self.memory_index:
+                position = self.get_position(name)
+                if position is not None:
+                    self.replaced_bytes += 8 + self._get_record_length(
+                        position)
+
     def get_item_at_position(self, position):
         """(int) -> str, str
         """
+        if self.file_map is not None:
+            length = str_to_int8(self.file_map.read(position, 8))
+            return (self.file_map.read(position + 8, 8),
+                    self.file_map.read(position + 16, length - 8))
         self.file.seek(position)
         record = read_int8_str(self.file)
         return record[:8], record[8:]
@@ -279,10 +502,22 @@ class Shelf (object):
     def get_offset_map(self):
         return self.offset_map
 
+    def get_replaced_bytes(self):
+        """() -> int
+        Return the number of bytes in the records of the initial
+        transaction that have been replaced by records in later ones.
+        """
+        return self.replaced_bytes
+
     def get_file(self):
         return self.file
 
+    def is_mapped(self):
+        return self.file_map is not None
+
     def close(self):
+        if self.file_map is not None:
+            self.file_map.close()
         self.file.close()
 
 
@@ -334,7 +569,7 @@ class OffsetMap (object):
     this class gives us a way to iterate over the holes, so that they
     can be allocated when oids are needed for new objects.
     """
-    def __init__(self, file, max_oid=-2, max_offset=0):
+    def __init__(self, file, max_oid=-2, max_offset=0, file_map=None):
         self.start = file.tell()
         file.seek(0, 2)
         if file.tell() == self.start:
@@ -342,6 +577,7 @@ class OffsetMap (object):
                 pass
         file.seek(self.start)
         self.int_array = IntArray(file=file)
+        self.file_map = file_map
 
     @staticmethod
     def generate(file, max_oid=-2, max_offset=0):
@@ -356,7 +592,10 @@ class OffsetMap (object):
         return self.start
 
     def get(self, j, default=None):
-        result = self.int_array.get(j, default=None)
+        if self.file_map is None:
+            result = self.int_array.get(j, default=None)
+        else:
+            result = self.int_array.get_from_map(self.file_map, j)
         if result is None or result >= self.start:
             return default
         else:
@@ -383,7 +622,7 @@ class OffsetMap (object):
                 yield j
 
     def iteritems(self):
-        for j, number in enumerate(self.int_array):
+        for j, number in iteritems(self.int_array):
             if number < self.start:
                 yield j, number
 
@@ -402,23 +641,36 @@ class OffsetMap (object):
         Each value is the index of the next hole plus self.start.
         The offset is added so that we can distinguish ordinary offsets,
         which are less than self.start, from elements of this linked list.
+        The array is read, updated, and written back a block at a time.
         """
         last_index = len(self.int_array) - 1
-        for index in xrange(0, len(self.int_array)):
-            if self.get(index) is None:
-                self.int_array[index] = last_index + self.start
-                last_index = index
-            yield index
-
-    def gen_holes(self):
+        for block_start, block in self.int_array.gen_blocks():
+            changed = False
+            for k, number in enumerate(block):
+                if number >= self.start: # This is a hole.
+                    block[k] = last_index + self.start
+                    last_index = block_start + k
+                    changed = True
+            if changed:
+                self.int_array.write_block(block_start, block)
+            for index in xrange(block_start, block_start + len(block)):
+                yield index
+
+    def gen_holes(self, block_size=4096):
         """Generate the sequence of holes."""
         last_index = len(self.int_array) - 1
         if last_index >= 0:
+            # Follow the linked list, reading the array a block at a time.
+            block_start = 0
+            block = []
             j = last_index
             while True:
-                new_j = self.int_array[j] - self.start
+                if not block_start <= j < block_start + len(block):
+                    block_start = j - j % block_size
+                    block = self.int_array.read_block(block_start,
+                        min(block_start + block_size, last_index + 1))
+                new_j = block[j - block_start] - self.start
                 yield new_j
                 if new_j == last_index:
                     break
                 j = new_j
-
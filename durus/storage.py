@@ -7,6 +7,12 @@ from durus.serialize import unpack_record, split_oids, extract_class_name
 from durus.utils import int8_to_str
 import durus.connection
 
+# When a storage calls fsync() on the data it writes in end().
+FSYNC_NONE = 'none' # never
+FSYNC_PER_COMMIT = 'per-commit' # in every end()
+FSYNC_GROUP = 'group' # in fsync(), called after a group of commits
+FSYNC_POLICIES = (FSYNC_NONE, FSYNC_PER_COMMIT, FSYNC_GROUP)
+
 class Storage (object):
     """
     This is the interface that Connection requires for Storage.
@@ -50,6 +56,12 @@ class Storage (object):
         """
         raise NotImplementedError
 
+    def fsync(self):
+        """
+        Make the commits concluded by end() durable, if end() has not.
+        Used by StorageServer to acknowledge a group of commits together.
+        """
+
     def close(self):
         """Clean up as needed.
         """
@@ -62,6 +74,15 @@ class Storage (object):
         """
         return None
 
+    def get_collector(self):
+        """
+        Return an incremental garbage collector (a generator), or None.
+        Used by StorageServer for the collections that gcbytes triggers.
+        Storages that can collect some of the garbage at less cost than a
+        pack can override this.
+        """
+        return self.get_packer()
+
     def pack(self):
         """If this storage supports it, remove obsolete records."""
         return None
@@ -6,12 +6,13 @@ from datetime import datetime
 from durus.error import ReadConflictError, ConflictError
 from durus.logger import log, is_logging
 from durus.serialize import extract_class_name, split_oids
+from durus.storage import FSYNC_GROUP
 from durus.utils import int4_to_str, str_to_int4, str_to_int8, read, write
 from durus.utils import read_int4, read_int4_str, write_int4_str
 from durus.utils import join_bytes, write_all, next, as_bytes
 from durus.systemd_socket import get_systemd_socket
 from os.path import exists
-from time import sleep
+from time import sleep, time
 import errno
 import select
 import socket
@@ -28,10 +29,15 @@ STATUS_OKAY = as_bytes('O')
 STATUS_KEYERROR = as_bytes('K')
 STATUS_INVALID = as_bytes('I')
 
+PROTOCOL_1 = int4_to_str(1)
+# Protocol 2 adds the 'F' command for pipelined, tagged bulk loads.
+PROTOCOL_2 = int4_to_str(2)
+
 TIMEOUT = 10
 DEFAULT_HOST = '127.0.0.1'
 DEFAULT_PORT = 2972
 DEFAULT_GCBYTES = 0
+DEFAULT_COMMIT_WINDOW = 0.0
 
 class _Client (object):
 
@@ -40,6 +46,7 @@ class _Client (object):
         self.addr = addr
         self.invalid = set()
         self.unused_oids = set()
+        self.protocol = PROTOCOL_1
 
 class ClientError(Exception):
     pass
@@ -242,10 +249,19 @@ class InheritedSocket(SocketAddress):
 
 class StorageServer (object):
 
-    protocol = int4_to_str(1)
+    protocol = PROTOCOL_2
+    supported_protocols = (PROTOCOL_1, PROTOCOL_2)
 
     def __init__(self, storage, host=DEFAULT_HOST, port=DEFAULT_PORT, 
-        address=None, gcbytes=DEFAULT_GCBYTES):
+        address=None, gcbytes=DEFAULT_GCBYTES,
+        commit_window=DEFAULT_COMMIT_WINDOW):
+        """
+        If the storage has the FSYNC_GROUP policy, commits are acknowledged
+        in groups, after one call to the storage's fsync().  A group holds
+        the commits that arrive within commit_window seconds of the first.
+        Other clients are told of the changes of a group after the fsync.
+        A load of a changed record before that finishes the group early.
+        """
         self.storage = storage
         self.clients = []
         self.sockets = []
@@ -255,6 +271,14 @@ class StorageServer (object):
         self.bytes_since_pack = 0
         self.gcbytes = gcbytes # Trigger a pack after this many bytes.
         assert isinstance(gcbytes, (int, float))
+        self.group_commit = (hasattr(storage, 'get_fsync_policy') and
+                             storage.get_fsync_policy() == FSYNC_GROUP)
+        self.commit_window = commit_window
+        self.commit_acks = [] # sockets waiting for STATUS_OKAY
+        self.commit_acks_due = None
+        # The invalidations of commits waiting for the fsync, and their oids.
+        self.commit_invalidations = [] # [(committer:_Client, [oid:str])]
+        self.commit_oids = set()
 
     def serve(self):
         sock = get_systemd_socket()
@@ -268,6 +292,8 @@ class StorageServer (object):
             while 1:
                 if self.packer is not None:
                     timeout = 0.0
+                elif self.commit_acks:
+                    timeout = max(0.0, self.commit_acks_due - time())
                 else:
                     timeout = None
                 r, w, e = select.select(self.sockets, [], [], timeout)
@@ -289,23 +315,31 @@ class StorageServer (object):
                             self.sockets.remove(s)
                             self.clients.remove(self._find_client(s))
                             s.close()
-                if (self.packer is None and
-                    0 < self.gcbytes <= self.bytes_since_pack):
-                    self.packer = self.storage.get_packer()
-                    if self.packer is not None:
-                        log(20, 'gc started at %s' % datetime.now())
+                if self.commit_acks and time() >= self.commit_acks_due:
+                    self._send_commit_acks()
+                self._start_gc_if_due()
                 if not r and self.packer is not None:
-                    try:
-                        pack_step = next(self.packer)
-                        if isinstance(pack_step, str):
-                            log(15, 'gc ' + pack_step)
-                    except StopIteration:
-                        log(20, 'gc at %s' % datetime.now())
-                        self.packer = None # done packing
-                        self.bytes_since_pack = 0 # reset
+                    self._pack_step()
         finally:
             self.address.close(sock)
 
+    def _start_gc_if_due(self):
+        if (self.packer is None and
+            0 < self.gcbytes <= self.bytes_since_pack):
+            self.packer = self.storage.get_collector()
+            if self.packer is not None:
+                log(20, 'gc started at %s' % datetime.now())
+
+    def _pack_step(self):
+        try:
+            pack_step = next(self.packer)
+            if isinstance(pack_step, str):
+                log(15, 'gc ' + pack_step)
+        except StopIteration:
+            log(20, 'gc at %s' % datetime.now())
+            self.packer = None # done packing
+            self.bytes_since_pack = 0 # reset
+
     def handle(self, s):
         command_byte = read(s, 1)[0]
         if type(command_byte) is int:
@@ -349,41 +383,59 @@ class StorageServer (object):
     def handle_L(self, s):
         # load
         oid = read(s, 8)
-        self._send_load_response(s, oid)
+        self._send_load_responses(s, as_bytes(''), [oid])
 
-    def _send_load_response(self, s, oid):
-        if oid in self._find_client(s).invalid:
-            write(s, STATUS_INVALID)
+    def _send_load_responses(self, s, prefix, oids):
+        self._complete_commits_of(oids)
+        client = self._find_client(s)
+        write(s, join_bytes(
+            [prefix] + [self._get_load_response(client, oid) for oid in oids]))
+
+    def _get_load_response(self, client, oid):
+        if oid in client.invalid:
+            return STATUS_INVALID
+        return self._load_response(oid)
+
+    def _load_response(self, oid):
+        try:
+            record = self.storage.load(oid)
+        except KeyError:
+            log(10, 'KeyError %s', str_to_int8(oid))
+            return STATUS_KEYERROR
+        except ReadConflictError:
+            log(10, 'ReadConflictError %s', str_to_int8(oid))
+            return STATUS_INVALID
         else:
-            try:
-                record = self.storage.load(oid)
-            except KeyError:
-                log(10, 'KeyError %s', str_to_int8(oid))
-                write(s, STATUS_KEYERROR)
-            except ReadConflictError:
-                log(10, 'ReadConflictError %s', str_to_int8(oid))
-                write(s, STATUS_INVALID)
-            else:
-                if is_logging(5):
-                    class_name = extract_class_name(record)
-                    if class_name in self.load_record:
-                        self.load_record[class_name] += 1
-                    else:
-                        self.load_record[class_name] = 1
-                    log(4, 'Load %-7s %s', str_to_int8(oid), class_name)
-                write(s, STATUS_OKAY)
-                write_int4_str(s, record)
+            if is_logging(5):
+                class_name = extract_class_name(record)
+                if class_name in self.load_record:
+                    self.load_record[class_name] += 1
+                else:
+                    self.load_record[class_name] = 1
+                log(4, 'Load %-7s %s', str_to_int8(oid), class_name)
+            return join_bytes([STATUS_OKAY, int4_to_str(len(record)), record])
 
     def handle_C(self, s):
         # commit
+        self._send_commit_invalidations(s)
+        self._commit(s, read_int4_str(s))
+
+    def _send_commit_invalidations(self, s):
         self._sync_storage()
         client = self._find_client(s)
-        write_all(s,
-            int4_to_str(len(client.invalid)), join_bytes(client.invalid))
+        # A commit must conflict with the commits still waiting for the
+        # fsync, too.  Its own acknowledgement waits for the same fsync.
+        invalid = set(client.invalid)
+        for committer, oids in self.commit_invalidations:
+            if committer is not client:
+                invalid.update(oids)
+        write_all(s, int4_to_str(len(invalid)), join_bytes(invalid))
         client.invalid.clear()
-        tdata = read_int4_str(s)
+
+    def _commit(self, s, tdata):
         if len(tdata) == 0:
             return # client decided not to commit (e.g. conflict)
+        client = self._find_client(s)
         logging_debug = is_logging(10)
         logging_debug and log(10, 'Committing %s bytes', len(tdata))
         self.storage.begin()
@@ -416,13 +468,53 @@ class StorageServer (object):
             self._report_load_record()
             log(20, 'Committed %3s objects %s bytes at %s',
                 len(oids), len(tdata), datetime.now())
-            write(s, STATUS_OKAY)
             client.unused_oids -= oid_set
-            for c in self.clients:
-                if c is not client:
-                    c.invalid.update(oids)
+            if self.group_commit:
+                # Other clients hear of the commit after the fsync.
+                self.commit_invalidations.append((client, oids))
+                self.commit_oids.update(oids)
+            else:
+                self._invalidate(client, oids)
+            self._acknowledge_commit(s)
             self.bytes_since_pack += len(tdata) + 8
 
+    def _invalidate(self, committer, oids):
+        for c in self.clients:
+            if c is not committer:
+                c.invalid.update(oids)
+
+    def _acknowledge_commit(self, s):
+        if not self.group_commit:
+            write(s, STATUS_OKAY)
+            return
+        if not self.commit_acks:
+            self.commit_acks_due = time() + self.commit_window
+        self.commit_acks.append(s)
+
+    def _complete_commits_of(self, oids):
+        """(oids:[str])
+        If any of the oids belongs to a commit that is waiting for the
+        fsync, finish the group now, so that the records of that commit
+        are on the disk, and invalid for other clients, before they can
+        be loaded.
+        """
+        if self.commit_oids and not self.commit_oids.isdisjoint(oids):
+            self._send_commit_acks()
+
+    def _send_commit_acks(self):
+        self.storage.fsync()
+        for committer, oids in self.commit_invalidations:
+            self._invalidate(committer, oids)
+        self.commit_invalidations = []
+        self.commit_oids.clear()
+        log(10, 'Group commit of %s', len(self.commit_acks))
+        for s in self.commit_acks:
+            try:
+                write(s, STATUS_OKAY)
+            except (socket.error, IOError):
+                pass # The client is dropped when it is next read.
+        self.commit_acks = []
+
     def _report_load_record(self):
         if self.load_record and is_logging(5):
             log(5, '[%s]\n' % getpid() + '\n'.join(
@@ -463,23 +555,39 @@ class StorageServer (object):
         # bulk read of objects
         number_of_oids = read_int4(s)
         oid_str = read(s, 8 * number_of_oids)
-        oids = split_oids(oid_str)
-        for oid in oids:
-            self._send_load_response(s, oid)
+        self._send_load_responses(s, as_bytes(''), split_oids(oid_str))
+
+    def handle_F(self, s):
+        # tagged bulk read of objects (protocol 2)
+        # The request id is echoed ahead of the load responses so that a
+        # client with several requests in flight can match them up.
+        if self._find_client(s).protocol < PROTOCOL_2:
+            raise ClientError('F requires protocol 2')
+        request_id = read(s, 4)
+        number_of_oids = read_int4(s)
+        oids = split_oids(read(s, 8 * number_of_oids))
+        self._send_load_responses(s, request_id, oids)
 
     def handle_Q(self, s):
         # graceful quit
         log(20, 'Quit')
+        if self.commit_acks:
+            self._send_commit_acks()
         self.storage.close()
         raise SystemExit
 
     def handle_V(self, s):
-        # Verify protocol version match.
+        # Negotiate the protocol version.
+        # A supported client protocol is echoed back and used from now on.
+        # Otherwise, our preferred protocol is sent and the client dropped.
         client_protocol = read(s, 4)
         log(10, 'Client Protocol: %s', str_to_int4(client_protocol))
         assert len(self.protocol) == 4
-        write(s, self.protocol)
-        if client_protocol != self.protocol:
+        if client_protocol in self.supported_protocols:
+            write(s, client_protocol)
+            self._find_client(s).protocol = client_protocol
+        else:
+            write(s, self.protocol)
             raise ClientError("Protocol not supported.")
 
 def wait_for_server(host=DEFAULT_HOST, port=DEFAULT_PORT, maxtries=300,
@@ -5,7 +5,9 @@ $Id$
 In Durus names, 'int4' is an unsigned 32-bit whole number,
 and 'int8' is an unsigned 64-bit whole number.
 """
+from array import array
 from struct import pack, unpack
+import re
 import sys
 
 def str_to_int8(s):
@@ -428,6 +430,44 @@ class WordArray (object):
     def get_bytes_per_word(self):
         return self.bytes_per_word
 
+    def get_start(self):
+        """() -> int
+        Return the position in the file of the first word.
+        """
+        return self.byte_array.start
+
+
+def decode_words(data, bytes_per_word):
+    """(data:str, bytes_per_word:int) -> array
+    Decode a packed sequence of big-endian unsigned words, each
+    bytes_per_word long, into an array of int8 values.
+    The work is done by slice assignments, not a Python loop over words.
+    """
+    number_of_words = len(data) // bytes_per_word
+    padded = bytearray(8 * number_of_words)
+    pad = 8 - bytes_per_word
+    for k in xrange(bytes_per_word):
+        padded[pad + k::8] = data[k::bytes_per_word]
+    result = array('Q')
+    result.frombytes(bytes(padded))
+    if sys.byteorder == 'little':
+        result.byteswap()
+    return result
+
+def encode_words(values, bytes_per_word):
+    """(values:array, bytes_per_word:int) -> str
+    The inverse of decode_words().
+    """
+    values = array('Q', values)
+    if sys.byteorder == 'little':
+        values.byteswap()
+    padded = values.tobytes()
+    data = bytearray(bytes_per_word * len(values))
+    pad = 8 - bytes_per_word
+    for k in xrange(bytes_per_word):
+        data[k::bytes_per_word] = padded[pad + k::8]
+    return bytes(data)
+
 
 class IntArray (object):
     """
@@ -482,6 +522,23 @@ class IntArray (object):
         else:
             return str_to_int8(self.pad + self.word_array[j])
 
+    def get_from_map(self, file_map, j, default=None):
+        """(file_map:durus.file.FileMap, j:int, default=None)
+        Like get(), but the word is decoded from a view of file_map instead
+        of being read from self.file.
+        """
+        if j < 0:
+            j += len(self.word_array)
+        if not 0 <= j < len(self.word_array):
+            return default
+        bytes_per_word = self.word_array.get_bytes_per_word()
+        word = file_map.view(
+            self.word_array.get_start() + j * bytes_per_word, bytes_per_word)
+        if word == self.blank:
+            return default
+        else:
+            return int.from_bytes(word, 'big')
+
     def __getitem__(self, j):
         return str_to_int8(self.pad + self.word_array[j])
 
@@ -492,14 +549,56 @@ class IntArray (object):
         word = s[len(self.pad):]
         self.word_array[j] = word
 
+    def read_block(self, start, stop):
+        """(start:int, stop:int) -> array
+        Return the integers at positions start through stop - 1.
+        They are read with one call and decoded in bulk.
+        """
+        if not 0 <= start <= stop <= len(self):
+            raise IndexError((start, stop))
+        if start == stop:
+            return array('Q')
+        bytes_per_word = self.word_array.get_bytes_per_word()
+        data = self.word_array.byte_array[
+            start * bytes_per_word:stop * bytes_per_word]
+        return decode_words(data, bytes_per_word)
+
+    def write_block(self, start, values):
+        """(start:int, values:array)
+        Store the values at positions start through start + len(values) - 1
+        with one write.
+        """
+        if not 0 <= start <= start + len(values) <= len(self):
+            raise IndexError((start, len(values)))
+        if not values:
+            return
+        if max(values) >= 1 << (8 * self.word_array.get_bytes_per_word()):
+            raise ValueError
+        bytes_per_word = self.word_array.get_bytes_per_word()
+        self.word_array.byte_array[
+            start * bytes_per_word:(start + len(values)) * bytes_per_word] = (
+            encode_words(values, bytes_per_word))
+
+    def gen_blocks(self, block_size=65536):
+        """(block_size:int=65536) -> sequence((start:int, array))
+        Generate the contents of the array, in order, as blocks of at most
+        block_size decoded integers.
+        """
+        for start in xrange(0, len(self), block_size):
+            yield start, self.read_block(
+                start, min(start + block_size, len(self)))
+
     def __iter__(self):
-        for word in self.word_array:
-            yield str_to_int8(self.pad + word)
+        for start, block in self.gen_blocks():
+            for number in block:
+                yield number
 
     def iteritems(self):
-        for j, word in enumerate(self.word_array):
-            if not word == self.blank:
-                yield j, str_to_int8(self.pad + word)
+        blank = self.get_blank_value()
+        for start, block in self.gen_blocks():
+            for j, number in enumerate(block, start):
+                if number != blank:
+                    yield j, number
 
     items = iteritems
 
@@ -532,3 +631,60 @@ class IntSet (object):
     def discard(self, n):
         if n < self.bit_array.get_size():
             self.bit_array[n] = 0
+
+
+_NONZERO_BYTE = re.compile(as_bytes('[^\x00]'))
+
+class Bitmap (object):
+    """
+    A set of non-negative integers held as the bits of a bytearray.
+    Like IntSet, but much faster, since it does not go through a file.
+    The bytes can be sent to another process and merged there with
+    update().
+    """
+    def __init__(self, bits=None):
+        if bits is None:
+            self.bits = bytearray()
+        else:
+            self.bits = bytearray(bits)
+
+    def add(self, n):
+        bits = self.bits
+        q = n >> 3
+        if q >= len(bits):
+            bits.extend(bytearray(max(q + 1 - len(bits), len(bits) >> 2)))
+        bits[q] |= 1 << (n & 7)
+
+    def __contains__(self, n):
+        q = n >> 3
+        return q < len(self.bits) and (self.bits[q] >> (n & 7)) & 1 == 1
+
+    def discard(self, n):
+        q = n >> 3
+        if q < len(self.bits):
+            self.bits[q] &= ~(1 << (n & 7)) & 0xff
+
+    def update(self, other):
+        """(other:Bitmap|str)
+        Add the members of other, or of a Bitmap with the bytes other.
+        """
+        bits = getattr(other, 'bits', other)
+        n = len(bits)
+        if n > len(self.bits):
+            self.bits.extend(bytearray(n - len(self.bits)))
+        merged = (int.from_bytes(bytes(self.bits[:n]), 'little') |
+                  int.from_bytes(bytes(bits), 'little'))
+        self.bits[:n] = merged.to_bytes(n, 'little')
+
+    def __iter__(self):
+        """Generate the members in increasing order."""
+        bits = self.bits
+        for match in _NONZERO_BYTE.finditer(bits):
+            q = match.start()
+            byte = bits[q]
+            for r in range(8):
+                if (byte >> r) & 1:
+                    yield (q << 3) | r
+
+    def __len__(self):
+        return bin(int.from_bytes(bytes(self.bits), 'little')).count('1')
@@ -16,7 +16,9 @@ if IS_PYPY:
 else:
     persistent = Extension(name="durus._persistent",
                           sources=["durus/_persistent.c"])
-    ext_modules = [persistent]
+    serialize = Extension(name="durus._serialize",
+                          sources=["durus/_serialize.c"])
+    ext_modules = [persistent, serialize]
 
 setup(name = "Durus",
       version = __version__,
@@ -33,6 +35,7 @@ setup(name = "Durus",
       author_email = "nas-durus@arctrix.com",
       url = "https://github.com/nascheme/durus",
       ext_modules = ext_modules,
+      extras_require = {'lz4': ['lz4'], 'zstd': ['zstandard']},
       license = "see LICENSE.txt",
       zip_safe=False,
       )
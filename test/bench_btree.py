@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""Measure BTree lookups, range scans, inserts, batched inserts and bulk
+loads for each BNode class.
+"""
+import random
+import sys
+import time
+from optparse import OptionParser
+from durus.btree import BTree, BNode
+
+
+def get_node_classes():
+    return [BNode] + sorted(BNode.__subclasses__(),
+                            key=lambda klass: klass.minimum_degree)
+
+
+def bench(node_class, keys, ranges):
+    result = {}
+    tree = BTree(node_constructor=node_class)
+    start = time.time()
+    for key in keys:
+        tree[key] = key
+    result['insert'] = time.time() - start
+    start = time.time()
+    for key in keys:
+        tree[key]
+    result['getitem'] = time.time() - start
+    start = time.time()
+    for low in ranges:
+        for item in tree.items_range(low, low + 100):
+            pass
+    result['items_range'] = time.time() - start
+    items = sorted(tree.items())
+    start = time.time()
+    BTree.from_sorted(items, node_constructor=node_class)
+    result['from_sorted'] = time.time() - start
+    tree = BTree(node_constructor=node_class)
+    start = time.time()
+    for j in range(0, len(keys), 1000):
+        tree.insert_many((key, key) for key in keys[j:j + 1000])
+    result['insert_many'] = time.time() - start
+    return result
+
+
+def main():
+    parser = OptionParser()
+    parser.set_description('Measure BTree operations by node class.')
+    parser.add_option('--keys', dest='keys', default=100000, type='int',
+                      help='Number of keys. (default=100000)')
+    parser.add_option('--ranges', dest='ranges', default=2000, type='int',
+                      help='Number of 100 key ranges to scan. (default=2000)')
+    (options, args) = parser.parse_args()
+    random.seed(1)
+    keys = list(range(options.keys))
+    random.shuffle(keys)
+    ranges = [random.randrange(options.keys) for j in range(options.ranges)]
+    sys.stdout.write('%10s %12s %12s %12s %12s %12s\n' % (
+        'node', 'insert us', 'getitem us', 'range ms', 'load us',
+        'many us'))
+    for node_class in get_node_classes():
+        result = bench(node_class, keys, ranges)
+        sys.stdout.write('%10s %12.2f %12.2f %12.3f %12.2f %12.2f\n' % (
+            node_class.__name__,
+            1e6 * result['insert'] / len(keys),
+            1e6 * result['getitem'] / len(keys),
+            1e3 * result['items_range'] / len(ranges),
+            1e6 * result['from_sorted'] / len(keys),
+            1e6 * result['insert_many'] / len(keys)))
+
+if __name__ == '__main__':
+    main()
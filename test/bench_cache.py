@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""Measure the cost of shrinking a full Connection cache at various sizes.
+"""
+import sys
+import time
+from optparse import OptionParser
+from durus.connection import Connection
+from durus.logger import logger
+from durus.persistent import Persistent
+from durus.storage import MemoryStorage
+from durus.utils import int8_to_str
+
+
+class Item (Persistent):
+    pass
+
+
+def touch(connection, first, count):
+    cache = connection.get_cache()
+    for j in range(first, first + count):
+        obj = cache.get_instance(int8_to_str(j), Item, connection)
+        obj._p_set_status_saved()
+        connection.note_access(obj)
+
+
+def bench(size, per_transaction, transactions):
+    connection = Connection(MemoryStorage(), cache_size=size)
+    start = time.time()
+    touch(connection, 1, size)
+    connection.abort()
+    fill = time.time() - start
+    start = time.time()
+    for t in range(transactions):
+        touch(connection, 1 + size + t * per_transaction, per_transaction)
+        connection.abort() # shrinks the cache
+    elapsed = time.time() - start
+    assert connection.get_cache_count() <= size + per_transaction
+    return fill, elapsed
+
+
+def main():
+    parser = OptionParser()
+    parser.set_description('Measure Connection cache shrink cost.')
+    parser.add_option('--objects', dest='objects', default=1000, type='int',
+                      help='Objects loaded per transaction. (default=1000)')
+    parser.add_option('--transactions', dest='transactions', default=100,
+                      type='int', help='Transactions per size. (default=100)')
+    parser.add_option('--sizes', dest='sizes',
+                      default='100000,1000000,5000000',
+                      help='Cache sizes. (default=100000,1000000,5000000)')
+    (options, args) = parser.parse_args()
+    logger.setLevel(30)
+    for size in [int(x) for x in options.sizes.split(',')]:
+        fill, elapsed = bench(size, options.objects, options.transactions)
+        sys.stdout.write(
+            '%8s objects: fill %6.1fs %8.3f ms/transaction\n' % (
+            size, fill, 1000 * elapsed / options.transactions))
+
+if __name__ == '__main__':
+    main()
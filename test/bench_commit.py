@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+"""Measure commit throughput of a FileStorage for various transaction sizes.
+"""
+import sys
+import time
+from optparse import OptionParser
+from durus.connection import Connection
+from durus.file_storage import TempFileStorage
+from durus.logger import logger
+from durus.persistent import Persistent
+
+
+class Item (Persistent):
+    def __init__(self, n):
+        self.n = n
+        self.data = 'x' * 100
+
+
+def bench(objects_per_transaction, transactions):
+    connection = Connection(TempFileStorage())
+    root = connection.get_root()
+    items = [Item(j) for j in range(objects_per_transaction)]
+    root['items'] = items
+    connection.commit()
+    start = time.time()
+    for t in range(transactions):
+        for item in items:
+            item.n += 1
+        connection.commit()
+    elapsed = time.time() - start
+    connection.get_storage().close()
+    return elapsed
+
+
+def main():
+    parser = OptionParser()
+    parser.set_description('Measure FileStorage commit throughput.')
+    parser.add_option('--objects', dest='objects', default=10000, type='int',
+                      help='Total objects committed per size. (default=10000)')
+    (options, args) = parser.parse_args()
+    logger.setLevel(30)
+    for size in (1, 100, 10000):
+        transactions = max(1, options.objects // size)
+        elapsed = bench(size, transactions)
+        sys.stdout.write(
+            '%6s objects/transaction: %8.1f commits/s %10.1f objects/s\n' % (
+            size, transactions / elapsed, transactions * size / elapsed))
+
+if __name__ == '__main__':
+    main()
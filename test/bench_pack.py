@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""Measure the time to pack a FileStorage, in this process and with
+worker processes.
+"""
+import os
+import sys
+import time
+from optparse import OptionParser
+from durus.connection import Connection
+from durus.file import File
+from durus.file_storage import FileStorage
+from durus.logger import logger
+from durus.persistent import Persistent
+from durus.persistent_list import PersistentList
+
+
+class Item (Persistent):
+
+    def __init__(self, n):
+        self.n = n
+        self.name = 'item %s' % n
+
+
+def make_file(count, per_commit):
+    file = File(prefix='bench_pack')
+    name = file.get_name()
+    file.close()
+    connection = Connection(FileStorage(name), cache_size=per_commit * 2)
+    root = connection.get_root()
+    for j in range(0, count, per_commit):
+        root[j] = PersistentList(
+            [Item(n) for n in range(j, min(count, j + per_commit))])
+        connection.commit()
+        connection.shrink_cache()
+    connection.get_storage().close()
+    return name
+
+
+def bench(name, workers):
+    storage = FileStorage(name, pack_workers=workers)
+    start = time.time()
+    storage.pack()
+    elapsed = time.time() - start
+    storage.close()
+    os.unlink(name + '.prepack')
+    return elapsed
+
+
+def main():
+    parser = OptionParser()
+    parser.set_description('Measure pack time.')
+    parser.add_option('--objects', dest='objects', default=200000,
+                      type='int', help='Number of objects. (default=200000)')
+    parser.add_option('--per-commit', dest='per_commit', default=1000,
+                      type='int', help='Objects per commit. (default=1000)')
+    parser.add_option('--workers', dest='workers', default='0,2,4',
+                      help='Comma separated worker counts. (default=0,2,4)')
+    (options, args) = parser.parse_args()
+    logger.setLevel(30)
+    name = make_file(options.objects, options.per_commit)
+    try:
+        for workers in options.workers.split(','):
+            elapsed = bench(name, int(workers))
+            sys.stdout.write('%2s workers: %8.0f records/s\n' % (
+                workers, options.objects / elapsed))
+    finally:
+        os.unlink(name)
+
+if __name__ == '__main__':
+    main()
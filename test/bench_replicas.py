@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""Measure the load throughput of a server with and without read replicas.
+
+Several client processes make bulk loads of random records at once, for a
+fixed time, from a server started with --readers=0 and then with the
+given number of readers.  A gain needs as many free cores as readers.
+"""
+import os
+import sys
+import time
+from durus import __main__
+from durus.client_storage import ClientStorage
+from durus.connection import Connection
+from durus.file_storage import FileStorage
+from durus.logger import logger
+from durus.persistent import Persistent
+from durus.storage_server import wait_for_server
+from optparse import OptionParser
+from random import Random
+from subprocess import Popen
+from tempfile import mktemp
+
+
+class Item (Persistent):
+    def __init__(self, n, size):
+        self.n = n
+        self.data = 'x' * size
+
+
+def make_file(filename, objects, size):
+    connection = Connection(FileStorage(filename))
+    root = connection.get_root()
+    root['items'] = [Item(j, size) for j in range(objects)]
+    connection.commit()
+    oids = [item._p_oid for item in root['items']]
+    connection.get_storage().close()
+    return oids
+
+
+def client(address, oids, batch, seconds, seed, output):
+    storage = ClientStorage(address=address)
+    random = Random(seed)
+    records = 0
+    stop = time.time() + seconds
+    while time.time() < stop:
+        for record in storage.bulk_load(random.sample(oids, batch)):
+            records += 1
+    storage.close()
+    os.write(output, ('%d\n' % records).encode())
+
+
+def bench(filename, readers, clients, oids, batch, seconds):
+    address = mktemp()
+    cmd = [sys.executable, __main__.__file__, '-s', '--file=%s' % filename,
+           '--address=%s' % address, '--readers=%s' % readers]
+    server = Popen(cmd)
+    wait_for_server(address=address, sleeptime=0.2, maxtries=50)
+    read_end, write_end = os.pipe()
+    pids = []
+    for j in range(clients):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                client(address, oids, batch, seconds, j, write_end)
+            finally:
+                os._exit(0)
+        pids.append(pid)
+    os.close(write_end)
+    for pid in pids:
+        os.waitpid(pid, 0)
+    output = b''
+    while True:
+        data = os.read(read_end, 4096)
+        if not data:
+            break
+        output += data
+    os.close(read_end)
+    __main__.stop_durus(address)
+    server.wait()
+    return sum(int(line) for line in output.split())
+
+
+def main():
+    parser = OptionParser()
+    parser.set_description(
+        'Measure load throughput with and without read replicas.')
+    parser.add_option('--readers', dest='readers', default=4, type='int',
+                      help='Reader processes to compare with. (default=4)')
+    parser.add_option('--clients', dest='clients', default=8, type='int',
+                      help='Client processes loading at once. (default=8)')
+    parser.add_option('--objects', dest='objects', default=20000,
+                      type='int', help='Records in the file. (default=20000)')
+    parser.add_option('--size', dest='size', default=1000, type='int',
+                      help='Bytes of data in each record. (default=1000)')
+    parser.add_option('--batch', dest='batch', default=100, type='int',
+                      help='Records in each bulk load. (default=100)')
+    parser.add_option('--seconds', dest='seconds', default=5.0,
+                      type='float', help='Time for each run. (default=5)')
+    (options, args) = parser.parse_args()
+    logger.setLevel(30)
+    filename = mktemp()
+    try:
+        oids = make_file(filename, options.objects, options.size)
+        sys.stdout.write('%s cores\n' % os.cpu_count())
+        for readers in (0, options.readers):
+            records = bench(filename, readers, options.clients, oids,
+                            options.batch, options.seconds)
+            sys.stdout.write('%3s readers: %10.1f records/s\n' % (
+                readers, records / options.seconds))
+    finally:
+        for name in (filename, filename + '.index'):
+            if os.path.exists(name):
+                os.unlink(name)
+
+if __name__ == '__main__':
+    main()
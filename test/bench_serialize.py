@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""Measure the per-record cost of the record helpers in durus.serialize,
+in C and in pure Python.
+"""
+import importlib.util
+import sys
+import time
+from optparse import OptionParser
+import durus.serialize
+from durus.utils import int8_to_str, join_bytes, as_bytes
+
+
+def import_pure_serialize():
+    saved = sys.modules.get('durus._serialize')
+    sys.modules['durus._serialize'] = None # blocks the import
+    try:
+        spec = importlib.util.spec_from_file_location(
+            '_pure_serialize', durus.serialize.__file__)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    finally:
+        if saved is None:
+            del sys.modules['durus._serialize']
+        else:
+            sys.modules['durus._serialize'] = saved
+
+
+def make_records(count, refs_per_record):
+    data = as_bytes(
+        '\x80\x02cdurus.persistent\nPersistent\nq\x01.' + 'x' * 200)
+    records = []
+    for j in range(count):
+        refs = join_bytes(int8_to_str(j + k) for k in range(refs_per_record))
+        records.append(durus.serialize.pack_record(int8_to_str(j), data, refs))
+    return records
+
+
+def bench(module, records):
+    unpack_record = module.unpack_record
+    pack_record = module.pack_record
+    split_oids = module.split_oids
+    extract_class_name = module.extract_class_name
+    result = {}
+    start = time.time()
+    unpacked = [unpack_record(record) for record in records]
+    result['unpack_record'] = time.time() - start
+    start = time.time()
+    for oid, data, refs in unpacked:
+        pack_record(oid, data, refs)
+    result['pack_record'] = time.time() - start
+    start = time.time()
+    for oid, data, refs in unpacked:
+        split_oids(refs)
+    result['split_oids'] = time.time() - start
+    start = time.time()
+    for record in records:
+        extract_class_name(record)
+    result['extract_class_name'] = time.time() - start
+    return result
+
+
+def main():
+    parser = OptionParser()
+    parser.set_description('Measure serialize record helper overhead.')
+    parser.add_option('--records', dest='records', default=200000,
+                      type='int', help='Records per test. (default=200000)')
+    parser.add_option('--refs', dest='refs', default=10, type='int',
+                      help='References per record. (default=10)')
+    (options, args) = parser.parse_args()
+    records = make_records(options.records, options.refs)
+    pure = bench(import_pure_serialize(), records)
+    fast = bench(durus.serialize, records)
+    if hasattr(durus.serialize.split_oids, '__code__'):
+        label = 'python' # The C module is not built.
+    else:
+        label = 'C'
+    for name in sorted(pure):
+        sys.stdout.write('%20s: %7.3f us python %7.3f us %s (per record)\n' % (
+            name,
+            1e6 * pure[name] / len(records),
+            1e6 * fast[name] / len(records),
+            label))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""Measure commit and load throughput for many small objects.
+"""
+import sys
+import time
+from optparse import OptionParser
+from durus.connection import Connection
+from durus.logger import logger
+from durus.persistent import Persistent
+from durus.persistent_list import PersistentList
+from durus.storage import MemoryStorage
+
+
+class Item (Persistent):
+
+    def __init__(self, n):
+        self.n = n
+        self.name = 'item %s' % n
+
+
+def bench(count, per_commit):
+    storage = MemoryStorage()
+    connection = Connection(storage, cache_size=count * 2)
+    root = connection.get_root()
+    for j in range(0, count, per_commit):
+        root[j] = PersistentList(
+            [Item(n) for n in range(j, min(count, j + per_commit))])
+        connection.commit()
+    start = time.time()
+    for chunk in root.values():
+        for item in chunk:
+            item.n += 1 # each item is a changed object
+        connection.commit()
+    commit = time.time() - start
+    connection = Connection(storage, cache_size=count * 2)
+    items = []
+    for chunk in connection.get_root().values():
+        items.extend(chunk)
+    start = time.time()
+    for item in items:
+        item.n # load the state
+    load = time.time() - start
+    return commit, load
+
+
+def main():
+    parser = OptionParser()
+    parser.set_description('Measure commit and load throughput.')
+    parser.add_option('--objects', dest='objects', default=100000,
+                      type='int', help='Number of objects. (default=100000)')
+    parser.add_option('--per-commit', dest='per_commit', default=1000,
+                      type='int', help='Objects per commit. (default=1000)')
+    (options, args) = parser.parse_args()
+    logger.setLevel(30)
+    commit, load = bench(options.objects, options.per_commit)
+    sys.stdout.write('commit: %8.0f objects/s\n' % (options.objects / commit))
+    sys.stdout.write('  load: %8.0f objects/s\n' % (options.objects / load))
+
+if __name__ == '__main__':
+    main()
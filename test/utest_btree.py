@@ -2,13 +2,28 @@
 $URL$
 $Id$
 """
-from durus.btree import BTree, BNode
+from durus.btree import BTree, BNode, BNode4
 from durus.connection import Connection
 from durus.storage import MemoryStorage
 from random import randint
 from sancho.utest import UTest, raises
 import sys
 
+def check_node(node, root=True):
+    """Assert the BTree invariants under node, and return its depth."""
+    t = node.minimum_degree
+    assert len(node.keys) <= 2 * t - 1
+    assert root or len(node.keys) >= t - 1
+    assert node.keys == sorted(node.keys)
+    assert node._count == node.get_count()
+    if node.is_leaf():
+        return 1
+    assert len(node.nodes) == len(node.keys) + 1
+    assert node.counts == [child._count for child in node.nodes]
+    depths = set(check_node(child, False) for child in node.nodes)
+    assert len(depths) == 1
+    return depths.pop() + 1
+
 class CoverageTest(UTest):
 
     def no_arbitrary_attributes(self):
@@ -80,6 +95,181 @@ class CoverageTest(UTest):
         bt = self._delete_case_3()
         del bt[7]
 
+    def delete_counts(self):
+        for bnode_class in [BNode] + BNode.__subclasses__()[:2]:
+            bt = BTree(bnode_class)
+            for j in range(300):
+                bt.add(j)
+            for j in list(range(0, 300, 3)) + list(range(299, 0, -3)):
+                del bt[j]
+                assert bt.root._count == bt.root.get_count()
+            assert list(bt) == [j for j in range(300)
+                                if j % 3 == 1 and (299 - j) % 3 != 0]
+
+    def legacy_items_state(self):
+        node = BNode()
+        node.__setstate__(dict(items=[(1, 'a'), (2, 'b')], nodes=None,
+                               _count=2))
+        assert node.keys == [1, 2]
+        assert node.values == ['a', 'b']
+        assert node.items == [(1, 'a'), (2, 'b')]
+        assert 'items' not in node.__getstate__()
+        bt = BTree(BNode)
+        bt.root = node
+        assert bt[2] == 'b'
+        bt[0] = 'c'
+        assert list(bt.items()) == [(0, 'c'), (1, 'a'), (2, 'b')]
+
+    def from_sorted(self):
+        for bnode_class in [BNode] + BNode.__subclasses__()[:3]:
+            for n in list(range(40)) + [100, 1000, 5000]:
+                for fill in (0.5, 0.9, 1):
+                    items = [(j, str(j)) for j in range(n)]
+                    bt = BTree.from_sorted(items, bnode_class, fill=fill)
+                    assert bt.root.__class__ is bnode_class
+                    check_node(bt.root)
+                    assert bt.items() == items
+                    assert len(bt) == n
+        bt = BTree.from_sorted((j, j) for j in range(100))
+        bt[100.5] = 1
+        del bt[3]
+        check_node(bt.root)
+        raises(ValueError, BTree.from_sorted, [(1, 1), (1, 2)])
+        raises(ValueError, BTree.from_sorted, [(2, 1), (1, 2)])
+
+    def positions(self):
+        for bnode_class in [BNode] + BNode.__subclasses__()[:2]:
+            bt = BTree(bnode_class)
+            for j in range(0, 600, 2):
+                bt[j] = str(j)
+            items = bt.items()
+            for index, item in enumerate(items):
+                assert bt.index_of(item[0]) == index
+                assert bt.item_at(index) == item
+                assert bt.item_at(index - len(items)) == item
+            raises(KeyError, bt.index_of, 3)
+            raises(KeyError, bt.index_of, 1000)
+            raises(IndexError, bt.item_at, 300)
+            raises(IndexError, bt.item_at, -301)
+            for start, stop in [(0, 10), (95, 130), (290, 400), (-5, -1),
+                                (10, 5), (0, 1000), (-1000, 3)]:
+                assert (list(bt.items_between_positions(start, stop)) ==
+                        items[start:stop])
+        raises(IndexError, BTree().item_at, 0)
+        assert list(BTree().items_between_positions(0, 10)) == []
+
+    def fill_counts(self):
+        bt = BTree(BNode)
+        for j in range(500):
+            bt[j] = j
+        def clear_counts(node):
+            del node._count
+            if node.nodes is not None:
+                del node.counts
+            for child in node.nodes or []:
+                clear_counts(child)
+        clear_counts(bt.root)
+        assert bt.item_at(300) == (300, 300)
+        assert bt.index_of(300) == 300
+        assert len(bt) == 500
+        node_count = bt.get_node_count()
+        assert bt.fill_counts() == node_count
+        check_node(bt.root)
+        assert bt.fill_counts() == 0
+        # Only the root and the nodes under its first child lack counts.
+        clear_counts(bt.root.nodes[0])
+        del bt.root._count
+        bt[500] = 500
+        del bt[3]
+        assert len(bt) == 500
+        assert 0 < bt.fill_counts() < node_count
+        check_node(bt.root)
+        # Nodes with a _count, but stored before counts were kept.
+        nodes = [bt.root]
+        while nodes:
+            node = nodes.pop()
+            if node.nodes is not None:
+                del node.counts
+                nodes.extend(node.nodes)
+        bt[501] = 501
+        del bt[4]
+        assert bt.index_of(300) == 298
+        # None of the nodes made from them has counts either.
+        internal = 0
+        nodes = [bt.root]
+        while nodes:
+            node = nodes.pop()
+            if node.nodes is not None:
+                assert node.counts is None
+                internal += 1
+                nodes.extend(node.nodes)
+        assert bt.fill_counts() == internal
+        check_node(bt.root)
+
+    def insert_many(self):
+        for bnode_class in [BNode] + BNode.__subclasses__()[:2]:
+            for size in (0, 10, 1000):
+                bt = BTree(bnode_class)
+                expect = {}
+                for j in range(0, size, 2):
+                    bt[j] = j
+                    expect[j] = j
+                for batch in (range(3000, 2000, -1), range(0, 3000, 3), [],
+                              [1], range(-100, 0)):
+                    items = [(key, -key) for key in batch]
+                    bt.insert_many(items)
+                    expect.update(items)
+                    check_node(bt.root)
+                    assert bt.items() == sorted(expect.items())
+        bt = BTree(BNode)
+        bt.insert_many([(1, 'a'), (0, 'b'), (1, 'c')])
+        assert bt.items() == [(0, 'b'), (1, 'c')]
+
+    def delete_many(self):
+        for bnode_class in [BNode] + BNode.__subclasses__()[:2]:
+            for batches in ([range(0, 1000, 3), range(1000), [5]],
+                            [range(100, 900), range(0, 1000, 2)],
+                            [range(999, -1, -1)],
+                            [range(0, 1000, 50), range(1, 1000, 7)]):
+                bt = BTree(bnode_class)
+                expect = {}
+                for j in range(1000):
+                    bt[j] = j
+                    expect[j] = j
+                for batch in batches:
+                    removed = bt.delete_many(batch)
+                    assert removed == len([key for key in set(batch)
+                                           if key in expect])
+                    for key in batch:
+                        expect.pop(key, None)
+                    check_node(bt.root)
+                    assert bt.items() == sorted(expect.items())
+        for j in range(50):
+            bt = BTree(BNode)
+            keys = [randint(0, 300) for k in range(200)]
+            bt.insert_many((key, key) for key in keys)
+            check_node(bt.root)
+            bt.delete_many(randint(0, 300) for k in range(150))
+            check_node(bt.root)
+            bt.insert_many((randint(0, 300), 1) for k in range(100))
+            check_node(bt.root)
+            bt.delete_many(randint(0, 300) for k in range(150))
+            check_node(bt.root)
+
+    def merge_sorted(self):
+        bt = BTree(BNode)
+        for j in range(0, 300, 2):
+            bt[j] = 'old'
+        bt.merge_sorted((j, 'new') for j in range(0, 300, 3))
+        check_node(bt.root)
+        expect = dict((j, 'old') for j in range(0, 300, 2))
+        expect.update((j, 'new') for j in range(0, 300, 3))
+        assert bt.items() == sorted(expect.items())
+        bt.merge_sorted([])
+        assert bt.items() == sorted(expect.items())
+        raises(ValueError, bt.merge_sorted, [(5, 1), (5, 2)])
+        assert bt.items() == sorted(expect.items())
+
     def nonzero(self):
         bt = BTree()
         assert not bt
@@ -139,6 +329,24 @@ class CoverageTest(UTest):
                     list(bt.items_from(cutoff, closed=False)))
 
 
+    def items_limit(self):
+        bt = BTree(BNode)
+        for j in range(100):
+            bt.add(j)
+        for limit in (0, 1, 5, 200):
+            assert list(bt.items_from(10, limit=limit)) == [
+                (j, True) for j in range(10, 100)][:limit]
+            assert list(bt.items_from(10, closed=False, limit=limit)) == [
+                (j, True) for j in range(11, 100)][:limit]
+            assert list(bt.items_range(10, 20, closed_start=False,
+                                       limit=limit)) == [
+                (j, True) for j in range(11, 20)][:limit]
+            assert list(bt.items_range(20, 10, closed_start=True,
+                                       limit=limit)) == [
+                (j, True) for j in range(20, 10, -1)][:limit]
+            assert list(bt.items_backward_from(20, limit=limit)) == [
+                (j, True) for j in range(19, -1, -1)][:limit]
+
     def items_backward_from(self):
         bt = BTree()
         for j in range(100):
@@ -346,6 +554,139 @@ class DurusTest(UTest):
         assert self.connection.get_cache_count() == 5
         bt.note_change_of_bnode_containing_key(1)
 
+    def b(self):
+        bt = self.connection.get_root()['bt'] = BTree(BNode)
+        bt[-1] = 'old'
+        self.connection.commit()
+        raises(ValueError, BTree(BNode).load_sorted, [], commit_every=10)
+        committed = []
+        commit = self.connection.commit
+        def note_commit():
+            # The tree has its old contents until the load is done.
+            commit()
+            other = Connection(self.connection.get_storage())
+            committed.append(other.get_root()['bt'].items())
+            assert other.get_root()['bt']._loading
+        self.connection.commit = note_commit
+        bt.load_sorted(((j, j) for j in range(1000)), commit_every=100)
+        del self.connection.commit
+        assert committed == [[(-1, 'old')]] * 10
+        assert bt._loading is None
+        self.connection.commit()
+        bt = Connection(self.connection.get_storage()).get_root()['bt']
+        check_node(bt.root)
+        assert bt.items() == [(j, j) for j in range(1000)]
+        assert '_loading' not in bt.__dict__
+
+    def d(self):
+        bt = self.connection.get_root()['bt'] = BTree(BNode)
+        for j in range(500):
+            bt[j] = j
+        self.connection.commit()
+        nodes = [bt.root]
+        while nodes:
+            node = nodes.pop()
+            del node._count
+            if node.nodes is not None:
+                del node.counts
+            nodes.extend(node.nodes or [])
+        self.connection.commit()
+        raises(ValueError, BTree().fill_counts, commit_every=10)
+        commits = []
+        commit = self.connection.commit
+        def note_commit():
+            commits.append(1)
+            commit()
+        self.connection.commit = note_commit
+        updated = bt.fill_counts(commit_every=10)
+        del self.connection.commit
+        assert len(commits) == updated // 10
+        self.connection.commit()
+        bt = Connection(self.connection.get_storage()).get_root()['bt']
+        check_node(bt.root)
+        assert bt.item_at(250) == (250, 250)
+
+    def e(self):
+        bt = self.connection.get_root()['bt'] = BTree.from_sorted(
+            ((j, j) for j in range(0, 20000, 2)), BNode4)
+        self.connection.commit()
+        bt.insert_many((j, -j) for j in range(1001, 3000, 2))
+        bt.delete_many(range(5000, 6000))
+        self.connection.commit()
+        other = Connection(self.connection.get_storage())
+        items = other.get_root()['bt'].items()
+        assert items == [(j, j) for j in range(0, 1001, 2)] + [
+            (j, j * (-1) ** j) for j in range(1001, 3000)] + [
+            (j, j) for j in range(3000, 5000, 2)] + [
+            (j, j) for j in range(6000, 20000, 2)]
+        # Fewer nodes change than with the same changes made one by one.
+        bt.insert_many((j, j) for j in range(7001, 9000, 2))
+        bt.delete_many(range(10000, 11000))
+        other_bt = other.get_root()['bt']
+        for j in range(7001, 9000, 2):
+            other_bt[j] = j
+        for j in range(10000, 11000, 2):
+            del other_bt[j]
+        assert len(self.connection.changed) < len(other.changed)
+        assert bt.items() == other_bt.items()
+
+    def c(self):
+        storage = self.connection.get_storage()
+        bt = self.connection.get_root()['bt'] = BTree.from_sorted(
+            ((j, j) for j in range(10000)), BNode4)
+        self.connection.commit()
+        loads = []
+        bulk_loads = []
+        def load(oid):
+            loads.append(oid)
+            return storage.__class__.load(storage, oid)
+        def bulk_load(oids):
+            bulk_loads.append(len(oids))
+            return [storage.__class__.load(storage, oid) for oid in oids]
+        storage.load = load
+        storage.bulk_load = bulk_load
+        connection = Connection(storage)
+        bt = connection.get_root()['bt']
+        del loads[:]
+        assert list(bt.items_range(1000, 1100, limit=50)) == [
+            (j, j) for j in range(1000, 1050)]
+        # The tree and a node of each level are loaded alone, on the way
+        # down, and the leaves that follow are prefetched.
+        assert len(loads) <= 1 + bt.get_depth(), loads
+        assert bulk_loads and max(bulk_loads) <= 50 // 4 + 1, bulk_loads
+        del loads[:]
+        del bulk_loads[:]
+        connection = Connection(storage)
+        bt = connection.get_root()['bt']
+        assert list(bt.items_range(2000, 2020)) == [
+            (j, j) for j in range(2000, 2020)]
+        # Nodes past the end of the range are not prefetched.
+        assert sum(bulk_loads) <= 8, bulk_loads
+        connection = Connection(storage)
+        bt = connection.get_root()['bt']
+        assert bt.items() == [(j, j) for j in range(10000)]
+        # An unbounded walk that stops early loads few nodes.
+        connection = Connection(storage)
+        bt = connection.get_root()['bt']
+        del loads[:]
+        del bulk_loads[:]
+        for key in bt:
+            if key == 20:
+                break
+        assert len(loads) + sum(bulk_loads) <= bt.get_depth() + 8, (
+            loads, bulk_loads)
+        # Positions are found loading only the nodes on the way down.
+        depth = bt.get_depth()
+        for index in (0, 4321, 9999):
+            connection = Connection(storage)
+            bt = connection.get_root()['bt']
+            del loads[:]
+            del bulk_loads[:]
+            assert bt.index_of(index) == index
+            assert bt.item_at(index) == (index, index)
+            assert not bulk_loads, bulk_loads
+            assert len(loads) <= 1 + 2 * depth, loads
+
 if __name__ == '__main__':
     CoverageTest()
     DurusTest()
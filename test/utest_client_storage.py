@@ -11,6 +11,7 @@ from durus.persistent import Persistent
 from durus.persistent_dict import PersistentDict
 from durus.serialize import pack_record
 from durus.storage_server import STATUS_INVALID, wait_for_server
+from durus.storage_server import PROTOCOL_1, PROTOCOL_2
 from durus.utils import int8_to_str, BytesIO, as_bytes, join_bytes
 from os import unlink, devnull
 from os.path import exists
@@ -39,11 +40,12 @@ class FakeSocket (object):
 class ClientTest (UTest):
 
     address = ("localhost", 9123)
+    server_options = []
 
     def _pre(self):
         self.filename = mktemp()
         cmd = [sys.executable, __main__.__file__, 
-            '-s', '--file=%s' % self.filename]
+            '-s', '--file=%s' % self.filename] + self.server_options
         if isinstance(self.address, tuple):
             cmd.append("--port=%s" % self.address[1])
         else:
@@ -97,6 +99,89 @@ class ClientTest (UTest):
         b.close()
         c.close()
 
+    def check_prefetch(self):
+        b = ClientStorage(address=self.address)
+        c = ClientStorage(address=self.address)
+        assert c.protocol == PROTOCOL_2
+        oids = [b.new_oid() for j in range(3)]
+        b.begin()
+        for oid in oids[:2]:
+            b.store(oid, pack_record(oid, as_bytes('ok'), as_bytes('')))
+        b.end()
+        c.sync()
+        c.prefetch(oids)
+        c.prefetch(oids) # Already pending, so nothing is sent.
+        assert len(c.pending) == 1
+        assert c.load(oids[1]) == pack_record(
+            oids[1], as_bytes('ok'), as_bytes(''))
+        assert not c.pending
+        assert sorted(c.prefetched) == [oids[0], oids[2]]
+        raises(DurusKeyError, c.load, oids[2])
+        # An invalidation discards the prefetched record.
+        b.begin()
+        b.store(oids[0], pack_record(oids[0], as_bytes('new'), as_bytes('')))
+        b.end()
+        assert c.sync() == [oids[0]]
+        assert not c.prefetched
+        c.prefetch(oids[:2])
+        assert c.sync() == [] # A sync reads the pending responses first.
+        assert c.load(oids[0]) == pack_record(
+            oids[0], as_bytes('new'), as_bytes(''))
+        assert len(list(c.bulk_load(oids[:2]))) == 2
+        # Unread prefetch responses are not allowed to pile up.
+        for j in range(c.max_pending + 5):
+            c.prefetch([oids[j % 2]])
+            c.prefetched.clear()
+            assert len(c.pending) <= c.max_pending
+        assert c.load(oids[1]) == pack_record(
+            oids[1], as_bytes('ok'), as_bytes(''))
+        # A bulk load that stops early leaves the rest unused, but only up
+        # to max_prefetched of them are kept.
+        more = [b.new_oid() for j in range(10)]
+        b.begin()
+        for oid in more:
+            b.store(oid, pack_record(oid, as_bytes('ok'), as_bytes('')))
+        b.end()
+        c.sync()
+        c.prefetched.clear()
+        c.max_prefetched = 3
+        records = c.bulk_load(more)
+        next(records)
+        records.close()
+        assert c.sync() == []
+        assert list(c.prefetched) == more[-3:]
+        c.prefetch([oids[1]])
+        assert c.load(oids[1]) == pack_record(
+            oids[1], as_bytes('ok'), as_bytes(''))
+        assert len(c.prefetched) <= 3
+        assert c.load(more[1]) == pack_record(
+            more[1], as_bytes('ok'), as_bytes(''))
+        b.close()
+        c.close()
+
+    def check_protocol_1(self):
+        class OldClientStorage (ClientStorage):
+            def _connect(self, protocol):
+                return ClientStorage._connect(self, PROTOCOL_1)
+        s = OldClientStorage(address=self.address)
+        assert s.protocol == PROTOCOL_1
+        s.prefetch([int8_to_str(0)])
+        assert not s.pending
+        raises(KeyError, s.load, int8_to_str(0))
+        assert len(list(s.bulk_load([]))) == 0
+        oids = [s.new_oid() for j in range(3)]
+        s.begin()
+        for oid in oids[::2]:
+            s.store(oid, pack_record(oid, as_bytes('ok'), as_bytes('')))
+        s.end()
+        # The responses after the missing record are read too, so the
+        # connection is still usable.
+        raises(KeyError, list, s.bulk_load(oids))
+        assert s.load(oids[2]) == pack_record(
+            oids[2], as_bytes('ok'), as_bytes(''))
+        assert len(list(s.bulk_load(oid for oid in oids[::2]))) == 2
+        s.close()
+
     def check_oid_reuse(self):
         # Requires ShelfStorage oid reuse pack semantics
         s1 = ClientStorage(address=self.address)
@@ -183,8 +268,23 @@ class UnixDomainSocketTest (ClientTest):
 
     address = "/tmp/test.durus_server"
 
+class AsyncServerTest (ClientTest):
+
+    server_options = ['--async']
+
+class ReadReplicaTest (ClientTest):
+
+    server_options = ['--readers=2']
+
+class GroupCommitTest (ClientTest):
+
+    server_options = ['--fsync=group', '--commit-window=0.01']
+
 if __name__ == "__main__":
     ClientTest()
+    AsyncServerTest()
+    ReadReplicaTest()
+    GroupCommitTest()
     try:
         from socket import AF_UNIX
         UnixDomainSocketTest()
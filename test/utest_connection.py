@@ -4,11 +4,16 @@ $Id$
 """
 from durus import __main__
 from durus.client_storage import ClientStorage
+from durus.btree import BTree, BNode4
 from durus.connection import Connection, touch_every_reference
-from durus.connection import ObjectDictionary
-from durus.error import ConflictError, WriteConflictError
+from durus.connection import prefetch_contents
+from durus.connection import ObjectDictionary, RecordCache, AccessPredictor
+from durus.error import ConflictError, WriteConflictError, ReadConflictError
 from durus.persistent import Persistent, PersistentBase
 from durus.persistent import ConnectionBase
+from durus.persistent_dict import PersistentDict
+from durus.persistent_list import PersistentList
+from durus.persistent_set import PersistentSet
 from durus.storage import get_reference_index, get_census, MemoryStorage
 from durus.storage import gen_referring_oid_record, Storage
 from durus.storage_server import wait_for_server
@@ -79,6 +84,128 @@ class TestConnection (UTest):
         conn.commit()
         conn.pack()
 
+    def check_shrink_order(self):
+        conn = Connection(self._get_storage())
+        root = conn.get_root()
+        for name in 'abc':
+            root[name] = PersistentDict()
+        conn.commit()
+        a, b, c = root['a'], root['b'], root['c']
+        conn.abort()
+        for x in (b, a, c):
+            len(x) # access
+        serial = conn.get_transaction_serial()
+        policy = conn.get_cache().recent_objects
+        assert policy.pop(serial) is root
+        assert policy.pop(serial) is None
+        assert len(policy) == 3
+        assert [policy.pop(serial + 1) for x in range(4)] == [b, a, c, None]
+        conn.abort()
+        len(a)
+        conn.abort()
+        len(b)
+        conn.set_cache_size(1)
+        conn.shrink_cache()
+        assert a._p_is_ghost()
+        assert not b._p_is_ghost()
+
+    def check_shrink_current_transaction(self):
+        # Objects loaded after one accessed in the same transaction can
+        # still be released.
+        conn = Connection(self._get_storage())
+        root = conn.get_root()
+        root['list'] = PersistentList(Persistent() for j in range(20))
+        conn.commit()
+        oids = [x._p_oid for x in root['list']]
+        conn = Connection(conn.get_storage(), cache_size=5)
+        root = conn.get_root()
+        len(root) # access
+        conn.prefetch(oids)
+        assert conn.get_cache_count() == 22
+        conn.shrink_cache()
+        assert conn.get_cache_count() <= 5
+        assert not root._p_is_ghost()
+
+    def check_prefetch(self):
+        connection = Connection(self._get_storage())
+        root = connection.get_root()
+        root['list'] = PersistentList(Persistent() for j in range(50))
+        root['set'] = PersistentSet(Persistent() for j in range(5))
+        root['dict'] = PersistentDict((j, Persistent()) for j in range(5))
+        root['tree'] = BTree(BNode4)
+        for j in range(100):
+            root['tree'][j] = Persistent()
+        connection.commit()
+        oid = root['list'][0]._p_oid
+        storage = connection.get_storage()
+        connection = Connection(storage)
+        root = connection.get_root()
+        bulk_loads = []
+        def bulk_load(oids):
+            bulk_loads.append(oids)
+            return storage.__class__.bulk_load(storage, oids)
+        storage.bulk_load = bulk_load
+        connection.prefetch([oid, root['list']])
+        assert len(bulk_loads) == 1
+        assert not connection.get(oid)._p_is_ghost()
+        prefetch_contents(root['list'])
+        assert len(bulk_loads) == 2
+        prefetch_contents(root['tree'])
+        tree = root['tree']
+        depth = 1
+        node = tree.root
+        while not node.is_leaf():
+            node = node.nodes[0]
+            depth += 1
+        assert depth > 2
+        assert len(bulk_loads) == 2 + depth + 1
+        prefetch_contents(root['set'])
+        prefetch_contents(root['dict'])
+        assert len(bulk_loads) == 2 + depth + 1 + 2
+        raises(TypeError, prefetch_contents, Persistent())
+        def load(oid):
+            raise AssertionError('not prefetched')
+        storage.load = load
+        for x in root['list']:
+            x.__dict__
+        for key, x in tree.items():
+            x.__dict__
+        for x in root['set']:
+            x.__dict__
+        for x in root['dict'].values():
+            x.__dict__
+
+    def check_predictor(self):
+        storage = self._get_storage()
+        connection = Connection(storage)
+        root = connection.get_root()
+        root['list'] = PersistentList(Persistent() for j in range(3))
+        connection.commit()
+        predictor = AccessPredictor()
+        bulk_loads = []
+        def bulk_load(oids):
+            bulk_loads.append(list(oids))
+            return storage.__class__.bulk_load(storage, oids)
+        storage.bulk_load = bulk_load
+        def use_all():
+            connection = Connection(storage, predictor=predictor)
+            for x in connection.get_root()['list']:
+                x.__dict__
+        use_all()
+        assert bulk_loads == []
+        assert (predictor.hits, predictor.misses) == (0, 4), str(predictor)
+        use_all()
+        # The list and the first item are loaded together, and so are the
+        # second and third items.
+        assert len(bulk_loads) == 2
+        assert (predictor.hits, predictor.misses) == (2, 6), str(predictor)
+        assert predictor.prefetched == 2
+        assert not predictor.pending
+        small = AccessPredictor(size=2, followers=1)
+        for oid in 'abcab':
+            small.note_load(oid)
+        assert list(small.table.items()) == [('c', ['a']), ('a', ['b'])]
+
     def check_storage_tools(self):
         connection = Connection(self._get_storage())
         root = connection.get_root()
@@ -170,6 +297,69 @@ class TestConnectionClientStorage (TestConnection):
         c.commit()
         rootb['d']
 
+    def check_record_cache(self):
+        record_cache = RecordCache()
+        c1 = Connection(self._get_storage(), record_cache=record_cache)
+        c2 = Connection(self._get_storage(), record_cache=record_cache)
+        root_oid = int8_to_str(0)
+        assert root_oid in record_cache.records
+        c1.get_root()['a'] = PersistentDict()
+        c1.commit()
+        assert len(record_cache) == 0
+        c2.abort()
+        assert 'a' in c2.get_root()
+        a_oid = c2.get_root()['a']._p_oid
+        c2.get_root()['a']['x'] = 1
+        c2.commit()
+        assert a_oid not in record_cache.records
+        c1.abort()
+        assert c1.get_root()['a']['x'] == 1
+        assert a_oid in record_cache.records
+        storage = self._get_storage()
+        loads = []
+        def load(oid):
+            loads.append(oid)
+            return storage.__class__.load(storage, oid)
+        storage.load = load
+        c3 = Connection(storage, record_cache=record_cache)
+        assert c3.get_root()['a']['x'] == 1
+        assert loads == []
+        small = RecordCache(size=1)
+        small.put(a_oid, as_bytes('xx'), small.get_serial(), 0)
+        assert len(small) == 0
+        serial = small.get_serial()
+        small.invalidate([a_oid])
+        small.put(a_oid, as_bytes('x'), serial, 0)
+        assert len(small) == 0
+
+    def check_record_cache_read_conflict(self):
+        record_cache = RecordCache()
+        c1 = Connection(self._get_storage(), record_cache=record_cache)
+        c2 = Connection(self._get_storage(), record_cache=record_cache)
+        c3 = Connection(self._get_storage())
+        root1 = c1.get_root()
+        root1['a'] = PersistentDict()
+        root1['b'] = PersistentDict()
+        c1.commit()
+        c2.abort()
+        root2 = c2.get_root()
+        assert 'x' not in root2['a']
+        c3.abort()
+        root3 = c3.get_root()
+        root3['a']['x'] = 1
+        root3['b']['x'] = 1
+        c3.commit()
+        # c1 sees the commit, and shares the new b.
+        c1.abort()
+        assert root1['b']['x'] == 1
+        b_oid = root1['b']._p_oid
+        assert b_oid in record_cache.records
+        # c2 read the old a in this transaction, so the new b is not used.
+        b2 = root2['b']
+        raises(ReadConflictError, getattr, b2, 'data')
+        c2.abort()
+        assert root2['a']['x'] == root2['b']['x'] == 1
+
     def check_fine_conflict(self):
         c1 = Connection(self._get_storage())
         c2 = Connection(self._get_storage())
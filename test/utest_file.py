@@ -2,8 +2,8 @@
 $URL$
 $Id$
 """
-from durus.file import File
-from durus.utils import as_bytes
+from durus.file import File, FileMap
+from durus.utils import as_bytes, ShortRead
 from os import unlink
 from os.path import exists
 from sancho.utest import UTest, raises
@@ -74,6 +74,21 @@ class FileTest (UTest):
         f.close()
         unlink(name2)
 
+    def d(self):
+        f = File()
+        f.write(as_bytes('abc'))
+        m = FileMap(f)
+        assert len(m) == 3
+        assert m.read(1, 2) == as_bytes('bc')
+        assert bytes(m.view(0, 2)) == as_bytes('ab')
+        f.seek_end()
+        f.write(as_bytes('def'))
+        assert m.read(2, 4) == as_bytes('cdef')
+        assert len(m) == 6
+        raises(ShortRead, m.read, 5, 2)
+        m.close()
+        f.close()
+
 if __name__ == '__main__':
     FileTest()
 
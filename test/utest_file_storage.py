@@ -7,9 +7,12 @@ from durus.connection import Connection
 from durus.file import File
 from durus.file_storage import TempFileStorage, FileStorage
 from durus.logger import direct_output
+from durus.pack import ReferenceIndex
 from durus.persistent import Persistent
 from durus.serialize import pack_record
-from durus.utils import int8_to_str, ShortRead, write_int4_str, as_bytes
+from durus.storage import FSYNC_GROUP, FSYNC_PER_COMMIT
+from durus.utils import int8_to_str, str_to_int8, ShortRead, write_int4_str
+from durus.utils import as_bytes
 from os import unlink
 from sancho.utest import UTest, raises
 from tempfile import mktemp
@@ -197,6 +200,209 @@ class ShelfStorageTest (UTest):
         new_oid = s.new_oid()
         assert new_oid == int8_to_str(2), repr(new_oid)
 
+    def d(self):
+        f = File(prefix='shelftest')
+        name = f.get_name()
+        f.close()
+        s = FileStorage(name, mmap=True)
+        c = Connection(s)
+        r = c.get_root()
+        for x in range(10):
+            r["a%s" % x] = Persistent()
+            c.commit()
+        del r['a9']
+        c.commit()
+        c.pack()
+        assert s.shelf.is_mapped()
+        c.abort()
+        s.close()
+        s = FileStorage(name, mmap=True)
+        c = Connection(s)
+        r = c.get_root()
+        assert sorted(r.keys()) == ["a%s" % x for x in range(9)]
+        s.close()
+        unlink(name)
+        unlink(name + '.prepack')
+
+    def e(self):
+        assert raises(ValueError, FileStorage, fsync='sometimes')
+        fsyncs = []
+        s = FileStorage(fsync=FSYNC_GROUP)
+        s.shelf.get_file().fsync = lambda: fsyncs.append(1)
+        c = Connection(s)
+        assert s.fsync_pending
+        s.fsync()
+        assert not s.fsync_pending
+        assert len(fsyncs) == 1
+        c.get_root()['a'] = Persistent()
+        c.commit()
+        c.get_root()['b'] = Persistent()
+        c.commit()
+        assert len(fsyncs) == 1
+        s.fsync()
+        s.fsync()
+        assert len(fsyncs) == 2
+        s = FileStorage(fsync=FSYNC_PER_COMMIT)
+        s.shelf.get_file().fsync = lambda: fsyncs.append(1)
+        c = Connection(s)
+        c.get_root()['a'] = Persistent()
+        c.commit()
+        assert len(fsyncs) == 4
+        assert not s.fsync_pending
+
+    def f(self):
+        f = File(prefix='shelftest')
+        name = f.get_name()
+        f.close()
+        s = FileStorage(name, pack_workers=3)
+        c = Connection(s)
+        r = c.get_root()
+        for x in range(100):
+            r["a%s" % x] = Persistent()
+            r["a%s" % x].b = Persistent()
+            c.commit()
+        deleted_oids = [r['a%s' % x]._p_oid for x in range(0, 100, 3)]
+        for x in range(0, 100, 3):
+            del r['a%s' % x]
+        c.commit()
+        packer = s.get_packer()
+        next(packer)
+        r['c'] = Persistent() # committed during the pack
+        c.commit()
+        for step in packer:
+            pass
+        c.abort()
+        for oid in deleted_oids:
+            raises(ReadConflictError, getattr, c.get(oid), 'a')
+        assert len(list(s.gen_oid_record())) == 1 + 2 * 66 + 1
+        s.close()
+        s = FileStorage(name)
+        c = Connection(s)
+        r = c.get_root()
+        assert len(r) == 67
+        assert r['a1'].b._p_oid is not None
+        assert r['c']._p_oid is not None
+        s.close()
+        unlink(name)
+        unlink(name + '.prepack')
+
+    def g(self):
+        f = File(prefix='shelftest')
+        name = f.get_name()
+        f.close()
+        s = FileStorage(name)
+        c = Connection(s)
+        r = c.get_root()
+        r['a'] = Persistent()
+        r['b'] = Persistent()
+        r['b'].c = Persistent()
+        c.commit()
+        a = r['a']
+        del r['a']
+        r['b'].c.d = 1
+        c.commit()
+        index = ReferenceIndex()
+        for step in index.gen_scan(s.shelf):
+            pass
+        marking = index.gen_mark([int8_to_str(0)])
+        try:
+            while True:
+                next(marking)
+        except StopIteration as stop:
+            seen = stop.value
+        oids = [r._p_oid, r['b']._p_oid, r['b'].c._p_oid]
+        assert sorted(seen) == sorted(str_to_int8(oid) for oid in oids)
+        assert str_to_int8(a._p_oid) not in seen
+        records = list(index.gen_records(name, seen))
+        # In file order, and only the current records.
+        assert [oid for oid, record in records] == [
+            r['b']._p_oid, r._p_oid, r['b'].c._p_oid]
+        for oid, record in records:
+            assert record == s.load(oid)
+        s.close()
+        unlink(name)
+
+    def h(self):
+        f = File(prefix='shelftest')
+        name = f.get_name()
+        f.close()
+        s = FileStorage(name, min_live_ratio=0.5)
+        c = Connection(s)
+        r = c.get_root()
+        for x in range(10):
+            r['a%s' % x] = Persistent()
+        c.commit()
+        del r['a0']
+        c.commit()
+        s.pack()
+        assert s.get_live_ratio() == 1.0
+        packed_size = s.shelf.transactions_start
+        # Young objects, some of which become garbage.
+        r['a1'].b = Persistent()
+        r['a1'].b.c = Persistent()
+        r['d'] = Persistent()
+        r['d'].e = Persistent()
+        c.commit()
+        young_garbage = [r['a1'].b._p_oid, r['a1'].b.c._p_oid,
+                         r['d'].e._p_oid]
+        r['a1'].b = None
+        del r['d'].e
+        c.commit()
+        assert s.get_live_ratio() < 1.0
+        collector = s.get_collector()
+        next(collector)
+        r['f'] = Persistent() # committed during the collection
+        c.commit()
+        for step in collector:
+            pass
+        assert s.shelf.transactions_start == packed_size
+        c.abort()
+        for oid in young_garbage:
+            raises(ReadConflictError, getattr, c.get(oid), 'a')
+        s.close()
+        s = FileStorage(name, min_live_ratio=0.99)
+        c = Connection(s)
+        r = c.get_root()
+        assert sorted(r.keys()) == sorted(
+            ['a%s' % x for x in range(1, 10)] + ['d', 'f'])
+        assert r['a1'].b is None
+        assert r['d']._p_oid not in young_garbage
+        for oid in young_garbage:
+            raises(KeyError, s.load, oid)
+        # Enough of the packed records have been replaced for a pack.
+        assert s.get_live_ratio() < 0.99
+        s.close()
+        unlink(name)
+        unlink(name + '.prepack')
+
+    def i(self):
+        f = File(prefix='shelftest')
+        name = f.get_name()
+        f.close()
+        for fsync in (FSYNC_PER_COMMIT, FSYNC_GROUP):
+            s = FileStorage(name, fsync=fsync)
+            s.shelf.checkpoint_bytes = 1
+            c = Connection(s)
+            c.get_root()['a'] = Persistent()
+            c.commit()
+            # Under FSYNC_GROUP, the checkpoint waits for the fsync.
+            assert os.path.exists(name + '.index') == (fsync != FSYNC_GROUP)
+            s.fsync()
+            assert os.path.exists(name + '.index')
+            # A pack leaves no checkpoint of the old file behind.
+            s.pack()
+            assert not os.path.exists(name + '.index')
+            c.get_root()['b'] = Persistent()
+            c.commit()
+            s.close()
+            s = FileStorage(name)
+            assert sorted(Connection(s).get_root().keys()) == ['a', 'b']
+            s.close()
+            unlink(name)
+            unlink(name + '.prepack')
+            if os.path.exists(name + '.index'):
+                unlink(name + '.index')
+
 
 if __name__ == "__main__":
     FileStorageTest()
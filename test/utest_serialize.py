@@ -2,12 +2,48 @@
 $URL$
 $Id$
 """
-from durus.connection import ROOT_OID
+from durus import codec, serialize
+from durus.connection import Connection, ROOT_OID
+from durus.error import DurusError
 from durus.persistent import Persistent, ConnectionBase
+from durus.persistent_dict import PersistentDict
+from durus.storage import MemoryStorage
 from durus.serialize import ObjectWriter, ObjectReader, pack_record
-from durus.serialize import unpack_record, split_oids
-from durus.utils import join_bytes, as_bytes
+from durus.serialize import unpack_record, split_oids, extract_class_name
+from durus.utils import join_bytes, as_bytes, dumps
+from os import urandom
 from sancho.utest import UTest, raises
+import sys
+
+
+class Small (Persistent):
+    pass
+
+class Always (Persistent):
+    _p_compress = True
+
+class Never (Persistent):
+    _p_compress = False
+
+class Loader (object):
+    """Loads the state of its target while being unpickled."""
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.x = self.target.x
+
+
+class Blob (object):
+    """Pickles its data out-of-band."""
+
+    def __init__(self, data):
+        self.data = data
+
+    def __reduce_ex__(self, protocol):
+        if protocol >= 5:
+            from pickle import PickleBuffer
+            return Blob, (PickleBuffer(self.data),)
+        return Blob, (bytes(self.data),)
 
 
 class Test (UTest):
@@ -59,5 +95,208 @@ class Test (UTest):
         assert split_oids(result[2]) == reflist
         assert split_oids('') == []
 
+    def check_c_record_functions(self):
+        try:
+            from durus import _serialize
+        except ImportError:
+            return
+        pure = import_pure_serialize()
+        records = [
+            pack_record(as_bytes('0'*8), as_bytes('a\nB\nc'), as_bytes('1'*8)),
+            pack_record(as_bytes('0'*8), as_bytes('a\nB'), as_bytes('')),
+            pack_record(as_bytes('0'*8), as_bytes('aB'), as_bytes('')),
+            pack_record(as_bytes('0'*8), as_bytes(''), as_bytes('1'*16))]
+        for record in records:
+            oid, data, refs = pure.unpack_record(record)
+            assert pure.pack_record(oid, data, refs) == record
+            assert _serialize.unpack_record(record) == (oid, data, refs)
+            assert _serialize.split_oids(refs) == pure.split_oids(refs)
+            assert (_serialize.extract_class_name(record) ==
+                    pure.extract_class_name(record))
+        refs = as_bytes('1'*8 + '2'*8)
+        assert (_serialize.split_oids(memoryview(refs)) ==
+                pure.split_oids(memoryview(refs)) == [refs[:8], refs[8:]])
+        raises(ValueError, _serialize.split_oids, as_bytes('1'*9))
+        raises(ValueError, pure.split_oids, as_bytes('1'*9))
+        raises(ValueError, _serialize.unpack_record, as_bytes('1'*11))
+
+    def check_codecs(self):
+        state = dumps(dict(('key%s' % j, j) for j in range(100)), 2)
+        zlib_codec = codec.get_codec('zlib')
+        assert zlib_codec.compress(state, dict) == serialize.compress(state)
+        assert codec.decompress_state(state) is None
+        for name in ('zlib', 'lz4', 'zstd'):
+            try:
+                c = codec.get_codec(name)
+            except ValueError:
+                continue
+            compressed = c.compress(state, dict)
+            assert codec.TAG_NAMES[compressed[:1]] == name
+            assert len(compressed) < len(state)
+            record = as_bytes('x') + compressed
+            assert codec.decompress_state(record, 1) == state
+        raises(ValueError, codec.get_codec, 'bogus')
+        saved = codec._codecs_by_tag.pop(codec.LZ4_TAG, None)
+        try:
+            raises(DurusError, codec.decompress_state, codec.LZ4_TAG + state)
+        finally:
+            if saved is not None:
+                codec._codecs_by_tag[codec.LZ4_TAG] = saved
+
+    def check_zstd_dictionary(self):
+        try:
+            zstd = codec.get_codec('zstd')
+        except ValueError:
+            return
+        samples = [dumps(dict(name='item %s' % j, size=j * 7), 2)
+                   for j in range(1000)]
+        dictionary = codec.train_dictionary(samples, size=4096)
+        zstd = codec.ZstdCodec()
+        dictionary_id = zstd.add_dictionary(dictionary, [PersistentDict])
+        with_dictionary = zstd.compress(samples[0], PersistentDict)
+        without = zstd.compress(samples[0], Persistent)
+        assert with_dictionary[:1] == codec.ZSTD_DICT_TAG
+        assert without[:1] == codec.ZSTD_TAG
+        assert len(with_dictionary) < len(without)
+        assert zstd.decompress(with_dictionary) == samples[0]
+        reader = codec.ZstdCodec()
+        raises(DurusError, reader.decompress, with_dictionary)
+        assert reader.add_dictionary(dictionary) == dictionary_id
+        assert reader.decompress(with_dictionary) == samples[0]
+
+    def check_connection_codecs(self):
+        storage = MemoryStorage()
+        connection = Connection(storage)
+        saved = serialize.STATE_CODEC
+        try:
+            for name in ('zlib', 'lz4', 'zstd'):
+                serialize.STATE_CODEC = name
+                try:
+                    codec.get_codec(name)
+                except ValueError:
+                    continue
+                connection.get_root()[name] = PersistentDict(x=name)
+                connection.commit()
+        finally:
+            serialize.STATE_CODEC = saved
+        root = Connection(storage).get_root()
+        for name in root:
+            assert root[name]['x'] == name
+
+    def check_adaptive_compression(self):
+        connection = Connection(MemoryStorage())
+        root = connection.get_root()
+        root['x'] = None # too small to compress
+        connection.commit()
+        stats = connection.get_compression_stats()
+        assert (stats.compressed, stats.uncompressed) == (0, 2), str(stats)
+        root['small'] = Small()
+        root['big'] = Persistent()
+        root['big'].a = 'a' * 1000
+        root['random'] = Persistent()
+        root['random'].a = urandom(1000)
+        root['always'] = Always()
+        root['never'] = Never()
+        root['never'].a = 'a' * 1000
+        saved = serialize.COMPRESS_MAX_RATIO
+        serialize.COMPRESS_MAX_RATIO = 0.5 # too low for root and random
+        try:
+            connection.commit()
+        finally:
+            serialize.COMPRESS_MAX_RATIO = saved
+        assert stats.compressed == 2, str(stats) # big and always
+        assert stats.uncompressed == 6, str(stats)
+        assert stats.bytes_saved > 800
+        storage = connection.get_storage()
+        def is_compressed(obj):
+            record = storage.load(obj._p_oid)
+            return as_bytes('\x80\x02}') not in unpack_record(record)[1]
+        assert is_compressed(root['big'])
+        assert is_compressed(root['always'])
+        assert not is_compressed(root['small'])
+        assert not is_compressed(root['random'])
+        assert not is_compressed(root['never'])
+        root = Connection(storage).get_root()
+        assert root['big'].a == 'a' * 1000
+        assert root['random'].a == connection.get_root()['random'].a
+
+    def check_out_of_band_buffers(self):
+        if sys.version_info < (3, 8):
+            return
+        storage = MemoryStorage()
+        connection = Connection(storage)
+        saved = serialize.PICKLE_PROTOCOL
+        serialize.PICKLE_PROTOCOL = 5
+        try:
+            root = connection.get_root()
+            root['blob'] = Persistent()
+            root['blob'].blob = Blob(as_bytes('b' * 2000))
+            root['blob'].array = bytearray(as_bytes('a' * 2000))
+            root['blob'].data = as_bytes('c' * 2000)
+            root['blob'].other = root['other'] = Persistent()
+            connection.commit()
+        finally:
+            serialize.PICKLE_PROTOCOL = saved
+        record = storage.load(root['blob']._p_oid)
+        # The buffers are stored as is, the rest is compressed.
+        assert as_bytes('a' * 2000) in record
+        assert as_bytes('b' * 2000) in record
+        assert as_bytes('c' * 2000) in record
+        assert extract_class_name(record) == as_bytes('Persistent')
+        root = Connection(storage).get_root()
+        blob = root['blob']
+        assert blob.array == bytearray(as_bytes('a' * 2000))
+        assert blob.data == as_bytes('c' * 2000)
+        assert type(blob.data) is type(as_bytes(''))
+        assert blob.blob.data.readonly # a view of the record
+        assert bytes(blob.blob.data) == as_bytes('b' * 2000)
+        assert blob.other is root['other']
+        root['blob'].array.append(ord('a'))
+        root['blob']._p_note_change()
+        root._p_connection.commit() # with protocol 2 again
+        root = Connection(storage).get_root()
+        assert len(root['blob'].array) == 2001
+        assert root['blob'].blob.data == as_bytes('b' * 2000)
+
+    def check_nested_load(self):
+        storage = MemoryStorage()
+        connection = Connection(storage)
+        root = connection.get_root()
+        root['a'] = Persistent()
+        root['a'].loader = Loader()
+        root['a'].loader.target = root['b'] = Persistent()
+        root['b'].x = 1
+        root['a'].loader.x = None
+        root['a'].y = 2
+        connection.commit()
+        connection = Connection(storage)
+        root = connection.get_root()
+        b = root['b'] # a ghost
+        assert root['a'].loader.x == 1
+        assert root['a'].y == 2
+        assert not b._p_is_ghost()
+        assert len(connection.reader.unpicklers) == 2
+
+
+def import_pure_serialize():
+    """
+    Return a separate copy of durus.serialize that does not use the
+    C versions of its functions.
+    """
+    import durus.serialize, importlib.util, sys
+    saved = sys.modules.get('durus._serialize')
+    sys.modules['durus._serialize'] = None # blocks the import
+    try:
+        spec = importlib.util.spec_from_file_location(
+            '_pure_serialize', durus.serialize.__file__)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    finally:
+        if saved is None:
+            del sys.modules['durus._serialize']
+        else:
+            sys.modules['durus._serialize'] = saved
+
 if __name__ == "__main__":
     Test()
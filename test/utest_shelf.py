@@ -6,6 +6,9 @@ from sancho.utest import UTest, raises
 from durus.file import File
 from durus.shelf import Shelf
 from durus.utils import ShortRead, int8_to_str, BytesIO, as_bytes
+from os import unlink
+from os.path import exists
+from tempfile import mktemp
 
 class ShelfTest (UTest):
 
@@ -52,6 +55,147 @@ class ShelfTest (UTest):
         n2 = int8_to_str(1)
         s = Shelf(f, items=[(n1, 'record1'), (n2, 'record2')])
 
+    def f(self):
+        f = File()
+        n1 = int8_to_str(0)
+        n2 = int8_to_str(1)
+        Shelf(f, items=[(n1, 'record1'), (n2, 'record2')])
+        f.seek(0)
+        s = Shelf(f, mmap=True)
+        assert s.is_mapped()
+        assert s.get_value(n1) == as_bytes('record1')
+        assert s.get_value(n2) == as_bytes('record2')
+        assert s.get_value(int8_to_str(2)) is None
+        # The map follows the file as it grows.
+        n3 = s.next_name()
+        s.store([(n3, 'record3'), (n2, 'record2b')])
+        assert s.get_value(n3) == as_bytes('record3')
+        assert s.get_value(n2) == as_bytes('record2b')
+        assert sorted(s.items()) == [
+            (n1, as_bytes('record1')), (n2, as_bytes('record2b')),
+            (n3, as_bytes('record3'))]
+        s.close()
+
+    def g(self):
+        f = File()
+        names = [int8_to_str(j) for j in (0, 2, 5)]
+        s = Shelf(f, items=[(name, 'record') for name in names])
+        offset_map = s.get_offset_map()
+        assert offset_map.get_array_size() == 7
+        assert list(offset_map.gen_holes()) == [4, 3, 1, 6]
+        assert list(offset_map.gen_holes(block_size=2)) == [4, 3, 1, 6]
+        assert list(offset_map) == [0, 2, 5]
+        assert [j for j, position in offset_map.items()] == [0, 2, 5]
+        assert [s.next_name() for j in range(5)] == [
+            int8_to_str(j) for j in (4, 3, 1, 6, 7)]
+
+    def h(self):
+        name = mktemp()
+        s = Shelf(name)
+        assert s.get_checkpoint_name() == name + '.index'
+        assert s.read_checkpoint() is None
+        names = [s.next_name() for j in range(4)]
+        s.store([(names[0], 'a'), (names[1], 'b')])
+        s.store([(names[2], 'c')])
+        s.write_checkpoint()
+        assert exists(name + '.index')
+        s.store([(names[3], 'd'), (names[0], 'e')])
+        index = dict(s.memory_index)
+        s.close()
+        s = Shelf(name, readonly=True)
+        position, checkpoint_index = s.read_checkpoint()
+        assert sorted(checkpoint_index) == names[:3]
+        assert s.memory_index == index
+        assert s.get_value(names[0]) == as_bytes('e')
+        s.close()
+        # A damaged checkpoint is ignored.
+        f = open(name + '.index', 'r+b')
+        f.seek(20)
+        f.write(as_bytes('x'))
+        f.close()
+        s = Shelf(name)
+        assert s.read_checkpoint() is None
+        assert s.memory_index == index
+        s.write_checkpoint()
+        s.close()
+        # So is a checkpoint that does not match the file.
+        f = open(name, 'r+b')
+        f.seek(-1, 2)
+        f.write(as_bytes('x'))
+        f.close()
+        s = Shelf(name)
+        assert s.read_checkpoint() is None
+        assert s.get_value(names[0]) == as_bytes('x')
+        s.close()
+        unlink(name)
+        unlink(name + '.index')
+
+    def i(self):
+        name = mktemp()
+        writer = Shelf(name)
+        names = [writer.next_name() for j in range(3)]
+        writer.store([(names[0], 'a')])
+        reader = Shelf(name, readonly=True, shared=True)
+        assert reader.end == writer.end
+        writer.store([(names[1], 'b')])
+        end = writer.end
+        writer.store([(names[2], 'c')])
+        assert names[1] not in reader
+        reader.refresh(end)
+        assert reader.end == end
+        assert reader.get_value(names[1]) == as_bytes('b')
+        assert names[2] not in reader
+        # A transaction that is still being written is left for later.
+        f = open(name, 'ab')
+        f.write(int8_to_str(100))
+        f.close()
+        reader.refresh()
+        assert reader.end == writer.end
+        assert reader.get_value(names[2]) == as_bytes('c')
+        reader.close()
+        # Without shared, it is an error.
+        raises(ShortRead, Shelf, name, readonly=True)
+        writer.close()
+        unlink(name)
+
+    def j(self):
+        # The items need not be in oid order, and can span offset blocks.
+        numbers = [70000, 3, 65536, 0, 65535, 131073]
+        items = [(int8_to_str(n), as_bytes('record%s' % n)) for n in numbers]
+        s = Shelf(File(), items=items)
+        for name, value in items:
+            assert s.get_value(name) == value
+        assert sorted(s) == sorted(name for name, value in items)
+        assert s.get_value(int8_to_str(1)) is None
+        assert s.get_value(int8_to_str(65537)) is None
+
+    def k(self):
+        # The bytes replaced in the initial transaction are counted as
+        # records are stored, refreshed and read from a checkpoint.
+        name = mktemp()
+        items = [(int8_to_str(n), as_bytes('x' * n)) for n in range(4)]
+        s = Shelf(name, items=items)
+        assert s.get_replaced_bytes() == 0
+        s.store([(int8_to_str(1), 'a'), (int8_to_str(1), 'b')])
+        assert s.get_replaced_bytes() == 8 + 8 + 1
+        s.store([(int8_to_str(1), 'c'), (int8_to_str(4), 'd')])
+        assert s.get_replaced_bytes() == 8 + 8 + 1
+        reader = Shelf(name, readonly=True, shared=True)
+        assert reader.get_replaced_bytes() == 8 + 8 + 1
+        s.store([(int8_to_str(3), 'e')])
+        reader.refresh()
+        assert reader.get_replaced_bytes() == 2 * (8 + 8) + 1 + 3
+        reader.close()
+        s.write_checkpoint()
+        s.store([(int8_to_str(2), 'f')])
+        s.close()
+        s = Shelf(name)
+        assert s.read_checkpoint() is not None
+        assert s.get_replaced_bytes() == 3 * (8 + 8) + 1 + 3 + 2
+        s.close()
+        unlink(name)
+        unlink(name + '.index')
+
 
 if __name__ == '__main__':
     ShelfTest()
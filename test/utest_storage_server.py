@@ -2,11 +2,20 @@
 $URL$
 $Id$
 """
-from durus.file_storage import TempFileStorage
-from durus.storage_server import StorageServer
-from durus.utils import read, as_bytes
+from durus.file import File
+from durus.file_storage import TempFileStorage, FileStorage
+from durus.replicated_storage_server import ReplicatedStorageServer, _Reader
+from durus.replicated_storage_server import ReadReplica, _send_with_socket
+from durus.serialize import pack_record
+from durus.storage import FSYNC_GROUP
+from durus.storage_server import StorageServer, _Client, STATUS_INVALID
+from durus.storage_server import STATUS_OKAY
+from durus.utils import read, as_bytes, int8_to_str, str_to_int8
+from durus.utils import int4_to_str, join_bytes, read_int4
+from os import unlink
 from random import choice
 from sancho.utest import UTest
+import socket
 
 class Test (UTest):
 
@@ -25,6 +34,100 @@ class Test (UTest):
         fake_socket = Dribble()
         read(fake_socket, 30)
 
+    def check_group_commit_invalidations(self):
+        file = File(prefix='group')
+        name = file.get_name()
+        file.close()
+        storage = FileStorage(name, fsync=FSYNC_GROUP)
+        server = StorageServer(storage, commit_window=60)
+        pairs = [socket.socketpair() for j in range(2)]
+        committer, other = [_Client(pair[0], None) for pair in pairs]
+        server.clients.extend([committer, other])
+        oid = int8_to_str(0)
+        record = pack_record(oid, as_bytes('x'), as_bytes(''))
+        server._commit(committer.s, join_bytes(
+            [int4_to_str(8 + len(record)), oid, record]))
+        # Until the fsync, the commit is not acknowledged, and other
+        # clients do not hear of it, except when they commit.
+        assert server.commit_acks == [committer.s]
+        assert not other.invalid
+        server._send_commit_invalidations(other.s)
+        peer = pairs[1][1]
+        assert read_int4(peer) == 1 and read(peer, 8) == oid
+        # A load of the record completes the group first.
+        server._send_load_responses(other.s, as_bytes(''), [oid])
+        assert not server.commit_acks
+        assert read(pairs[0][1], 1) == STATUS_OKAY
+        assert read(peer, 1) == STATUS_INVALID
+        for pair in pairs:
+            for s in pair:
+                s.close()
+        storage.close()
+        unlink(name)
+
+    def check_replica_request_end(self):
+        file = File(prefix='replica')
+        name = file.get_name()
+        file.close()
+        storage = FileStorage(name)
+        server = ReplicatedStorageServer(storage, readers=1)
+        client_s, client_peer = socket.socketpair()
+        reader_s, reader_peer = socket.socketpair()
+        reader = _Reader(0, reader_s)
+        server.readers.append(reader)
+        server.clients.append(_Client(client_s, None))
+        server.sockets.append(client_s)
+        # The reader is busy, so this load waits in its queue.
+        reader.requests.append((None, as_bytes(''), as_bytes(''), []))
+        server._send_load_responses(client_s, as_bytes(''), [int8_to_str(0)])
+        end = storage.shelf.end
+        storage.begin()
+        storage.store(int8_to_str(0),
+            pack_record(int8_to_str(0), as_bytes('x'), as_bytes('')))
+        storage.end()
+        assert storage.shelf.end > end
+        reader.requests.popleft()
+        server._send_reader_request(reader)
+        # The reader is sent the end from when the load arrived.
+        assert str_to_int8(reader_peer.recv(12)[4:]) == end
+        for s in (client_s, client_peer, reader_s, reader_peer):
+            s.close()
+        storage.close()
+        unlink(name)
+
+    def check_replica_writes_to_client(self):
+        file = File(prefix='replica')
+        name = file.get_name()
+        file.close()
+        storage = FileStorage(name)
+        oid = int8_to_str(0)
+        record = pack_record(oid, as_bytes('x'), as_bytes(''))
+        storage.begin()
+        storage.store(oid, record)
+        storage.end()
+        replica = ReadReplica(name)
+        client_s, client_peer = socket.socketpair()
+        reader_s, reader_peer = socket.socketpair()
+        _send_with_socket(reader_peer, join_bytes([
+            int4_to_str(0), int8_to_str(storage.shelf.end), int4_to_str(2),
+            int4_to_str(4), as_bytes('tag!'),
+            STATUS_OKAY, oid, STATUS_INVALID, int8_to_str(1)]), client_s)
+        reader_peer.shutdown(socket.SHUT_WR)
+        replica.serve(reader_s)
+        # The reader answers the client itself, and then the primary.
+        assert read(reader_peer, 1) == STATUS_OKAY
+        assert read(client_peer, 4) == as_bytes('tag!')
+        assert read(client_peer, 1) == STATUS_OKAY
+        assert read(client_peer, read_int4(client_peer)) == record
+        assert read(client_peer, 1) == STATUS_INVALID
+        # The client's socket is still open in the primary.
+        client_s.sendall(as_bytes('?'))
+        assert read(client_peer, 1) == as_bytes('?')
+        for s in (client_s, client_peer, reader_peer):
+            s.close()
+        storage.close()
+        unlink(name)
+
 
 if __name__ == "__main__":
     Test()
@@ -4,6 +4,7 @@ $Id$
 """
 from durus.file import File
 from durus.utils import Byte, ByteArray, BitArray, IntArray, WordArray, IntSet
+from durus.utils import Bitmap
 from durus.utils import read, write
 from durus.utils import read_int4, write_int4
 from durus.utils import read_int4_str, write_int4_str
@@ -12,6 +13,7 @@ from durus.utils import read_int8_str, write_int8_str
 from durus.utils import ShortRead, xrange, iteritems, BytesIO, as_bytes
 from durus.utils import str_to_int4, int4_to_str
 from durus.utils import str_to_int8, int8_to_str
+from durus.utils import decode_words, encode_words
 from sancho.utest import UTest, raises
 import durus.utils
 
@@ -214,6 +216,32 @@ class IntArrayTest (UTest):
         int_array2 = IntArray(file=file)
 
 
+    def read_write_block(self):
+        for maximum_int in (10, 300, 2**20, 2**40, None):
+            int_array = IntArray(number_of_ints=10, maximum_int=maximum_int)
+            block = int_array.read_block(2, 6)
+            assert list(block) == [int_array.get_blank_value()] * 4
+            block[0] = 5
+            block[3] = 7
+            int_array.write_block(2, block)
+            assert int_array.get(2) == 5
+            assert int_array.get(3) is None
+            assert int_array.get(5) == 7
+            assert list(iteritems(int_array)) == [(2, 5), (5, 7)]
+            assert list(int_array.read_block(4, 4)) == []
+            raises(IndexError, int_array.read_block, 5, 11)
+            raises(IndexError, int_array.write_block, 9, [1, 2])
+        assert list(dict(int_array.gen_blocks(block_size=4))) == [0, 4, 8]
+
+    def encode_decode_words(self):
+        for bytes_per_word in range(1, 9):
+            values = [0, 1, 2**(8 * bytes_per_word) - 1, 2**(4 * bytes_per_word)]
+            data = encode_words(values, bytes_per_word)
+            assert len(data) == len(values) * bytes_per_word
+            assert list(decode_words(data, bytes_per_word)) == values
+            assert data[:bytes_per_word] == (
+                int8_to_str(values[0])[8 - bytes_per_word:])
+
 class BitArrayTest (UTest):
 
     def a(self):
@@ -273,6 +301,38 @@ class IntSetTest (UTest):
                 assert x - 1 not in int_set
 
 
+class BitmapTest (UTest):
+
+    def a(self):
+        bitmap = Bitmap()
+        for x in range(1000):
+            assert x not in bitmap
+            bitmap.add(x)
+            assert x in bitmap
+        assert len(bitmap) == 1000
+        assert list(bitmap) == list(range(1000))
+        for x in range(1000):
+            bitmap.discard(x)
+            assert x not in bitmap
+        assert len(bitmap) == 0
+        assert list(bitmap) == []
+        bitmap.discard(10**6)
+
+    def b(self):
+        a = Bitmap()
+        b = Bitmap()
+        for x in (3, 9, 700):
+            a.add(x)
+        for x in (0, 9, 5000):
+            b.add(x)
+        a.update(b)
+        assert list(a) == [0, 3, 9, 700, 5000]
+        c = Bitmap(bytes(a.bits))
+        c.update(Bitmap().bits)
+        assert list(c) == list(a)
+        assert 5001 not in c
+
+
 if __name__ == '__main__':
     ByteTest()
     ByteArrayTest()
@@ -281,4 +341,5 @@ if __name__ == '__main__':
     WordArrayTest()
     IntArrayTest()
     IntSetTest()
+    BitmapTest()
     UtilTest()